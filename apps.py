@@ -2,23 +2,35 @@ import os
 import webapp2
 import logging
 
-import handlers
-
 
 debug = os.environ.get('SERVER_SOFTWARE', '').startswith('Dev')
 loglevel = logging.DEBUG if debug else logging.INFO
 
 logging.getLogger().setLevel(logging.DEBUG)     # XXX
 
+# Handlers are referenced by name, so module with them is imported only when route matches
 task_app = webapp2.WSGIApplication([
-    ('/task/index', handlers.IndexTaskHandler),
-    ('/task/torrent', handlers.TorrentTaskHandler),
-    ('/task/update_feeds', handlers.FeedsTaskHandler),
-    ('/task/build_feed', handlers.SingleFeedTaskHandler),
-    ('/task/buildmap', handlers.CategoryMapTaskHandler),
-    ('/task/cleanup', handlers.JanitorTaskHandler)
+    ('/task/index', 'handlers.IndexTaskHandler'),
+    ('/task/torrent', 'handlers.TorrentTaskHandler'),
+    ('/task/update_feeds', 'handlers.FeedsTaskHandler'),
+    ('/task/build_feed', 'handlers.SingleFeedTaskHandler'),
+    ('/task/buildmap', 'handlers.CategoryMapTaskHandler'),
+    ('/task/cleanup', 'handlers.JanitorTaskHandler'),
+    ('/task/recount', 'handlers.RecountTaskHandler'),
+    ('/task/migrate_descriptions', 'handlers.DescriptionMigrationTaskHandler'),
 ], debug=debug)
 
 manage_app = webapp2.WSGIApplication([
-    ('/manage/', handlers.DashboardHandler),
+    ('/manage/stats', 'handlers.DashboardHandler'),
+    ('/manage/spans', 'handlers.SpanStatsHandler'),
+], debug=debug)
+
+public_app = webapp2.WSGIApplication([
+    ('/search', 'handlers.SearchHandler'),
+    ('/feeds/custom', 'handlers.CompositeFeedHandler'),
+    (r'/feeds/short/([rcf]\d+)\.xml', 'handlers.CategoryFeedHandler'),
+], debug=debug)
+
+warmup_app = webapp2.WSGIApplication([
+    ('/_ah/warmup', 'handlers.WarmupHandler'),
 ], debug=debug)
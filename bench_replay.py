@@ -0,0 +1,186 @@
+"""Replays recorded tracker session through the whole import pipeline and compares timings with baseline
+
+Tracker responses come from Betamax cassette, datastore, memcache, task queue and storage are local
+stand-ins set up by pipeline module. Tasks are executed synchronously, so replay order matches recording."""
+import json
+import optparse
+import os
+import sys
+import time
+
+import pipeline
+
+
+USAGE = """%prog SDK_PATH CASSETTE [options]
+Replay tracker session recorded in CASSETTE through import pipeline, report
+per-stage latency and torrents/sec and compare them with stored baseline.
+Exits with status 1 if results regress.
+
+SDK_PATH    Path to Google Cloud or Google App Engine SDK installation, usually
+            ~/google_cloud_sdk
+CASSETTE    Cassette name, record it first with --record and tracker credentials"""
+
+TOLERANCE = 0.2         # Allowed relative slowdown against baseline
+MIN_DELTA_MS = 1.0      # Smaller slowdowns of mean latency are noise
+
+
+def account_path(options, cassette):
+    return os.path.join(options.cassette_dir, '{}.account.json'.format(cassette))
+
+
+def baseline_path(options, cassette):
+    return options.baseline or os.path.join(options.cassette_dir, '{}.baseline.json'.format(cassette))
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path, value):
+    with open(path, 'w') as f:
+        json.dump(value, f, indent=2, sort_keys=True)
+
+
+def make_account(options, cassette):
+    """Create tracker account entity. Password is only needed for recording, it's not stored"""
+    from models import Account
+    path = account_path(options, cassette)
+
+    if options.record:
+        if not (options.username and options.password and options.userid):
+            raise SystemExit('Recording requires --username, --password and --userid')
+        save_json(path, {'username': options.username, 'userid': options.userid})
+        Account(username=options.username, password=options.password, userid=options.userid).put()
+    else:
+        account = load_json(path)
+        if account is None:
+            raise SystemExit('No account file {}, record cassette first'.format(path))
+        Account(username=account['username'], password='replay', userid=account['userid']).put()
+
+
+def replay(options, cassette):
+    """Run pipeline with tracker responses from cassette, returns report dict"""
+    import betamax
+    import requests
+    import debug
+    import webclient
+
+    pipeline.local_services()
+    pipeline.install_collector()
+    make_account(options, cassette)
+
+    session = requests.Session()
+    recorder = betamax.Betamax(session, cassette_library_dir=options.cassette_dir)
+    webclient.set_session_factory(lambda: session)
+
+    with recorder.use_cassette(cassette, record='once' if options.record else 'none'):
+        runner = pipeline.Runner(pipeline.SyncExecutor())
+        started = time.time()
+        stage_stats = runner.run()
+        elapsed = time.time() - started
+
+    debug.flush_spans()
+    return make_report(stage_stats, debug.span_stats(), elapsed)
+
+
+def make_report(stage_stats, span_stats, elapsed):
+    """Returns dict with throughput and mean latencies of pipeline stages and span stages"""
+    torrents = stage_stats['/task/torrent'].tasks
+    report = {
+        'elapsed': round(elapsed, 3),
+        'torrents': torrents,
+        'torrents_per_sec': round(torrents / elapsed, 2) if elapsed else 0.0,
+        'stages': {},
+        'spans': {},
+    }
+
+    for url, stage in stage_stats.items():
+        if stage.tasks:
+            report['stages'][url] = {'tasks': stage.tasks, 'mean_ms': round(stage.task_time / stage.tasks * 1000, 2)}
+
+    for name, span in span_stats.items():
+        if span['count']:
+            report['spans'][name] = {'count': span['count'], 'mean_ms': round(float(span['ms']) / span['count'], 2),
+                                     'p95_ms': span['p95']}
+
+    return report
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    """Returns list of regressions of report against baseline, as messages"""
+    rv = []
+    if report['torrents'] != baseline['torrents']:
+        rv.append('{} torrents imported, baseline {}'.format(report['torrents'], baseline['torrents']))
+
+    if report['torrents_per_sec'] < baseline['torrents_per_sec'] * (1 - tolerance):
+        rv.append('{} torrents/sec, baseline {}'.format(report['torrents_per_sec'], baseline['torrents_per_sec']))
+
+    for group in ('stages', 'spans'):
+        for name, base in baseline[group].items():
+            current = report[group].get(name)
+            if current is None:
+                rv.append('{} {} did not run'.format(group[:-1], name))
+                continue
+            delta = current['mean_ms'] - base['mean_ms']
+            if delta > MIN_DELTA_MS and current['mean_ms'] > base['mean_ms'] * (1 + tolerance):
+                rv.append('{} mean {}ms, baseline {}ms'.format(name, current['mean_ms'], base['mean_ms']))
+
+    return rv
+
+
+def print_report(report, baseline=None):
+    print 'Replayed in {}s: {} torrents, {} torrents/sec{}'.format(
+        report['elapsed'], report['torrents'], report['torrents_per_sec'],
+        ' (baseline {})'.format(baseline['torrents_per_sec']) if baseline else '')
+
+    for group in ('stages', 'spans'):
+        for name, values in sorted(report[group].items()):
+            base = baseline and baseline[group].get(name)
+            print '{:<28} {:>6} x {:>9.2f}ms{}'.format(
+                name, values.get('tasks', values.get('count')), values['mean_ms'],
+                ' (baseline {:.2f}ms)'.format(base['mean_ms']) if base else '')
+
+
+def main(sdk_path, cassette, options):
+    pipeline.setup_sdk(sdk_path)
+    report = replay(options, cassette)
+
+    if options.record:
+        print 'Recorded cassette {}, replay it to make baseline'.format(cassette)
+        return 0
+
+    path = baseline_path(options, cassette)
+    baseline = None if options.update_baseline else load_json(path)
+    print_report(report, baseline)
+
+    if baseline is None:
+        save_json(path, report)
+        print 'Baseline saved to {}'.format(path)
+        return 0
+
+    regressions = compare(report, baseline, options.tolerance)
+    for message in regressions:
+        print 'REGRESSION: {}'.format(message)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--cassette-dir', default='../cassettes', help='cassette library dir [default: %default]')
+    parser.add_option('--baseline', help='baseline file [default: CASSETTE.baseline.json in cassette dir]')
+    parser.add_option('--update-baseline', action='store_true', help='save results as new baseline')
+    parser.add_option('--tolerance', type='float', default=TOLERANCE,
+                      help='allowed relative slowdown [default: %default]')
+    parser.add_option('--record', action='store_true', help='record cassette from real tracker')
+    parser.add_option('--username', help='tracker username, for recording')
+    parser.add_option('--password', help='tracker password, for recording')
+    parser.add_option('--userid', type='int', help='tracker user id, for recording')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        print 'Error: Exactly 2 arguments required.'
+        parser.print_help()
+        sys.exit(1)
+    sys.exit(main(args[0], args[1], options))
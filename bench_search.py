@@ -0,0 +1,140 @@
+# coding: utf-8
+"""Benchmark of search index on synthetic torrent titles
+
+Measures in-memory index build and query latency, and how index writes spread over stored posting entities.
+With --sdk-path, also indexes titles into local datastore stub through dao, see pipeline.local_services."""
+import collections
+import optparse
+import random
+import sys
+import time
+
+import search
+
+
+USAGE = """%prog [options]
+Build search index over synthetic titles and measure query latency and posting write load."""
+
+SYLLABLES = [u'ка', u'ро', u'ми', u'на', u'ль', u'те', u'зо', u'вы', u'ше', u'ду', u'ja', u'ro', u'ne', u'ta']
+
+
+def make_vocabulary(size, rnd):
+    words = set()
+    while len(words) < size:
+        words.add(u''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 6))))
+    return sorted(words)
+
+
+def pick_word(vocabulary, rnd):
+    """Zipf-like word choice, low indexes are much more frequent"""
+    idx = int(rnd.paretovariate(1.1)) - 1
+    return vocabulary[idx % len(vocabulary)]
+
+
+def make_title(vocabulary, rnd):
+    words = [pick_word(vocabulary, rnd) for _ in range(rnd.randint(4, 10))]
+    return u'{} ({}) [{}]'.format(u' '.join(words).capitalize(), rnd.randint(1950, 2016), rnd.choice(['HDRip', 'FLAC']))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def print_write_load(token_writes, shard_writes, num_titles, import_rate):
+    """Print share of index writes taken by the hottest posting entity, unsharded and sharded"""
+    for label, writes in [('unsharded', token_writes), ('sharded', shard_writes)]:
+        name, count = writes.most_common(1)[0]
+        share = float(count) / num_titles
+        print u'Hottest {} posting entity {}: written by {:.1%} of torrents, {:.2f} writes/s at {} torrents/s'.format(
+            label, name, share, share * import_rate, import_rate).encode('utf-8')
+
+
+def bench_datastore(docs, queries, k):
+    """Index docs into local datastore stub through dao, print write and query latency"""
+    import dao
+
+    latencies = []
+    for tid, title, cat_ids in docs:
+        started = time.time()
+        dao.add_to_search_index(tid, search.document_tokens(title, cat_ids))
+        latencies.append((time.time() - started) * 1000)
+    print '{} titles indexed into datastore, latency ms: p50 {:.2f}, p95 {:.2f}, max {:.2f}'.format(
+        len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.95), max(latencies))
+
+    latencies = []
+    for query, cat in queries:
+        started = time.time()
+        search.intersect_newest(dao.get_postings(search.query_tokens(query, cat)), k)
+        latencies.append((time.time() - started) * 1000)
+    print '{} datastore queries, latency ms: p50 {:.2f}, p95 {:.2f}, max {:.2f}'.format(
+        len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.95), max(latencies))
+
+
+def main(options):
+    rnd = random.Random(options.seed)
+    vocabulary = make_vocabulary(options.vocabulary, rnd)
+    forums = ['f{}'.format(i) for i in range(options.forums)]
+    index = search.InvertedIndex()
+    token_writes = collections.Counter()
+    shard_writes = collections.Counter()
+    docs = []
+
+    started = time.time()
+    for tid in xrange(1, options.titles + 1):
+        forum = rnd.choice(forums)
+        title = make_title(vocabulary, rnd)
+        cat_ids = ['r0', 'c{}'.format(int(forum[1:]) % 20), forum]
+        index.add(tid, title, cat_ids)
+        if options.sdk_path and len(docs) < options.datastore_titles:
+            docs.append((tid, title, cat_ids))
+        for token in search.document_tokens(title, cat_ids):
+            token_writes[token] += 1
+            shard_writes[search.posting_shard(token, tid)] += 1
+    build_time = time.time() - started
+
+    nbytes = sum(p.itemsize * len(p) for p in index.postings.values())
+    print '{} titles indexed in {:.1f}s ({:.0f}/s), {} tokens, {:.1f} MB of postings'.format(
+        options.titles, build_time, options.titles / build_time, len(index.postings), nbytes / 1048576.0)
+    print_write_load(token_writes, shard_writes, options.titles, options.import_rate)
+
+    queries = []
+    for _ in range(options.queries):
+        words = [pick_word(vocabulary, rnd) for _ in range(rnd.randint(1, 3))]
+        cat = rnd.choice(forums) if rnd.random() < 0.3 else None
+        queries.append((u' '.join(words), cat))
+
+    latencies = []
+    for query, cat in queries:
+        started = time.time()
+        index.search(query, cat, k=options.k)
+        latencies.append((time.time() - started) * 1000)
+
+    print '{} queries, latency ms: p50 {:.3f}, p95 {:.3f}, p99 {:.3f}, max {:.3f}'.format(
+        len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.95), percentile(latencies, 0.99),
+        max(latencies))
+
+    if options.sdk_path:
+        import pipeline
+        pipeline.setup_sdk(options.sdk_path)
+        pipeline.local_services()
+        bench_datastore(docs, queries[:options.datastore_queries], options.k)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--titles', type='int', default=1000000)
+    parser.add_option('--vocabulary', type='int', default=50000)
+    parser.add_option('--forums', type='int', default=500)
+    parser.add_option('--queries', type='int', default=2000)
+    parser.add_option('-k', type='int', default=20)
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--import-rate', type='float', default=5, help='torrents imported per second')
+    parser.add_option('--sdk-path', help='App Engine SDK path, benchmark datastore index too')
+    parser.add_option('--datastore-titles', type='int', default=2000)
+    parser.add_option('--datastore-queries', type='int', default=200)
+    options, args = parser.parse_args()
+    if args:
+        parser.print_help()
+        sys.exit(1)
+    main(options)
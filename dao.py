@@ -1,25 +1,37 @@
 """Data access layer"""
 import datetime
+import itertools
+import random
+import time
+import zlib
 from contextlib import contextmanager
 import logging
 
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 
-from models import Torrent, Category, Account, PersistentScalarValue
+import search
+from debug import traced
+from models import Torrent, TorrentDescription, TorrentFingerprint, Category, ForumCategory, Account, \
+    PersistentScalarValue, SearchPosting, FeedSnapshot, CategoryCounter
 
 
 ROOT_CATEGORY_KEY = ndb.Key(Category, 'r0')
+COUNTER_SHARDS = {'r': 20, 'c': 8, 'f': 2}  # Counter shards by category id prefix, upper levels get more writes
+XG_BATCH_SIZE = 25                          # Entity groups per cross-group transaction, datastore limit
+FIRST_COUNTERS_DT = datetime.datetime(2000, 1, 1)   # Counter marker of torrents counted before counters were reset
 _account_key = None
 
 
 # Generic functions
 
+@traced('datastore')
 def get_from_key(key):
     """Return entity from key"""
     return key.get()
 
 
+@traced('datastore')
 def write_multi(entities):
     """Write multiple entities at once"""
     ndb.put_multi(entities)
@@ -46,6 +58,7 @@ def get_all_parents_multi(keys):
 # Torrent-related functions
 
 
+@traced('datastore')
 def latest_torrent_dt():
     """Returns datetime for most recent torrent or start of epoch if no torrents"""
     latest_torrent = Torrent.query(ancestor=ROOT_CATEGORY_KEY).order(-Torrent.dt).get()
@@ -55,12 +68,60 @@ def latest_torrent_dt():
         return datetime.datetime.utcfromtimestamp(0)
 
 
+@traced('datastore')
 def latest_torrents(num_items, cat_key=None):
     """Returns num_items torrent in specified category and/or its subcategories"""
+    keys = _latest_torrent_keys(num_items, cat_key)
+    return ndb.get_multi(keys, max_memcache_items=100)
+
+
+@traced('datastore')
+def latest_forum_torrents(num_items, cat_key):
+    """Returns num_items latest torrents of forum itself, without its subforums"""
+    forum_id = int(cat_key.id()[1:])
+    keys = Torrent.query(Torrent.forum_id == forum_id).order(-Torrent.dt).fetch(num_items, keys_only=True)
+    return ndb.get_multi(keys, max_memcache_items=100)
+
+
+@traced('datastore')
+def latest_torrent_keys(num_items, cat_key=None):
+    """Returns keys for num_items latest torrents in specified category and/or its subcategories"""
+    return _latest_torrent_keys(num_items, cat_key)
+
+
+def _latest_torrent_keys(num_items, cat_key=None):
     if cat_key is None:
         cat_key = ROOT_CATEGORY_KEY
-    keys = Torrent.query(ancestor=cat_key).order(-Torrent.dt).fetch(num_items, keys_only=True, max_memcache_items=100)
-    return ndb.get_multi(keys, max_memcache_items=100)
+    return Torrent.query(ancestor=cat_key).order(-Torrent.dt).fetch(num_items, keys_only=True, max_memcache_items=100)
+
+
+@traced('datastore')
+def old_torrent_keys_page(cutoff_dt, cursor=None, page_size=100):
+    """Returns page of keys for torrents older than cutoff_dt, oldest first
+
+    Returns (keys, urlsafe cursor, more) tuple"""
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    keys, next_cursor, more = Torrent.query(Torrent.dt < cutoff_dt).order(Torrent.dt).fetch_page(
+        page_size, start_cursor=start_cursor, keys_only=True)
+    return keys, next_cursor and next_cursor.urlsafe(), more
+
+
+@traced('datastore')
+def torrents_page(cutoff_dt, cursor=None, page_size=500):
+    """Returns page of torrents created or updated before cutoff_dt, oldest first
+
+    Returns (torrents, urlsafe cursor, more) tuple"""
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    torrents, next_cursor, more = Torrent.query(Torrent.dt <= cutoff_dt).order(Torrent.dt).fetch_page(
+        page_size, start_cursor=start_cursor, use_cache=False, use_memcache=False)
+    return torrents, next_cursor and next_cursor.urlsafe(), more
+
+
+@traced('datastore')
+def delete_torrents(keys):
+    """Delete torrents along with their descriptions and fingerprints"""
+    ndb.delete_multi(keys + [description_key(key) for key in keys] +
+                     [ndb.Key(TorrentFingerprint, key.id()) for key in keys])
 
 
 def make_torrent(parent, fields):
@@ -68,6 +129,79 @@ def make_torrent(parent, fields):
     return Torrent(parent=parent, **fields)
 
 
+def description_key(torrent_key):
+    """Returns key of description entity for torrent"""
+    return ndb.Key(TorrentDescription, 1, parent=torrent_key)
+
+
+def make_torrent_description(torrent_key, html, raw_size=None):
+    """Make description entity for torrent, html is compressed here"""
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    return TorrentDescription(key=description_key(torrent_key), data=zlib.compress(html), raw_size=raw_size)
+
+
+@traced('datastore')
+def get_torrent_description(torrent_key):
+    """Returns torrent description text, loaded on demand. Falls back to legacy inline description"""
+    desc = description_key(torrent_key).get()
+    if desc:
+        return desc.text
+
+    torrent = torrent_key.get()
+    return torrent and torrent.description
+
+
+@traced('datastore')
+def move_descriptions_page(cursor=None, page_size=100):
+    """Move inline descriptions of one page of torrents to description entities
+
+    Returns (number of moved descriptions, urlsafe cursor, more) tuple"""
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    torrents, next_cursor, more = Torrent.query(ancestor=ROOT_CATEGORY_KEY).fetch_page(
+        page_size, start_cursor=start_cursor, use_cache=False, use_memcache=False)
+    to_write = []
+
+    for torrent in torrents:
+        if torrent.description is None:
+            continue
+        to_write.append(make_torrent_description(torrent.key, torrent.description))
+        torrent.description = None
+        to_write.append(torrent)
+
+    ndb.put_multi(to_write)
+    return len(to_write) // 2, next_cursor and next_cursor.urlsafe(), more
+
+
+def make_fingerprint(torrent):
+    """Make fingerprint entity for torrent"""
+    return TorrentFingerprint(id=torrent.key.id(), title=torrent.title, nbytes=torrent.nbytes,
+                              forum_id=torrent.forum_id, torrent_key=torrent.key)
+
+
+@traced('datastore')
+def get_fingerprints(tids):
+    """Returns list of fingerprints (or None if torrent is unknown) for torrent ids"""
+    return ndb.get_multi([ndb.Key(TorrentFingerprint, tid) for tid in tids])
+
+
+@traced('datastore')
+def update_torrent_dts(key_dt_pairs):
+    """Set new dt for torrents, specified by list of (key, dt) tuples"""
+    if not key_dt_pairs:
+        return
+
+    keys, dts = zip(*key_dt_pairs)
+    torrents = ndb.get_multi(keys)
+    to_write = []
+    for torrent, dt in zip(torrents, dts):
+        if torrent:
+            torrent.dt = dt
+            to_write.append(torrent)
+    ndb.put_multi(to_write)
+
+
+@traced('datastore')
 def torrent_keys_since_dt(dt):
     """Returns list of keys for torrents added since dt"""
     return Torrent.query(Torrent.dt > dt).fetch(keys_only=True)
@@ -75,6 +209,7 @@ def torrent_keys_since_dt(dt):
 
 # Category-related functions
 
+@traced('datastore')
 def get_all_categories():
     """Returns all categories"""
     return Category.query(ancestor=ROOT_CATEGORY_KEY).fetch()
@@ -93,11 +228,181 @@ def category_key_from_tuples(cat_tuples):
     return ndb.Key(pairs=pairs)
 
 
+def get_top_categories():
+    """Returns list of (id, title) tuples for root category and its children, cached in memcache for an hour"""
+    rv = memcache.get('top_categories')
+    if rv is None:
+        cats = get_all_categories()
+        rv = [(c.key.id(), c.title) for c in cats if c.key == ROOT_CATEGORY_KEY or c.key.parent() == ROOT_CATEGORY_KEY]
+        rv.sort(key=lambda item: item[0] != ROOT_CATEGORY_KEY.id())     # Root first
+        memcache.set('top_categories', rv, 3600)
+    return rv
+
+
 def make_category(key, title):
     """Make category entity with key and title"""
     return Category(key=key, title=title)
 
 
+def make_forum_category(forum_id, cat_key):
+    """Make forum index entity, mapping forum id to full category key"""
+    return ForumCategory(id=forum_id, cat_key=cat_key)
+
+
+@traced('datastore')
+def get_forum_category_keys(forum_ids):
+    """Returns list of full category keys (or None for unknown forums) for forum ids"""
+    entities = ndb.get_multi([ndb.Key(ForumCategory, fid) for fid in forum_ids])
+    return [e and e.cat_key for e in entities]
+
+
+def counter_shards(cat_id):
+    """Returns number of counter shards for category"""
+    return COUNTER_SHARDS.get(cat_id[0], 1)
+
+
+def rollup_counter_deltas(changes):
+    """Returns dict of category id to [count, nbytes] deltas, for list of (category key, count, nbytes) changes
+
+    Every change is added to its category and all parents, categories with zero deltas are left out"""
+    deltas = {}
+    for cat_key, count, nbytes in changes:
+        for key in [cat_key] + get_all_parents(cat_key):
+            delta = deltas.setdefault(key.id(), [0, 0])
+            delta[0] += count
+            delta[1] += nbytes
+    return dict((cat_id, delta) for cat_id, delta in deltas.items() if delta != [0, 0])
+
+
+@traced('datastore')
+def update_category_counters(changes):
+    """Add torrent count and size changes, list of (category key, count, nbytes) tuples, to category counters
+
+    Changes are rolled up to parents and written to one random shard per category, so the root isn't a hot entity"""
+    deltas = rollup_counter_deltas(changes).items()
+    for i in range(0, len(deltas), XG_BATCH_SIZE):
+        batch = deltas[i:i + XG_BATCH_SIZE]
+        ndb.transaction(lambda: _add_to_counter_shards(batch), xg=True)
+
+
+@traced('datastore')
+def count_torrent(torrent, description, previous_key=None):
+    """Write imported torrent with its description and fingerprint, and add it to category counters, in one transaction
+
+    Torrent is marked as counted with time counters were reset. Stored torrent which is already counted, after
+    retried import or import of torrent which had no fingerprint, is subtracted, as is moved torrent at previous_key.
+    Moved torrent is deleted in the same transaction, so counters change once however many times import is tried"""
+    torrent.counted = get_counters_reset_dt()
+    to_put = [torrent, description, make_fingerprint(torrent)]
+    keys = [torrent.key]
+    if previous_key and previous_key != torrent.key:
+        keys.append(previous_key)
+
+    def txn():
+        changes = [(torrent.key.parent(), 1, torrent.nbytes)]
+        changes.extend((t.key.parent(), -1, -t.nbytes) for t in ndb.get_multi(keys)
+                       if t and _is_counted(t, torrent.counted))
+        _add_to_counter_shards(rollup_counter_deltas(changes).items())     # Two category paths fit one transaction
+        ndb.put_multi(to_put)
+        if len(keys) > 1:
+            ndb.delete_multi([previous_key, description_key(previous_key)])
+
+    ndb.transaction(txn, xg=True)
+
+
+@traced('datastore')
+def count_stored_torrents(keys, reset_dt):
+    """Add stored torrents which were not counted since counters were reset at reset_dt to counters, and mark them
+
+    Returns number of torrents counted"""
+    def txn(batch):
+        torrents = [t for t in ndb.get_multi(batch) if t and not _is_counted(t, reset_dt)]
+        _add_to_counter_shards(rollup_counter_deltas([(t.key.parent(), 1, t.nbytes) for t in torrents]).items())
+        for torrent in torrents:
+            torrent.counted = reset_dt
+        ndb.put_multi(torrents)
+        return len(torrents)
+
+    return sum(ndb.transaction(lambda: txn(batch), xg=True) for batch in _counter_batches(keys))
+
+
+@traced('datastore')
+def delete_counted_torrents(keys):
+    """Delete torrents along with their descriptions and fingerprints, and subtract counted ones from counters
+
+    Torrents are deleted in the transactions which change counters, so retried deletes don't subtract twice"""
+    reset_dt = get_counters_reset_dt()
+    ndb.delete_multi([ndb.Key(TorrentFingerprint, key.id()) for key in keys])
+
+    def txn(batch):
+        torrents = [t for t in ndb.get_multi(batch) if t and _is_counted(t, reset_dt)]
+        _add_to_counter_shards(rollup_counter_deltas([(t.key.parent(), -1, -t.nbytes) for t in torrents]).items())
+        ndb.delete_multi(batch + [description_key(key) for key in batch])
+
+    for batch in _counter_batches(keys):
+        ndb.transaction(lambda: txn(batch), xg=True)
+
+
+def _is_counted(torrent, reset_dt):
+    return (torrent.counted or FIRST_COUNTERS_DT) == reset_dt     # Unmarked torrents were counted before first reset
+
+
+def _counter_batches(torrent_keys):
+    """Split torrent keys into batches which fit one transaction with counter shards of their categories
+
+    All torrents are in the entity group of root category, other groups are one counter shard per category"""
+    batches, batch, cat_ids = [], [], set()
+    for key in sorted(torrent_keys, key=lambda k: k.pairs()):
+        path = set(cat_id for _, cat_id in key.parent().pairs())
+        if batch and len(cat_ids | path) >= XG_BATCH_SIZE:
+            batches.append(batch)
+            batch, cat_ids = [], set()
+        batch.append(key)
+        cat_ids |= path
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _add_to_counter_shards(deltas):
+    keys = [ndb.Key(CategoryCounter, '{}.{}'.format(cat_id, random.randrange(counter_shards(cat_id))))
+            for cat_id, _ in deltas]
+    shards = ndb.get_multi(keys)
+    for i, (key, (count, nbytes)) in enumerate(zip(keys, deltas)):
+        shards[i] = shards[i] or CategoryCounter(key=key)
+        shards[i].count += count
+        shards[i].nbytes += nbytes
+    ndb.put_multi(shards)
+
+
+@traced('datastore')
+def get_category_counters(cat_ids):
+    """Returns list of (torrent count, total nbytes) tuples for category ids, subcategories included"""
+    keys = [ndb.Key(CategoryCounter, '{}.{}'.format(cat_id, shard))
+            for cat_id in cat_ids for shard in range(counter_shards(cat_id))]
+    totals = dict((cat_id, [0, 0]) for cat_id in cat_ids)
+    for key, shard in zip(keys, ndb.get_multi(keys)):
+        if shard:
+            total = totals[key.id().rsplit('.', 1)[0]]
+            total[0] += shard.count
+            total[1] += shard.nbytes
+    return [tuple(totals[cat_id]) for cat_id in cat_ids]
+
+
+@traced('datastore')
+def reset_category_counters():
+    """Delete all category counter shards. Returns reset time, torrents counted after it are marked with it"""
+    reset_dt = datetime.datetime.utcnow()
+    CachedPersistentValue('counters_reset_dt').put(reset_dt)
+    ndb.delete_multi(CategoryCounter.query().fetch(keys_only=True))
+    return reset_dt
+
+
+def get_counters_reset_dt():
+    """Returns time category counters were last reset, see count_torrent"""
+    return CachedPersistentValue('counters_reset_dt').get() or FIRST_COUNTERS_DT
+
+
 # Account-related functions
 
 def get_account():
@@ -128,22 +433,126 @@ def account_context(acc=None):
 
 def get_last_feed_rebuild_dt():
     """Returns datatime of last feed rebuild"""
-    cts = CachedPersistentValue('feed_build_date')
+    cts = CachedPersistentValue('feed_build_date', local=True)
     return cts.get() or datetime.datetime.utcfromtimestamp(0)
 
 
 def set_last_feed_rebuild_dt(dt):
     """Saves datatime of last feed rebuild"""
-    cts = CachedPersistentValue('feed_build_date')
+    cts = CachedPersistentValue('feed_build_date', local=True)
     cts.put(dt)
 
 
+def save_feed_snapshot(cat_id, title, rows):
+    """Save newest items of category feed"""
+    FeedSnapshot(id=cat_id, title=title, items=rows).put()
+
+
+@traced('datastore')
+def get_feed_snapshots(cat_ids):
+    """Returns list of feed snapshots (or None if category has no feed yet) for category ids"""
+    return ndb.get_multi([ndb.Key(FeedSnapshot, cid) for cid in cat_ids])
+
+
+# Search-related functions
+
+@traced('datastore')
+def add_to_search_index(tid, tokens):
+    """Add torrent id to posting lists of tokens
+
+    Torrent id goes to one shard per token, so even tokens of every torrent, like categories, take few writes"""
+    shards = [search.posting_shard(t, tid) for t in tokens]
+    for i in range(0, len(shards), XG_BATCH_SIZE):
+        batch = shards[i:i + XG_BATCH_SIZE]
+        ndb.transaction(lambda: _add_to_posting_shards(tid, batch), xg=True)
+
+
+def _add_to_posting_shards(tid, shards):
+    keys = [ndb.Key(SearchPosting, s) for s in shards]
+    to_write = []
+    for key, entity in zip(keys, ndb.get_multi(keys)):
+        postings = search.make_postings(entity and entity.tids)
+        if entity and search.contains(postings, tid):
+            continue
+        search.add_posting(postings, tid, search.SHARD_POSTINGS)
+        to_write.append(SearchPosting(key=key, tids=postings.tostring()))
+    ndb.put_multi(to_write)
+
+
+@traced('datastore')
+def get_postings(tokens):
+    """Returns list of posting lists for tokens, empty for unknown ones"""
+    shards = [search.posting_shards(t) for t in tokens]
+    entities = iter(ndb.get_multi([ndb.Key(SearchPosting, s) for names in shards for s in names]))
+    return [search.merge_postings([search.make_postings(e and e.tids) for e in itertools.islice(entities, len(names))])
+            for names in shards]
+
+
+@traced('datastore')
+def search_torrents(query, cat_id=None, k=20):
+    """Returns up to k most recently updated torrents matching query, optionally in category and its subcategories
+
+    Posting lists are never cleaned up, so deleted torrents and torrents with changed titles are dropped here"""
+    tokens = search.query_tokens(query, cat_id)
+    if not tokens:
+        return []
+
+    def load(tids):
+        fingerprints = [fp for fp in get_fingerprints(tids) if fp]
+        rv = []
+        for torrent in ndb.get_multi([fp.torrent_key for fp in fingerprints]):
+            if not torrent:
+                continue
+            cat_ids = [key.id() for key in get_all_parents(torrent.key)]
+            if set(tokens).issubset(search.document_tokens(torrent.title, cat_ids)):
+                rv.append(torrent)
+        return rv
+
+    return search.most_recent(search.iter_newest(get_postings(tokens)), load, k)
+
+
+#  Cleanup-related functions
+
+def get_cleanup_state():
+    """Returns (urlsafe cursor, cutoff datetime) tuple for unfinished cleanup, (None, None) if there is none"""
+    cursor, cutoff_dt = CachedPersistentValue.get_multi(['cleanup_cursor', 'cleanup_cutoff'])
+    return cursor, cutoff_dt
+
+
+def acquire_cleanup_lock(seconds):
+    """Returns True if cleanup lock was taken. Lock expires after seconds unless released earlier"""
+    return memcache.add('cleanup_lock', 1, time=seconds)
+
+
+def release_cleanup_lock():
+    memcache.delete('cleanup_lock')
+
+
+def set_cleanup_state(cursor, cutoff_dt):
+    """Saves cleanup cursor and cutoff datetime, deletes them if cursor is None"""
+    values = [(CachedPersistentValue('cleanup_cursor'), cursor), (CachedPersistentValue('cleanup_cutoff'), cutoff_dt)]
+    for cpv, value in values:
+        if cursor is None:
+            cpv.delete()
+        else:
+            cpv.put(value)
+
+
 class CachedPersistentValue(object):
+    """Named value stored in datastore and cached in memcache
+
+    Values created with local=True are also cached in instance memory. Local cache is trusted for LOCAL_TTL
+    seconds, then revalidated against version stamp in memcache, which every put and delete changes"""
     root_key = ndb.Key('PersistentScalarValues', 'root')
+    VERSION_KEY = 'cts.version'
+    LOCAL_TTL = 10          # Seconds
+    _local = {}
+    _local_state = {'version': None, 'checked': 0}
 
-    def __init__(self, key):
+    def __init__(self, key, local=False):
         self.key = 'cts.{}'.format(key)
         self.ds_key = ndb.Key(PersistentScalarValue, key, parent=self.root_key)
+        self.local = local
 
     def put(self, value, async=False):
         if not memcache.set(self.key, value):
@@ -154,18 +563,24 @@ class CachedPersistentValue(object):
             psv.put_async()
         else:
             psv.put()
+        self.bump_version(value)
 
     def get(self):
-        val = memcache.get(self.key)
-        if val is not None:
-            return val
+        if self.local:
+            self.revalidate_local()
+            if self.key in self._local:
+                return self._local[self.key]
 
-        entity = self.ds_key.get()
-        if entity is None:
-            return None
+        val = memcache.get(self.key)
+        if val is None:
+            entity = self.ds_key.get()
+            if entity is not None:
+                val = entity.value
+                memcache.set(self.key, val)
 
-        memcache.set(self.key, entity.value)
-        return entity.value
+        if self.local:
+            self._local[self.key] = val
+        return val
 
     def delete(self, async=False):
         memcache.delete(self.key)
@@ -173,3 +588,57 @@ class CachedPersistentValue(object):
             self.ds_key.delete_async()
         else:
             self.ds_key.delete()
+        self.bump_version(None)
+
+    @classmethod
+    def get_multi(cls, keys, local=False):
+        """Returns list of values for keys, with one memcache and at most one datastore round trip"""
+        values = [cls(key, local) for key in keys]
+        found = {}
+        if local:
+            cls.revalidate_local()
+            found.update((v.key, cls._local[v.key]) for v in values if v.key in cls._local)
+
+        missing = [v for v in values if v.key not in found]
+        if missing:
+            found.update(memcache.get_multi([v.key for v in missing]))
+            missing = [v for v in missing if v.key not in found]
+
+        if missing:
+            entities = ndb.get_multi([v.ds_key for v in missing])
+            loaded = dict((v.key, e.value) for v, e in zip(missing, entities) if e is not None)
+            if loaded:
+                memcache.set_multi(loaded)
+            found.update((v.key, loaded.get(v.key)) for v in missing)
+
+        if local:
+            cls._local.update(found)
+        return [found[v.key] for v in values]
+
+    def bump_version(self, value):
+        """Invalidate local caches of all instances, keep new value in local cache of this one"""
+        version = memcache.incr(self.VERSION_KEY, initial_value=random.getrandbits(31))
+        state = self._local_state
+        if version is not None and state['version'] is not None and version == state['version'] + 1:
+            state['version'] = version      # Nobody else changed values since last check, local cache is valid
+        if self.local:
+            self._local[self.key] = value
+        else:
+            self._local.pop(self.key, None)
+
+    @classmethod
+    def revalidate_local(cls):
+        """Drop local cache if version stamp changed. Stamp is checked at most once per LOCAL_TTL"""
+        state = cls._local_state
+        now = time.time()
+        if now - state['checked'] < cls.LOCAL_TTL:
+            return
+
+        version = memcache.get(cls.VERSION_KEY)
+        if version is None:     # Evicted, start new random version, so it can't match any earlier one
+            memcache.add(cls.VERSION_KEY, random.getrandbits(31))
+            version = memcache.get(cls.VERSION_KEY)
+        if version is None or version != state['version']:
+            cls._local.clear()
+        state['version'] = version
+        state['checked'] = now
@@ -1,15 +1,28 @@
 import datetime
+import functools
 import os
 import logging
+import threading
+import time
 from contextlib import contextmanager
 
+from google.appengine.api import memcache
 from google.appengine.api.runtime import runtime
 
-import staticstorage
+
+SPAN_STAGES = ('request', 'webclient', 'parse', 'datastore', 'render', 'storage')
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)     # Bucket upper bounds, ms
+FLUSH_INTERVAL = 10         # Seconds between flushes of accumulated span stats to memcache
+SPAN_STATS_PREFIX = 'span.'
+
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = [time.time()]
 
 
 def debug_dump(filename, content, storage=None):
     """Create debug dump file with specified name and content"""
+    import staticstorage
     ts = datetime.datetime.utcnow().strftime('%d-%m-%Y_%H-%M-%S')
     path, suffix = os.path.splitext(filename)
     filename = "{}_{}{}".format(path, ts, suffix)
@@ -17,7 +30,7 @@ def debug_dump(filename, content, storage=None):
     if type(content) is unicode:
         content = content.encode('utf-8')
 
-    store = storage or staticstorage.GCSStorage()
+    store = storage or staticstorage.get_storage()
     store.put(filename, content)
 
 
@@ -34,3 +47,136 @@ def trace():
         a1m = mem_usage.average1m()
         a10m = mem_usage.average10m()
         logging.debug(' --- MEMTRACE: CURRENT={} DELTA={}M AVG: {}/{} ---'.format(after, after - before, a1m, a10m))
+
+
+class Span(object):
+    """Timed section of code. Set nbytes to record amount of data processed"""
+    __slots__ = ('stage', 'nbytes')
+
+    def __init__(self, stage, nbytes=0):
+        self.stage = stage
+        self.nbytes = nbytes
+
+
+@contextmanager
+def span(stage, nbytes=0):
+    """Measure wall time and bytes of code block and add them to stage stats"""
+    s = Span(stage, nbytes)
+    started = time.time()
+
+    try:
+        yield s
+    finally:
+        record_span(stage, (time.time() - started) * 1000, s.nbytes)
+
+
+@contextmanager
+def request_span():
+    """Measure wall time and memory delta of request or task as 'request' stage, then flush span stats
+
+    Memory is measured once per request, because runtime.memory_usage is an API call"""
+    mem_before = _memory_usage()
+    started = time.time()
+
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.time() - started) * 1000
+        mem_after = _memory_usage() if mem_before is not None else None
+        mem_delta = mem_after - mem_before if mem_after is not None else None
+        record_span('request', elapsed_ms, mem_delta=mem_delta)
+        flush_spans()
+
+
+def traced(stage):
+    """Decorator wrapping every function call in span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _memory_usage():
+    """Returns current instance memory usage in megabytes or None if not available"""
+    try:
+        return runtime.memory_usage().current()
+    except Exception:       # No runtime service outside of App Engine
+        return None
+
+
+def histogram_bucket(ms):
+    """Returns histogram bucket index for duration in milliseconds"""
+    for i, bound in enumerate(HISTOGRAM_BOUNDS):
+        if ms <= bound:
+            return i
+    return len(HISTOGRAM_BOUNDS)
+
+
+def record_span(stage, elapsed_ms, nbytes=0, mem_delta=None):
+    """Add span measurements to pending stats, flush them to memcache if it's time"""
+    prefix = SPAN_STATS_PREFIX + stage
+    deltas = [
+        (prefix + '.count', 1),
+        (prefix + '.ms', int(elapsed_ms)),
+        (prefix + '.h{}'.format(histogram_bucket(elapsed_ms)), 1),
+    ]
+    if nbytes:
+        deltas.append((prefix + '.bytes', int(nbytes)))
+    if mem_delta and mem_delta > 0:
+        deltas.append((prefix + '.mem_kb', int(mem_delta * 1024)))
+
+    with _pending_lock:
+        for key, delta in deltas:
+            _pending[key] = _pending.get(key, 0) + delta
+
+    if time.time() - _last_flush[0] > FLUSH_INTERVAL:
+        flush_spans()
+
+
+def flush_spans():
+    """Send pending span stats to memcache in one batch"""
+    global _pending
+    with _pending_lock:
+        pending, _pending = _pending, {}
+        _last_flush[0] = time.time()
+
+    if pending:
+        memcache.offset_multi(pending, initial_value=0)
+
+
+def span_stats(stages=SPAN_STAGES):
+    """Returns dict of aggregated stats for stages, read from memcache"""
+    fields = ['count', 'ms', 'bytes', 'mem_kb'] + ['h{}'.format(i) for i in range(len(HISTOGRAM_BOUNDS) + 1)]
+    keys = ['{}{}.{}'.format(SPAN_STATS_PREFIX, stage, f) for stage in stages for f in fields]
+    values = memcache.get_multi(keys)
+    rv = {}
+
+    for stage in stages:
+        prefix = SPAN_STATS_PREFIX + stage + '.'
+        stats = dict((f, int(values.get(prefix + f, 0))) for f in fields)
+        histogram = [stats.pop('h{}'.format(i)) for i in range(len(HISTOGRAM_BOUNDS) + 1)]
+        stats['histogram'] = histogram
+        stats['p50'] = histogram_percentile(histogram, 0.5)
+        stats['p95'] = histogram_percentile(histogram, 0.95)
+        rv[stage] = stats
+
+    return rv
+
+
+def histogram_percentile(histogram, fraction):
+    """Returns upper bound (ms) of the bucket holding given percentile, None for empty histogram
+
+    Percentiles in overflow bucket are reported as the largest bound"""
+    total = sum(histogram)
+    if not total:
+        return None
+
+    threshold = total * fraction
+    running = 0
+    for i, count in enumerate(histogram):
+        running += count
+        if running >= threshold:
+            return HISTOGRAM_BOUNDS[min(i, len(HISTOGRAM_BOUNDS) - 1)]
@@ -0,0 +1,311 @@
+# coding: utf-8
+"""Local stand-in for tracker, serves generated windows-1251 pages for load testing the crawler
+
+Emulates login.php, tracker.php (with pagination and forum filter) and viewtopic.php. New torrents arrive
+at configured rate, latency, server errors, session expiry and huge threads can be injected."""
+import BaseHTTPServer
+import Cookie
+import hashlib
+import optparse
+import random
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+from xml.sax.saxutils import escape
+
+import webclient
+
+
+USAGE = """%prog [options]
+Run fake tracker HTTP server. Point pipeline at it with --tracker-url."""
+
+ENCODING = 'windows-1251'
+BASE_TID = 5000000
+SESSION_COOKIE = 'bb_session'
+HUGE_THREAD_BYTES = 4 * 1024 * 1024
+WORDS = [u'Фильм', u'Сериал', u'Сезон', u'Альбом', u'Книга', u'Игра', u'Ночь', u'Город', u'Тайна', u'Дорога',
+         u'Война', u'Love', u'Dark', u'Star', u'Live', u'Collection', u'Remastered', u'Ёлка', u'Зима', u'Море']
+RELEASES = [u'DVDRip', u'HDRip', u'BDRip 1080p', u'WEB-DL 720p', u'FLAC', u'MP3', u'PDF', u'RePack']
+
+
+class Config(object):
+    """Fake tracker behaviour"""
+
+    def __init__(self, rate=60.0, backlog=200, forums=50, page_size=50, latency=0.0, error_rate=0.0,
+                 session_ttl=0, huge_rate=0.0, userid=1, seed=1):
+        self.rate = rate                    # New torrents per minute
+        self.backlog = backlog              # Torrents present at start
+        self.forums = forums
+        self.page_size = page_size          # Rows per tracker.php page
+        self.latency = latency              # Mean response delay, seconds, exponentially distributed
+        self.error_rate = error_rate        # Fraction of requests answered with 503
+        self.session_ttl = session_ttl      # Seconds until session cookie expires, 0 for never
+        self.huge_rate = huge_rate          # Fraction of topics with multi-megabyte threads
+        self.userid = userid
+        self.seed = seed
+
+
+class FakeTracker(object):
+    """Generates torrents and pages. Torrent attributes are derived from torrent id, so they are stable"""
+
+    def __init__(self, config, now=time.time):
+        self.config = config
+        self.now = now
+        self.started = now()
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def num_torrents(self):
+        """Returns number of torrents that have arrived so far"""
+        return self.config.backlog + int((self.now() - self.started) * self.config.rate / 60)
+
+    def arrival_time(self, i):
+        return int(self.started + (i - self.config.backlog) * 60.0 / self.config.rate) if self.config.rate else \
+            int(self.started)
+
+    def torrent(self, tid):
+        """Returns dict with torrent attributes or None if torrent doesn't exist (yet)"""
+        i = tid - BASE_TID
+        if i < 0 or i >= self.num_torrents():
+            return None
+
+        rnd = random.Random('{}-{}'.format(self.config.seed, tid))
+        title = u' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 6)))
+        return {
+            'id': tid,
+            'title': u'{} ({}) {}'.format(title, rnd.randint(1950, 2016), rnd.choice(RELEASES)),
+            'forum_id': self.forum_ids()[rnd.randrange(len(self.forum_ids()))],
+            'nbytes': rnd.randint(10 ** 6, 5 * 10 ** 10),
+            'btih': hashlib.sha1(str(tid)).hexdigest().upper(),
+            'dt': self.arrival_time(i),
+            'huge': rnd.random() < self.config.huge_rate,
+        }
+
+    def forum_ids(self):
+        return range(100, 100 + self.config.forums)
+
+    def category_id(self, forum_id):
+        """Forums are grouped into categories of ten"""
+        return (forum_id - 100) // 10 + 1
+
+    def latest(self, forum_id=None, start=0):
+        """Returns page of newest torrents, optionally only ones in forum"""
+        rv = []
+        skipped = 0
+        for i in xrange(self.num_torrents() - 1, -1, -1):
+            torrent = self.torrent(BASE_TID + i)
+            if forum_id is not None and torrent['forum_id'] != forum_id:
+                continue
+            if skipped < start:
+                skipped += 1
+                continue
+            rv.append(torrent)
+            if len(rv) >= self.config.page_size:
+                break
+        return rv
+
+    def login(self):
+        """Starts new session, returns session token"""
+        token = hashlib.sha1('{}-{}'.format(self.now(), random.random())).hexdigest()
+        with self.lock:
+            self.sessions[token] = self.now()
+        return token
+
+    def is_valid_session(self, token):
+        with self.lock:
+            created = self.sessions.get(token)
+        if created is None:
+            return False
+        return not self.config.session_ttl or self.now() - created < self.config.session_ttl
+
+    # Pages, as unicode
+
+    def page(self, body, logged_in):
+        marker = webclient.RutrackerWebClient.USER_MARKER.format(self.config.userid) if logged_in else u''
+        return (u'<!DOCTYPE html><html><head><meta charset="windows-1251"><title>Fake tracker</title></head>'
+                u'<body><div id="page_header">{}{}</a></div>{}</body></html>').format(
+            marker, u'user' if logged_in else u'', body)
+
+    def index_page(self, torrents, logged_in):
+        rows = []
+        for t in torrents:
+            rows.append(
+                u'<tr class="tCenter hl-tr"><td class="f-name"><a class="gen f" href="tracker.php?f={forum_id}">'
+                u'Forum {forum_id}</a></td><td class="t-title"><div class="t-title">'
+                u'<a data-topic_id="{id}" href="viewtopic.php?t={id}">{title}</a></div></td>'
+                u'<td class="tor-size"><u>{nbytes}</u></td><td><u>{dt}</u></td></tr>'.format(
+                    forum_id=t['forum_id'], id=t['id'], title=escape(t['title']), nbytes=t['nbytes'], dt=t['dt']))
+        return self.page(u'<table id="tor-tbl">{}</table>'.format(u''.join(rows)), logged_in)
+
+    def topic_parts(self, torrent, logged_in):
+        """Yields topic page in parts, so huge threads are streamed"""
+        if torrent is None:
+            yield self.page(u'<table class="message"><tr><td><div class="mrg_16">Тема не найдена</div></td></tr>'
+                            u'</table>', logged_in)
+            return
+
+        cat_id = self.category_id(torrent['forum_id'])
+        breadcrumbs = (u'<td class="nav w100 pad_2 brand-bg-white"><span><a href="index.php">Трекер</a></span>'
+                       u'<span><a href="index.php?c={c}">Категория {c}</a></span>'
+                       u'<span><a href="viewforum.php?f={f}">Форум {f}</a></span></td>').format(
+            c=cat_id, f=torrent['forum_id'])
+        first_post = (u'<tbody id="post_{tid}"><tr><td><div class="post_body">'
+                      u'<span class="post-b">{title}</span><br/>Описание раздачи {tid}. '
+                      u'<div class="sp-wrap"><div class="sp-body" title="Подробнее">Скриншоты и прочее</div></div>'
+                      u'<table id="tor-reged"><tr><td><span id="tor-status-resp"><a href="#"><b>проверено</b></a>'
+                      u'</span></td></tr></table>'
+                      u'<a class="med magnet-link-16" href="magnet:?xt=urn:btih:{btih}&amp;tr=http%3A%2F%2Fbt">'
+                      u'magnet</a></div></td></tr></tbody>').format(
+            tid=torrent['id'], title=escape(torrent['title']), btih=torrent['btih'])
+
+        head, tail = self.page(u'\0', logged_in).split(u'\0')
+        yield head + u'<table>' + breadcrumbs + u'</table><table id="topic_main">' + first_post
+
+        if torrent['huge']:
+            reply = u'<tbody id="post_{}"><tr><td><div class="post_body">{}</div></td></tr></tbody>'
+            text = u'Спасибо за раздачу! ' * 200
+            for n in xrange(HUGE_THREAD_BYTES // len(text)):
+                yield reply.format(n, text)
+
+        yield u'</table><!--/topic_main-->' + tail
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Routes requests to fake tracker pages"""
+    protocol_version = 'HTTP/1.0'
+
+    @property
+    def tracker(self):
+        return self.server.tracker
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length') or 0)
+        self.handle_request(urlparse.parse_qs(self.rfile.read(length)))
+
+    def handle_request(self, form):
+        config = self.tracker.config
+        if config.latency:
+            time.sleep(random.expovariate(1.0 / config.latency))
+        if config.error_rate and random.random() < config.error_rate:
+            return self.send_page([u'<html><body>Service unavailable</body></html>'], 503)
+
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        params.update(form)
+        logged_in = self.tracker.is_valid_session(self.session_token())
+
+        if url.path.endswith('/login.php'):
+            token = self.tracker.login()
+            self.send_page([self.tracker.page(u'', True)], cookies={SESSION_COOKIE: token})
+        elif url.path.endswith('/tracker.php'):
+            forum_id = int(first(params, 'f', 'f[]') or -1)
+            start = int(first(params, 'start') or 0)
+            torrents = self.tracker.latest(forum_id if forum_id >= 0 else None, start) if logged_in else []
+            self.send_page([self.tracker.index_page(torrents, logged_in)])
+        elif url.path.endswith('/viewtopic.php'):
+            torrent = self.tracker.torrent(int(first(params, 't') or 0)) if logged_in else None
+            self.send_page(self.tracker.topic_parts(torrent, logged_in))
+        else:
+            self.send_page([u'<html><body>Not found</body></html>'], 404)
+
+    def session_token(self):
+        cookies = Cookie.SimpleCookie(self.headers.get('cookie', ''))
+        morsel = cookies.get(SESSION_COOKIE)
+        return morsel and morsel.value
+
+    def send_page(self, parts, status=200, cookies=None):
+        """Send page parts encoded as windows-1251. Client may close connection early, that's fine"""
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/html; charset=windows-1251')
+            for name, value in (cookies or {}).items():
+                self.send_header('Set-Cookie', '{}={}; path=/'.format(name, value))
+            self.end_headers()
+            for part in parts:
+                self.wfile.write(part.encode(ENCODING, 'xmlcharrefreplace'))
+        except socket.error:
+            pass
+
+
+def first(params, *names):
+    for name in names:
+        if params.get(name):
+            return params[name][0]
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, tracker):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.tracker = tracker
+
+    def handle_error(self, request, client_address):
+        """Clients stop reading huge threads early, so broken connections are expected"""
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+
+def start_server(config, host='127.0.0.1', port=0):
+    """Start fake tracker in background thread, returns server. Use port 0 to pick free port"""
+    server = Server((host, port), FakeTracker(config))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def use_tracker(base_url):
+    """Point RutrackerWebClient to tracker at base_url"""
+    cls = webclient.RutrackerWebClient
+    cls.TORRENT_PAGE_URL = base_url + 'forum/viewtopic.php?t={}'
+    cls.LOGIN_URL = base_url + 'forum/login.php'
+    cls.INDEX_URL = base_url + 'forum/tracker.php'
+
+
+def main(options):
+    config = Config(rate=options.rate, backlog=options.backlog, forums=options.forums, page_size=options.page_size,
+                    latency=options.latency, error_rate=options.error_rate, session_ttl=options.session_ttl,
+                    huge_rate=options.huge_rate, userid=options.userid, seed=options.seed)
+    server = Server((options.host, options.port), FakeTracker(config))
+    print 'Fake tracker serving at {}'.format(server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8800)
+    parser.add_option('--rate', type='float', default=60.0, help='new torrents per minute [default: %default]')
+    parser.add_option('--backlog', type='int', default=200, help='torrents present at start [default: %default]')
+    parser.add_option('--forums', type='int', default=50)
+    parser.add_option('--page-size', type='int', default=50, help='tracker.php rows per page [default: %default]')
+    parser.add_option('--latency', type='float', default=0.0, help='mean response delay, seconds')
+    parser.add_option('--error-rate', type='float', default=0.0, help='fraction of requests failing with 503')
+    parser.add_option('--session-ttl', type='int', default=0, help='session lifetime, seconds, 0 for unlimited')
+    parser.add_option('--huge-rate', type='float', default=0.0, help='fraction of topics with huge threads')
+    parser.add_option('--userid', type='int', default=1, help='user id of every logged in user')
+    parser.add_option('--seed', type='int', default=1)
+    options, args = parser.parse_args()
+    if args:
+        parser.print_help()
+        sys.exit(1)
+    main(options)
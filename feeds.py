@@ -1,28 +1,174 @@
 """(Re)builds feeds for categories"""
+import collections
+import hashlib
+import heapq
+import json
 import os
 import datetime
 import jinja2
 from google.appengine.api import app_identity
+from google.appengine.api import memcache
 
 import dao
+import debug
+import search
 import util
 
 
-def build_and_save_for_category(cat, store, prefix):
-    """Build and save feeds for category"""
-    feed = build_feed(cat)
-    save_feeds(store, feed, prefix, cat.key.id())
+SNAPSHOT_SIZE = 100             # Newest items kept per category for composite feeds
+COMPOSITE_FEED_SIZE = 100
+COMPOSITE_CACHE_TIME = 300      # Seconds, bounds staleness while feed build tasks of a rebuild are running
 
+MAGNET_URI = 'magnet:?xt=urn:btih:{}&tr=http%3A%2F%2Fbt.rutracker.cc%2Fann%3Fmagnet'
+JSON_FEED_VERSION = 'https://jsonfeed.org/version/1.1'
 
-def build_feed(cat):
-    """Build feed for category"""
+FeedItem = collections.namedtuple('FeedItem', 'tid title btih dt nbytes forum_id')
+ItemView = collections.namedtuple('ItemView', 'tid btih title magnet title_xml magnet_xml published updated')
+
+_jinja_env = None
+
+
+class FeedBuilder(object):
+    """Builds and saves category feeds and snapshots, categories are expected children first
+
+    Only feeds of categories without subcategories are loaded from datastore. Parent feeds are merged from
+    snapshots of their children, which hold at least as many newest items as parent feeds need.
+    Subcategories without snapshot (see missing_children) have to be built before their parent"""
+
+    def __init__(self, categories, store, prefix):
+        self.categories = dict((cat.key.id(), cat) for cat in categories)
+        self.children = {}
+        for cat in categories:
+            if cat.key.parent():
+                self.children.setdefault(cat.key.parent().id(), []).append(cat.key.id())
+        self.store = store
+        self.prefix = prefix
+        self.snapshots = {}         # Category id -> snapshot rows, built or loaded during this pass
+
+    def build(self, cat_id):
+        """Build and save feeds and snapshot for category. Returns feed
+
+        Raises ValueError if some of subcategories have no snapshot"""
+        cat = self.categories[cat_id]
+        rows = self.newest_rows(cat)
+        dao.save_feed_snapshot(cat_id, cat.title, rows)
+        self.snapshots[cat_id] = rows
+        feed = build_feed(cat, [item_from_row(row) for row in rows])
+        save_feeds(self.store, feed, self.prefix, cat_id)
+        return feed
+
+    def newest_rows(self, cat):
+        """Returns snapshot rows of newest torrents in category and its subcategories"""
+        limit = window_size(cat.key)
+        child_ids = self.children.get(cat.key.id())
+        if not child_ids:
+            return [snapshot_row(t) for t in dao.latest_torrents(limit, cat.key)]
+
+        missing = self.missing_children(cat.key.id())
+        if missing:
+            raise ValueError('Subcategories {} of {} have no feed snapshot'.format(missing, cat.key.id()))
+        row_lists = [self.snapshots[cid] for cid in child_ids]
+        if cat.key.id().startswith('f'):    # Forum with subforums, has torrents of its own
+            row_lists.append([snapshot_row(t) for t in dao.latest_forum_torrents(limit, cat.key)])
+        return merge_newest_rows(row_lists, limit)
+
+    def missing_children(self, cat_id):
+        """Returns ids of subcategories which have no snapshot yet. Snapshots of the others are loaded"""
+        to_load = [cid for cid in self.children.get(cat_id, ()) if cid not in self.snapshots]
+        if not to_load:
+            return []
+        missing = []
+        for cid, snapshot in zip(to_load, dao.get_feed_snapshots(to_load)):
+            if snapshot:
+                self.snapshots[cid] = snapshot.items
+            else:
+                missing.append(cid)
+        return missing
+
+
+def build_feed(cat, items):
+    """Build feed for category from feed items, newest first"""
     feed = Feed(title=cat.title, link=get_app_url())
-    items = dao.latest_torrents(feed_size(cat), cat.key)
-    for item in items:
+    for item in items[:feed_size(cat.key)]:
         feed.add_item(item)
     return feed
 
 
+def snapshot_row(torrent):
+    """Returns JSON-serializable row for torrent in feed snapshot"""
+    return [torrent.key.id(), torrent.title, torrent.btih, util.datetime_to_timestamp(torrent.dt), torrent.nbytes,
+            torrent.forum_id]
+
+
+def item_from_row(row):
+    tid, title, btih, ts, nbytes, forum_id = row
+    return FeedItem(tid, title, btih, datetime.datetime.utcfromtimestamp(ts), nbytes, forum_id)
+
+
+def merge_newest(row_lists, limit, keywords=()):
+    """K-way merge of snapshot rows lists, each sorted newest first. Returns up to limit newest feed items
+
+    Torrents present in several lists (category and its parent) are returned once.
+    If keywords are given, only items with all of them in title are returned"""
+    return [item_from_row(row) for row in merge_newest_rows(row_lists, limit, keywords)]
+
+
+def merge_newest_rows(row_lists, limit, keywords=()):
+    """Same as merge_newest, but returns snapshot rows"""
+    tokens = set(search.tokenize(u' '.join(keywords)))
+    streams = [((-row[3], row[0], row) for row in rows) for rows in row_lists]
+    seen = set()
+    rv = []
+
+    for _, tid, row in heapq.merge(*streams):
+        if tid in seen:
+            continue
+        seen.add(tid)
+        if tokens and not tokens.issubset(search.tokenize(row[1])):
+            continue
+        rv.append(row)
+        if len(rv) >= limit:
+            break
+
+    return rv
+
+
+def category_feed(cat_id):
+    """Returns feed for category built from its snapshot, None if category has no feed yet"""
+    snapshot = dao.get_feed_snapshots([cat_id])[0]
+    if snapshot is None:
+        return None
+
+    feed = Feed(title=snapshot.title, link=get_app_url())
+    for row in snapshot.items[:feed_size(snapshot.key)]:
+        feed.add_item(item_from_row(row))
+    return feed
+
+
+def composite_feed(cat_ids, keywords=()):
+    """Returns feed merged from snapshots of multiple categories, filtered by title keywords
+
+    Feeds are cached per feed rebuild, so each combination is merged once per rebuild"""
+    cat_ids = sorted(set(cat_ids))
+    tokens = sorted(set(search.tokenize(u' '.join(keywords))))
+    generation = int(util.datetime_to_timestamp(dao.get_last_feed_rebuild_dt()))
+    digest = hashlib.sha1(json.dumps([cat_ids, tokens])).hexdigest()
+    cache_key = 'composite.{}.{}'.format(generation, digest)
+
+    feed = memcache.get(cache_key)
+    if feed is None:
+        snapshots = [s for s in dao.get_feed_snapshots(cat_ids) if s]
+        title = u' + '.join(s.title for s in snapshots)
+        if tokens:
+            title = u'{}: {}'.format(title, u' '.join(tokens))
+        feed = Feed(title=title, link=get_app_url())
+        for item in merge_newest([s.items for s in snapshots], COMPOSITE_FEED_SIZE, tokens):
+            feed.add_item(item)
+        memcache.set(cache_key, feed, time=COMPOSITE_CACHE_TIME)
+
+    return feed
+
+
 def get_app_url():
     """Returns full URL for app engine app"""
     app_id = app_identity.get_application_id()
@@ -30,10 +176,21 @@ def get_app_url():
 
 
 def save_feeds(store, feed, prefix, name):
-    """Saves feeds to storage"""
-    xml = feed.render_short_rss()
-    path = os.path.join(prefix, 'short', '{}.xml'.format(name))
-    store.put(path, xml.encode('utf-8'), 'application/rss+xml')
+    """Saves feed in all formats to storage, in one batch"""
+    atom_path = os.path.join(prefix, 'atom', '{}.xml'.format(name))
+    rss, atom, json_feed = feed.render_all(store.url_for_path(atom_path))
+    store.put_multi([
+        (os.path.join(prefix, 'short', '{}.xml'.format(name)), rss.encode('utf-8'), 'application/rss+xml'),
+        (atom_path, atom.encode('utf-8'), 'application/atom+xml'),
+        (os.path.join(prefix, 'json', '{}.json'.format(name)), json_feed, 'application/feed+json'),
+    ])
+
+
+def item_view(item):
+    """Returns fields of feed item shared by all output formats, serialized and escaped"""
+    magnet = MAGNET_URI.format(item.btih)
+    return ItemView(item.tid, item.btih, item.title, magnet, jinja2.escape(item.title), jinja2.escape(magnet),
+                    util.datetime_to_rfc822(item.dt), util.datetime_to_rfc3339(item.dt))
 
 
 class Feed(object):
@@ -53,11 +210,77 @@ class Feed(object):
         if self.latest_item_dt < item.dt:
             self.latest_item_dt = item.dt
 
-    def render_short_rss(self):
+    def filter_since(self, dt):
+        """Drop items not newer than dt. Latest item time is kept, it's still the time feed was modified"""
+        self.items = [item for item in self.items if item.dt > dt]
+
+    def etag(self):
+        """Returns strong ETag for feed of FeedItems, changes whenever rendered feed would change"""
+        digest = hashlib.sha1(self.title.encode('utf-8'))
+        digest.update(str(util.datetime_to_timestamp(self.latest_item_dt)))
+        for item in self.items:
+            digest.update('{}:{}:{};'.format(item.tid, item.btih, util.datetime_to_timestamp(item.dt)))
+        return '"{}"'.format(digest.hexdigest())
+
+    def item_views(self):
+        return [item_view(item) for item in self.items]
+
+    def render_short_rss(self, views=None):
+        self.lastBuildDate = self.latest_item_dt
+        with debug.span('render') as s:
+            rv = self._render_template('rss_short.xml', views)
+            s.nbytes = len(rv)
+        return rv
+
+    def render_json(self, views=None):
+        """Returns feed in JSON Feed format, as utf-8 encoded string"""
+        items = [{
+            'id': v.btih,
+            'url': v.magnet,
+            'title': v.title,
+            'content_text': v.title,
+            'date_published': v.updated,
+        } for v in (self.item_views() if views is None else views)]
+        rv = {
+            'version': JSON_FEED_VERSION,
+            'title': self.title,
+            'description': self.description,
+            'home_page_url': self.link,
+            'icon': self.link + 'static/rutracker-rss-icon.png',
+            'items': items,
+        }
+        return json.dumps(rv, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def render_all(self, atom_url):
+        """Returns tuple (RSS, Atom, JSON Feed) of feed renderings, items are serialized once for all of them
+
+        Atom feed is identified by atom_url, the URL it is published at"""
         self.lastBuildDate = self.latest_item_dt
-        env = make_jinja_env()
-        template = env.get_template('rss_short.xml')
-        return template.render(feed=self)
+        with debug.span('render') as s:
+            views = self.item_views()
+            rv = (self._render_template('rss_short.xml', views),
+                  self._render_template('atom_short.xml', views, atom_url=atom_url),
+                  self.render_json(views))
+            s.nbytes = sum(len(r) for r in rv)
+        return rv
+
+    def _render_template(self, name, views, **context):
+        template = get_jinja_env().get_template(name)
+        return template.render(feed=self, items=self.item_views() if views is None else views, **context)
+
+
+def get_jinja_env():
+    """Returns shared jinja environment. Environment caches compiled templates and is safe to share"""
+    global _jinja_env
+    if _jinja_env is None:
+        _jinja_env = make_jinja_env()
+    return _jinja_env
+
+
+def warm_up():
+    """Create jinja environment and compile feed templates"""
+    get_jinja_env().get_template('rss_short.xml')
+    get_jinja_env().get_template('atom_short.xml')
 
 
 def make_jinja_env():
@@ -68,13 +291,19 @@ def make_jinja_env():
         extensions=['jinja2.ext.autoescape']
     )
     jinja2_env.filters['rfc822date'] = util.datetime_to_rfc822
+    jinja2_env.filters['rfc3339date'] = util.datetime_to_rfc3339
     return jinja2_env
 
 
-def feed_size(category):
-    """Returns number of feed entries for category"""
-    if category.key.id() == 'r0':               # Root category
+def feed_size(cat_key):
+    """Returns number of feed entries for category with key"""
+    if cat_key.id() == 'r0':                    # Root category
         return 100
-    elif category.key.id().startswith('c'):     # Level 2 category
+    elif cat_key.id().startswith('c'):          # Level 2 category
         return 50
     return 25                                   # category with subcategories
+
+
+def window_size(cat_key):
+    """Returns number of newest torrents in category which its feed or snapshot may refer to"""
+    return max(SNAPSHOT_SIZE, feed_size(cat_key))
@@ -2,15 +2,32 @@
 import datetime
 import json
 import logging
+import time
+from contextlib import contextmanager
 
 import dao
+import debug
 import feeds
 import staticstorage
+import stats
 import webclient
 import parsing
+import search
 import taskmaster
 
 
+FEED_BUILD_TIME_BUDGET = 300    # Seconds per feed build task, remaining feeds are built by next task
+MAP_REBUILD_TIMEOUT = datetime.timedelta(minutes=30)    # Map rebuild not done in this time is requested again
+_parser_factory = parsing.Parser
+
+
+def set_parser_factory(factory):
+    """Make torrent import tasks get page parser from factory. Returns previous factory"""
+    global _parser_factory
+    previous, _parser_factory = _parser_factory, factory
+    return previous
+
+
 def import_index():
     """Add tasks for new torrents"""
     num_new_torrents = add_new_torrents()
@@ -22,44 +39,104 @@ def import_index():
 
 
 def add_new_torrents():
-    """Enqueues tasks for all new torrents"""
+    """Enqueues tasks for all new and changed torrents, returns number of new and updated torrents"""
     wc = webclient.RutrackerWebClient()
     p = parsing.Parser()
     try:
-        new_entries = get_new_torrents(wc, p)
+        new_entries, num_bumped = get_new_torrents(wc, p)
 
     except webclient.NotLoggedIn:   # Session expired
         logging.debug('Session expired')
     except webclient.RequestError:  # Tracker is down, happens sometimes
         logging.debug('Tracker seems to be down')
     else:
+        route_entries(new_entries)
         taskmaster.add_torrent_tasks(new_entries)
-        return len(new_entries)
+        logging.debug('%d torrent tasks added, %d torrents updated in place', len(new_entries), num_bumped)
+        return len(new_entries) + num_bumped
 
 
 def import_torrent(payload):
     """Run torrent import task for torrent, specified by torrent_data"""
     torrent_dict = taskmaster.unpack_payload(payload)
     tid = torrent_dict['id']
+    previous_key = torrent_dict.pop('previous_key', None)
+    torrent_dict.pop('previous_nbytes', None)       # Set by older versions, previous torrent is read when counted
+    cat_key = torrent_dict.pop('cat_key', None)
 
     wc = webclient.RutrackerWebClient()
-    with dao.account_context() as account:
-        html = wc.get_torrent_page(account, tid)
-    p = parsing.Parser()
     try:
-        torrent_data, category_tuples = p.parse_torrent_page(html)
+        with dao.account_context() as account, tracker_request() as s:
+            html = wc.get_torrent_page(account, tid)
+            s.nbytes = len(html or '')
+    except webclient.CircuitOpen as e:     # Tracker is down, retrying now would only use up task retries
+        logging.info('Deferring torrent %d by %ds: %s', tid, e.retry_after, str(e))
+        taskmaster.add_deferred_torrent_task(payload, e.retry_after)
+        return
+    if wc.bytes_skipped:
+        stats.incr('tracker_bytes_skipped', wc.bytes_skipped)
+    p = _parser_factory()
+    try:
+        with debug.span('parse', len(html or '')):
+            torrent_data, category_tuples = p.parse_torrent_page(html, with_categories=cat_key is None)
     except parsing.SkipTorrent as e:
         logging.info('Skipping torrent %d: %s', tid, str(e))
         return
 
     torrent_dict.update(torrent_data)
-    to_write = process_categories(category_tuples)
+    description = torrent_dict.pop('description')
+    description_size = torrent_dict.pop('description_size')
+    to_write = []
+    if cat_key is None:         # Forum is not indexed yet, category comes from breadcrumbs
+        to_write = process_categories(category_tuples)
+        cat_key = dao.category_key_from_tuples(category_tuples)
+        if cat_key.id() == 'f{}'.format(torrent_dict['forum_id']):
+            to_write.append(dao.make_forum_category(torrent_dict['forum_id'], cat_key))
 
-    cat_key = dao.category_key_from_tuples(category_tuples)
     torrent = dao.make_torrent(cat_key, torrent_dict)
-    to_write.append(torrent)
+    desc = dao.make_torrent_description(torrent.key, description, description_size)
+    logging.debug('Torrent %d description: %d bytes on page, %d sanitized, %d stored (%d saved)', tid,
+                  description_size, len(description), len(desc.data), description_size - len(desc.data))
+
+    if to_write:
+        dao.write_multi(to_write)
+    dao.add_to_search_index(tid, search.document_tokens(torrent.title, [cid for _, cid in cat_key.pairs()]))
+    dao.count_torrent(torrent, desc, previous_key)
+    stats.incr('torrents_imported')
+
+
+def route_entries(entries):
+    """Set full category key for entries from known forums and order entries by forum, in place
 
-    dao.write_multi(to_write)
+    Tasks for torrents of known forums don't parse breadcrumbs or look up categories"""
+    forum_ids = sorted(set(e['forum_id'] for e in entries))
+    forum_cat_keys = dict(zip(forum_ids, dao.get_forum_category_keys(forum_ids)))
+
+    for entry in entries:
+        cat_key = forum_cat_keys[entry['forum_id']]
+        if cat_key:
+            entry['cat_key'] = cat_key
+    entries.sort(key=lambda e: e['forum_id'])
+
+
+@contextmanager
+def tracker_request():
+    """Wraps tracker requests in span and counts requests, errors and timeouts. Yields span"""
+    counters = {'tracker_requests': 1}
+    try:
+        with debug.span('webclient') as s:
+            yield s
+    except webclient.CircuitOpen:
+        counters = {'tracker_rejected': 1}
+        raise
+    except webclient.RequestTimeout:
+        counters['tracker_timeouts'] = 1
+        raise
+    except webclient.RequestError:
+        counters['tracker_errors'] = 1
+        raise
+    finally:
+        stats.incr_multi(counters)
 
 
 def process_categories(cat_tuples):
@@ -75,10 +152,16 @@ def process_categories(cat_tuples):
 
 
 def enqueue_map_rebuild_if_needed():
-    rebuild_flag = dao.CachedPersistentValue('map_rebuild_flag')
-    if not rebuild_flag.get():
-        rebuild_flag.put(True)
-        taskmaster.add_map_rebuild_task()
+    """Enqueue category map rebuild unless one was requested less than MAP_REBUILD_TIMEOUT ago
+
+    Flag holds time of request, so flag left by rebuild which never finished doesn't suppress rebuilds for good"""
+    rebuild_flag = dao.CachedPersistentValue('map_rebuild_flag', local=True)
+    requested = rebuild_flag.get()
+    now = datetime.datetime.utcnow()
+    if isinstance(requested, datetime.datetime) and now - requested < MAP_REBUILD_TIMEOUT:
+        return
+    rebuild_flag.put(now)
+    taskmaster.add_map_rebuild_task()
 
 
 def make_categories(cat_tuples):
@@ -103,20 +186,35 @@ def make_categories(cat_tuples):
 def rebuild_category_map():
     """Rebuilds category map file"""
     all_cats = dao.get_all_categories()
-    tree = build_category_tree(all_cats)
+    index_forums(all_cats)
+    counters = dao.get_category_counters([cat.key.id() for cat in all_cats])
+    tree = build_category_tree(all_cats, counters)
     map_json = json.dumps([tree], separators=(',', ':'), ensure_ascii=False)
-    storage = staticstorage.GCSStorage()
+    storage = staticstorage.get_storage()
     storage.put('category_map.json', map_json.encode('utf-8'), 'application/json')
-    rebuild_flag = dao.CachedPersistentValue('map_rebuild_flag')
-    rebuild_flag.put(False)
+    rebuild_flag = dao.CachedPersistentValue('map_rebuild_flag', local=True)
+    rebuild_flag.put(None)
+
+
+def index_forums(cat_list):
+    """Add forum categories missing from forum index"""
+    forum_cats = dict((int(cat.key.id()[1:]), cat.key) for cat in cat_list if cat.key.id().startswith('f'))
+    forum_ids = forum_cats.keys()
+    known = dao.get_forum_category_keys(forum_ids)
+    missing = [dao.make_forum_category(fid, forum_cats[fid]) for fid, key in zip(forum_ids, known) if key is None]
+    if missing:
+        dao.write_multi(missing)
 
 
-def build_category_tree(cat_list):
+def build_category_tree(cat_list, counters=None):
+    """Returns category tree for category map, optionally with (count, nbytes) counters for categories in list"""
     cmap = {}
-    for cat in cat_list:
+    for i, cat in enumerate(cat_list):
         cat_id = cat.key.id()
         parent_id = cat.key.parent().id() if cat.key.parent() else None
         cmap[cat_id] = {'cid': cat_id, 'text': cat.title, 'parent_id': parent_id}
+        if counters:
+            cmap[cat_id]['count'], cmap[cat_id]['nbytes'] = counters[i]
 
     for cat_id, cat in cmap.items():
         parent_id = cat.pop('parent_id')
@@ -135,26 +233,47 @@ def build_category_tree(cat_list):
 
 
 def get_new_torrents(webclient, parser):
-    """Returns list of torent entries for new torrents"""
-    with dao.account_context() as account:
+    """Returns tuple (list of torrent entries to import, number of torrents updated in place)"""
+    with dao.account_context() as account, tracker_request() as s:
         index_html = webclient.get_index_page(account)
-    all_entries = parser.parse_index(index_html)
+        s.nbytes = len(index_html or '')
+    with debug.span('parse', len(index_html or '')):
+        all_entries = parser.parse_index(index_html)
     return filter_new_entries(all_entries)
 
 
 def filter_new_entries(entries):
-    """Returns only new entries from the list"""
+    """Returns tuple (entries which need import, number of torrents updated in place)
+
+    Entries for torrents which were bumped on tracker without changes only get their dt updated"""
     dt_threshold = dao.latest_torrent_dt()
-    return [e for e in entries if e['dt'] > dt_threshold]
+    recent = [e for e in entries if e['dt'] > dt_threshold]
+    fingerprints = dao.get_fingerprints([e['id'] for e in recent])
+    to_import, bumped = [], []
+
+    for entry, fp in zip(recent, fingerprints):
+        if fp is None:
+            to_import.append(entry)
+        elif (fp.title, fp.nbytes, fp.forum_id) != (entry['title'], entry['nbytes'], entry['forum_id']):
+            entry['previous_key'] = fp.torrent_key
+            to_import.append(entry)
+        else:
+            bumped.append((fp.torrent_key, entry['dt']))
+
+    dao.update_torrent_dts(bumped)
+    return to_import, len(bumped)
 
 
 def add_feed_tasks():
     """Adds tasks for rebuilding feeds"""
     last_rebuild_dt = dao.get_last_feed_rebuild_dt()
-    dao.set_last_feed_rebuild_dt(dao.latest_torrent_dt())
+    rebuild_dt = dao.latest_torrent_dt()
+    dao.set_last_feed_rebuild_dt(rebuild_dt)
     cat_keys = changed_cat_keys_since(last_rebuild_dt)
-    taskmaster.add_feed_build_tasks(cat_keys)
-    logging.debug("Added %d feed rebuild tasks", len(cat_keys))
+    if cat_keys:
+        cat_ids = [key.id() for key in sorted(cat_keys, key=lambda k: len(k.pairs()), reverse=True)]
+        taskmaster.add_feed_build_task(cat_ids, rebuild_dt, last_rebuild_dt)
+    logging.debug("Added feed rebuild task for %d categories", len(cat_keys))
     return last_rebuild_dt, len(cat_keys)
 
 
@@ -173,8 +292,71 @@ def changed_cat_keys_since(dt):
 
 
 def build_feed(payload_data):
-    """Rebuilds feed for category"""
-    category_key = taskmaster.unpack_payload(payload_data)
-    category = dao.get_from_key(category_key)
-    store = staticstorage.GCSStorage()
-    feeds.build_and_save_for_category(category, store, 'feeds')
+    """Rebuilds feeds for categories, subcategories before parents. Returns number of feeds built
+
+    Parent feeds are merged from feeds of their children, children without feed are queued before their parent.
+    Pass continues in next task when out of time"""
+    cat_ids, generation, since_dt, part = taskmaster.unpack_payload(payload_data)
+    started = time.time()
+    builder = feeds.FeedBuilder(dao.get_all_categories(), staticstorage.get_storage(), 'feeds')
+    num_built = 0
+
+    while cat_ids and time.time() - started < FEED_BUILD_TIME_BUDGET:
+        missing = builder.missing_children(cat_ids[0])
+        if missing:
+            cat_ids[:0] = missing
+            continue
+        cat_id = cat_ids.pop(0)
+        feed = builder.build(cat_id)
+        record_publication_lag(builder.categories[cat_id].key, feed.items, since_dt)
+        num_built += 1
+
+    stats.incr('feeds_built', num_built)
+    if cat_ids:
+        taskmaster.add_feed_build_task(cat_ids, generation, since_dt, part + 1)
+    return num_built
+
+
+def record_publication_lag(cat_key, items, since_dt):
+    """Record lag between tracker time and feed publication for torrents first published in forum feed
+
+    Every torrent is counted once, in feed of the forum it belongs to"""
+    if not cat_key.id().startswith('f'):
+        return
+
+    forum_id = int(cat_key.id()[1:])
+    now = datetime.datetime.utcnow()
+    lags = [(now - item.dt).total_seconds() for item in items if item.dt > since_dt and item.forum_id == forum_id]
+    stats.record_lags('publication', lags)
+
+
+def recount_categories(payload=None):
+    """Rebuilds category counters from stored torrents, one page per task
+
+    First task resets counters. Torrents updated after it are counted by their import tasks, so pages stop there.
+    Counted torrents are marked with reset time, so retried pages don't count them twice"""
+    if payload:
+        cursor, cutoff_dt = taskmaster.unpack_payload(payload)
+    else:
+        cursor, cutoff_dt = None, dao.reset_category_counters()
+
+    torrents, cursor, more = dao.torrents_page(cutoff_dt, cursor)
+    num_counted = dao.count_stored_torrents([t.key for t in torrents], cutoff_dt)
+    logging.info('Counted %d torrents', num_counted)
+
+    if more and cursor:
+        taskmaster.add_recount_task(cursor, cutoff_dt)
+
+    return num_counted
+
+
+def migrate_descriptions(payload=None):
+    """Moves inline torrent descriptions to separate entities, one page per task"""
+    cursor = taskmaster.unpack_payload(payload) if payload else None
+    num_moved, cursor, more = dao.move_descriptions_page(cursor)
+    logging.info('Moved %d torrent descriptions', num_moved)
+
+    if more and cursor:
+        taskmaster.add_description_migration_task(cursor)
+
+    return num_moved
@@ -1,8 +1,16 @@
-import webapp2
+import datetime
 import json
+import re
+import time
+
+import webapp2
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 
-import flow
-from debug import trace
+import debug
+import profiler
+import stats
+import util
 
 
 class JSONHandler(webapp2.RequestHandler):
@@ -13,7 +21,12 @@ class JSONHandler(webapp2.RequestHandler):
         self.response.headers['Content-Type'] = 'application/json'
 
     def dispatch(self):
-        rv = super(JSONHandler, self).dispatch()
+        with debug.request_span():
+            if profiler.should_profile(self.request):
+                with profiler.profile(self.request.path.strip('/').replace('/', '_')):
+                    rv = super(JSONHandler, self).dispatch()
+            else:
+                rv = super(JSONHandler, self).dispatch()
         self.response.out.write(json.dumps(rv))
 
 
@@ -21,24 +34,31 @@ class IndexTaskHandler(JSONHandler):
     """Starts tracker scraping task"""
 
     def get(self):
+        import flow
         num_new = flow.import_index()
         return {
             'status': 'success',
-            'message': '{} new torrent tasks added'.format(num_new),
+            'message': '{} new or updated torrents'.format(num_new),
         }
 
 
-class TorrentTaskHandler(webapp2.RequestHandler):
+class TorrentTaskHandler(JSONHandler):
     """Starts individual torrent import task"""
 
     def post(self):
+        import flow
         flow.import_torrent(self.request.body)
+        return {
+            'status': 'success',
+            'message': 'Torrent task done',
+        }
 
 
 class FeedsTaskHandler(JSONHandler):
     """Starts feed build task"""
 
     def post(self):
+        import flow
         last_rebuild_dt, changed_categories = flow.add_feed_tasks()
         return {
             'status': 'success',
@@ -47,13 +67,14 @@ class FeedsTaskHandler(JSONHandler):
 
 
 class SingleFeedTaskHandler(JSONHandler):
-    """Starts feed build task"""
+    """Builds feeds of changed categories, children before parents"""
 
     def post(self):
+        import flow
         rv = flow.build_feed(self.request.body)
         return {
             'status': 'success',
-            'message': 'Feed {} rebuilt'.format(rv)
+            'message': '{} feeds rebuilt'.format(rv)
         }
 
 
@@ -61,6 +82,7 @@ class CategoryMapTaskHandler(JSONHandler):
     """Starts task for rebuilding category map file"""
 
     def post(self):
+        import flow
         flow.rebuild_category_map()
         return {
             'status': 'success',
@@ -68,17 +90,207 @@ class CategoryMapTaskHandler(JSONHandler):
         }
 
 
-class JanitorTaskHandler(webapp2.RequestHandler):
+class DescriptionMigrationTaskHandler(JSONHandler):
+    """Moves one page of inline torrent descriptions to separate entities, enqueues next page"""
+
+    def post(self):
+        import flow
+        num_moved = flow.migrate_descriptions(self.request.body)
+        return {
+            'status': 'success',
+            'message': '{} descriptions moved'.format(num_moved),
+        }
+
+
+class RecountTaskHandler(JSONHandler):
+    """Counts one page of torrents into category counters, enqueues next page. First task resets counters"""
+
+    def post(self):
+        import flow
+        num_counted = flow.recount_categories(self.request.body)
+        return {
+            'status': 'success',
+            'message': '{} torrents counted'.format(num_counted),
+        }
+
+
+class JanitorTaskHandler(JSONHandler):
+    """Removes old torrents. Started by cron (GET) and continued by task queue (POST)"""
+
+    def get(self):
+        return self.run_janitor()
 
     def post(self):
+        import taskmaster
+        return self.run_janitor(taskmaster.unpack_payload(self.request.body))
+
+    def run_janitor(self, cursor=None):
+        from janitor import Janitor
         janitor = Janitor()
-        janitor.run()
+        rv = janitor.run(cursor)
+        return {
+            'status': 'success',
+            'message': '{deleted} torrents deleted in {seconds}s ({per_second}/s)'.format(**rv),
+        }
+
+
+class SearchHandler(JSONHandler):
+    """Searches torrents by title, optionally within category"""
+    MAX_RESULTS = 100
+
+    def get(self):
+        import dao
+        query = self.request.get('q')
+        cat_id = self.request.get('cat') or None
+        k = min(self.request.get_range('k', min_value=1, default=20), self.MAX_RESULTS)
+        torrents = dao.search_torrents(query, cat_id, k)
+        return {
+            'status': 'success',
+            'results': [{
+                'id': t.key.id(),
+                'title': t.title,
+                'category': t.key.parent().id(),
+                'dt': t.dt.isoformat(),
+                'nbytes': t.nbytes,
+                'btih': t.btih,
+            } for t in torrents],
+        }
+
+
+class FeedHandler(webapp2.RequestHandler):
+    """Base class for handlers rendering feeds on request
+
+    Supports conditional requests with ETag and Last-Modified and 'since' parameter (POSIX timestamp)
+    to return only items newer than that. Rendered feeds are cached by ETag"""
+    CATEGORY_ID_RE = re.compile(r'^[rcf]\d+$')
+    MAX_AGE = 60                    # Seconds
+    RENDER_CACHE_TIME = 3600        # Seconds
+
+    def serve(self, feed):
+        if feed is None:
+            self.abort(404)
+
+        since = self.request.get('since')
+        if since:
+            try:
+                feed.filter_since(datetime.datetime.utcfromtimestamp(float(since)))
+            except (ValueError, OverflowError):
+                self.abort(400)
+
+        etag = feed.etag()
+        headers = self.response.headers
+        headers['ETag'] = etag
+        headers['Last-Modified'] = util.datetime_to_http_date(feed.latest_item_dt)
+        headers['Cache-Control'] = 'public, max-age={}'.format(self.MAX_AGE)
+
+        if self.not_modified(etag, feed.latest_item_dt):
+            self.response.status_int = 304
+            return
+
+        cache_key = 'feedxml.' + etag.strip('"')
+        xml = memcache.get(cache_key)
+        if xml is None:
+            xml = feed.render_short_rss().encode('utf-8')
+            memcache.set(cache_key, xml, time=self.RENDER_CACHE_TIME)
+
+        headers['Content-Type'] = 'application/rss+xml'
+        self.response.write(xml)
+
+    def not_modified(self, etag, latest_dt):
+        """Returns True if client copy is still fresh. If-None-Match takes precedence over If-Modified-Since"""
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        modified_since = util.http_date_to_timestamp(self.request.headers.get('If-Modified-Since'))
+        return modified_since is not None and int(util.datetime_to_timestamp(latest_dt)) <= modified_since
+
+
+class CategoryFeedHandler(FeedHandler):
+    """Serves RSS feed of category, like /feeds/short/f123.xml"""
+
+    def get(self, cat_id):
+        import feeds
+        self.serve(feeds.category_feed(cat_id))
+
+
+class CompositeFeedHandler(FeedHandler):
+    """Serves RSS feed merged from multiple categories, like /feeds/custom?cats=f1,f2&q=keywords"""
+    MAX_CATEGORIES = 50
+
+    def get(self):
+        import feeds
+        cat_ids = [cid for cid in self.request.get('cats').split(',') if cid]
+        if not cat_ids or len(cat_ids) > self.MAX_CATEGORIES or not all(self.CATEGORY_ID_RE.match(c) for c in cat_ids):
+            self.abort(400)
+
+        self.serve(feeds.composite_feed(cat_ids, self.request.get('q').split()))
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Loads modules and prepares caches before instance gets its first request"""
+
+    def get(self):
+        import feeds
+        import flow
+        import parsing
+        import webclient
+        (flow)
+        parsing.warm_up()
+        feeds.warm_up()
+        webclient.warm_up()
+
+
+class SpanStatsHandler(JSONHandler):
+    """Returns aggregated timing stats per stage"""
+
+    def get(self):
+        return debug.span_stats()
+
+
+class DashboardHandler(JSONHandler):
+    """Returns pipeline freshness and throughput stats for dashboard, from precomputed aggregates"""
+    COUNTERS = ['torrents_imported', 'feeds_built', 'tracker_requests', 'tracker_errors', 'tracker_timeouts',
+                'tracker_rejected']
+    WINDOWS = [5, 60]       # Minutes
+
+    def get(self):
+        rv = {
+            'queue': queue_stats(),
+            'stages': debug.span_stats(),
+        }
+        for minutes in self.WINDOWS:
+            totals = stats.totals(self.COUNTERS, minutes)
+            per_minute = dict((name, round(float(value) / minutes, 2)) for name, value in totals.items())
+            requests = totals['tracker_requests']
+            per_minute['tracker_error_rate'] = (round(float(totals['tracker_errors']) / requests, 3)
+                                                if requests else 0)
+            per_minute['tracker_timeout_rate'] = (round(float(totals['tracker_timeouts']) / requests, 3)
+                                                  if requests else 0)
+            per_minute['publication_lag'] = stats.lag_percentiles('publication', minutes)
+            rv['last_{}m'.format(minutes)] = per_minute
+        rv['categories'] = category_stats()
+        return rv
+
 
+def category_stats():
+    """Returns torrent count and size of root and top level categories, from category counters"""
+    import dao
+    cats = dao.get_top_categories()
+    counters = dao.get_category_counters([cat_id for cat_id, _ in cats])
+    return [{'cid': cat_id, 'title': title, 'count': count, 'nbytes': nbytes}
+            for (cat_id, title), (count, nbytes) in zip(cats, counters)]
 
-class DashboardHandler(webapp2.RequestHandler):
 
-    def get(self):      # TODO
-        env = self.request.environ.items()
-        self.response.headers['Content-Type'] = 'text/plain'
-        env_vars = ["%s: %s" % (k, v) for k, v in env]
-        self.response.out.write("\n".join(env_vars))
+def queue_stats():
+    """Returns task queue backlog size and age of the oldest task"""
+    qs = taskqueue.Queue().fetch_statistics()
+    oldest_age = None
+    if qs.oldest_eta_usec:
+        oldest_age = max(0, int(time.time() - qs.oldest_eta_usec / 1e6))
+    return {
+        'tasks': qs.tasks,
+        'oldest_task_age': oldest_age,
+        'executed_last_minute': qs.executed_last_minute,
+    }
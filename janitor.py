@@ -1,5 +1,95 @@
+"""Removes old torrents"""
+import datetime
+import logging
+import time
+
+import dao
+import feeds
+import taskmaster
+
+
+RETENTION_DAYS = 180        # Torrents older than this are removed
+TIME_BUDGET = 60            # Seconds per run, cleanup continues in next task if not finished
+BATCH_SIZE = 200
+LOCK_MARGIN = 60            # Seconds cleanup lock outlives time budget, in case the last batch runs late
+
+
 class Janitor(object):
-    """Removes old torrents"""
+    """Removes torrents older than retention period in batches, resuming from saved cursor
+
+    Torrents which are still in feed window of their category or any of its parents are kept, see feeds.window_size.
+    Only one run at a time reads and saves the cursor, others are skipped"""
+
+    def __init__(self, retention_days=RETENTION_DAYS, time_budget=TIME_BUDGET, batch_size=BATCH_SIZE):
+        self.retention = datetime.timedelta(days=retention_days)
+        self.time_budget = time_budget
+        self.batch_size = batch_size
+        self.windows = {}
+
+    def run(self, task_cursor=None):
+        """Delete old torrents until done or out of time. Returns dict with run stats
+
+        Continuation tasks pass cursor they were enqueued with, and are skipped unless it is still the saved one.
+        Cron run resumes from saved cursor, so another chain of continuation tasks is never started"""
+        started = time.time()
+        if not dao.acquire_cleanup_lock(self.time_budget + LOCK_MARGIN):
+            logging.info('Cleanup is already running, skipping')
+            return self.run_stats(0, started, finished=False)
+        try:
+            num_deleted, cursor, more = self.clean(task_cursor, started)
+        finally:
+            dao.release_cleanup_lock()
+        if more:
+            taskmaster.add_cleanup_task(cursor)
+        return self.run_stats(num_deleted, started, finished=not more)
+
+    def clean(self, task_cursor, started):
+        """Delete batches of old torrents and save cleanup state. Returns (num_deleted, cursor, more) tuple"""
+        cursor, cutoff = dao.get_cleanup_state()
+        if task_cursor is not None and task_cursor != cursor:
+            logging.info('Cleanup task cursor is stale, skipping')
+            return 0, None, False
+        if cutoff is None:
+            cutoff = datetime.datetime.utcnow() - self.retention
+
+        num_deleted = 0
+        more = True
+        while more and time.time() - started < self.time_budget:
+            keys, cursor, more = dao.old_torrent_keys_page(cutoff, cursor, self.batch_size)
+            to_delete = [key for key in keys if not self.in_feed(key)]
+            dao.delete_counted_torrents(to_delete)
+            num_deleted += len(to_delete)
+            more = more and cursor is not None
+
+        if more:
+            dao.set_cleanup_state(cursor, cutoff)
+        else:
+            dao.set_cleanup_state(None, None)
+        logging.info('Deleted %d torrents older than %s', num_deleted, cutoff)
+        return num_deleted, cursor, more
+
+    def run_stats(self, num_deleted, started, finished):
+        elapsed = time.time() - started
+        rate = num_deleted / elapsed if elapsed else 0.0
+        logging.info('Cleanup run took %.1fs, %.1f torrents/s', elapsed, rate)
+        return {
+            'deleted': num_deleted,
+            'seconds': round(elapsed, 3),
+            'per_second': round(rate, 1),
+            'finished': finished
+        }
+
+    def in_feed(self, torrent_key):
+        """Returns True if torrent is in the feed window of its category or any of its parents"""
+        cat_key = torrent_key.parent()
+        for key in [cat_key] + dao.get_all_parents(cat_key):
+            if torrent_key in self.feed_window(key):
+                return True
+        return False
 
-    def run(self):
-        raise NotImplementedError   # TODO
+    def feed_window(self, cat_key):
+        """Returns set of keys for torrents category feed or snapshot may refer to"""
+        if cat_key not in self.windows:
+            keys = dao.latest_torrent_keys(feeds.window_size(cat_key), cat_key)
+            self.windows[cat_key] = set(keys)
+        return self.windows[cat_key]
@@ -1,5 +1,6 @@
 """All datastore models live in this module"""
 import datetime
+import zlib
 
 from google.appengine.ext import ndb
 
@@ -10,12 +11,34 @@ class Torrent(ndb.Model):
     btih = ndb.StringProperty(indexed=False, required=True)         # Infohash
     dt = ndb.DateTimeProperty(required=True)                        # Create/update time, as reported by tracker
     nbytes = ndb.IntegerProperty(indexed=False, required=True)      # Torrent data size, bytes
-    description = ndb.TextProperty(required=True)
+    description = ndb.TextProperty()    # Legacy, descriptions are stored in TorrentDescription now
     forum_id = ndb.IntegerProperty(required=True)     # for finding torrents in category but not its subcategories
+    counted = ndb.DateTimeProperty(indexed=False)     # Reset time of category counters torrent is counted in
 
     _memcache_timeout = 2592000     # 30 days
 
 
+class TorrentDescription(ndb.Model):
+    """Torrent description, child of Torrent entity. Stored separately so feed reads don't load it"""
+    data = ndb.BlobProperty(required=True)                  # zlib-compressed sanitized html, utf-8
+    raw_size = ndb.IntegerProperty(indexed=False)           # Size of description html on torrent page, bytes
+
+    _use_memcache = False
+
+    @property
+    def text(self):
+        """Description html, decompressed"""
+        return zlib.decompress(self.data).decode('utf-8')
+
+
+class TorrentFingerprint(ndb.Model):
+    """Index row fields of imported torrent, keyed by torrent id. Used to skip refetching unchanged torrents"""
+    title = ndb.StringProperty(indexed=False, required=True)
+    nbytes = ndb.IntegerProperty(indexed=False, required=True)
+    forum_id = ndb.IntegerProperty(indexed=False, required=True)
+    torrent_key = ndb.KeyProperty(indexed=False, required=True)
+
+
 class Account(ndb.Model):
     """Represents tracker user account along with its session"""
     username = ndb.StringProperty(indexed=False, required=True)
@@ -37,6 +60,33 @@ class Category(ndb.Model):
     _memcache_timeout = 86400       # 1 day
 
 
+class ForumCategory(ndb.Model):
+    """Full category key of forum, keyed by forum id. Lets torrent import skip breadcrumb parsing"""
+    cat_key = ndb.KeyProperty(indexed=False, required=True)
+
+    _memcache_timeout = 86400       # 1 day
+
+
+class CategoryCounter(ndb.Model):
+    """Shard of torrent count and total size of category, subcategories included. Keyed by '<cat_id>.<shard>'"""
+    count = ndb.IntegerProperty(indexed=False, default=0)
+    nbytes = ndb.IntegerProperty(indexed=False, default=0)
+
+
 class PersistentScalarValue(ndb.Expando):
     """Persistent scalar value that is stored in datastore"""
     pass
+
+
+class SearchPosting(ndb.Model):
+    """Shard of search token posting list, keyed by shard name. See search module"""
+    tids = ndb.BlobProperty(required=True)          # Packed sorted array of torrent ids
+
+    _use_memcache = False
+
+
+class FeedSnapshot(ndb.Model):
+    """Newest items of category feed, keyed by category id. Composite feeds are merged from these"""
+    title = ndb.StringProperty(indexed=False, required=True)
+    items = ndb.JsonProperty(compressed=True)       # List of rows, see feeds.snapshot_row
+    updated = ndb.DateTimeProperty(indexed=False, auto_now=True)
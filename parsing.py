@@ -1,12 +1,34 @@
 # coding: utf-8
 """Everythong related to parsing tracker responses"""
+import re
 import sys
 import datetime
+import threading
 import urlparse
 
 from lxml import etree, cssselect
 
 
+PAGE_ENCODING = 'windows-1251'     # Tracker pages are parsed as raw bytes in this encoding
+
+SELECTORS = {
+    'index_rows': 'table#tor-tbl tr.tCenter.hl-tr',
+    'index_title_link': 'td.t-title div.t-title a',
+    'index_forum_link': 'a.gen.f',
+    'index_timestamp': 'td:last-child u',
+    'index_nbytes': 'td.tor-size u',
+    'category_links': 'td.nav.w100.pad_2.brand-bg-white > span > a',
+    'description': 'div.post_body',
+    'magnet_link': 'a.med.magnet-link-16',
+    'spoiler': 'div.sp-wrap',
+    'message': 'table.message tr > td > div.mrg_16',
+    'torrent_status': '#tor-reged #tor-status-resp > a > b',
+}
+
+_parsers = threading.local()
+_selectors = threading.local()
+
+
 class Parser(object):
 
     def parse_index(self, html):
@@ -20,14 +42,15 @@ class Parser(object):
 
         return entries
 
-    def parse_torrent_page(self, html):
+    def parse_torrent_page(self, html, with_categories=True):
+        """Returns tuple (torrent data dict, category tuples). Categories are None if not requested"""
         tree = make_tree(html)
         validate_torrent(tree)
 
         try:
-            categories = self.torrent_categories(tree)
+            categories = self.torrent_categories(tree) if with_categories else None
             btih = self.torrent_btih(tree)
-            description = self.torrent_description(tree)
+            description, description_size = self.torrent_description(tree)
 
         except IndexError as e:
             _, old_exc, traceback = sys.exc_info()
@@ -36,6 +59,7 @@ class Parser(object):
 
         torrent_data = {
             'description': description,
+            'description_size': description_size,
             'btih': btih
         }
 
@@ -44,7 +68,7 @@ class Parser(object):
     def parse_index_table(self, html):
         tree = make_tree(html)
         """Returns list of index rows represented as etree.Elements"""
-        rows_selector = cssselect.CSSSelector('table#tor-tbl tr.tCenter.hl-tr')
+        rows_selector = selector('index_rows')
         rows = rows_selector(tree)
         return rows
 
@@ -65,34 +89,34 @@ class Parser(object):
         }
 
     def index_tid(self, elem):
-        title_link_selector = cssselect.CSSSelector('td.t-title div.t-title a')
+        title_link_selector = selector('index_title_link')
         a = title_link_selector(elem).pop()
         tid = a.attrib['data-topic_id']
         return int(tid)
 
     def index_forum_id(self, elem):
-        forum_link_selector = cssselect.CSSSelector('a.gen.f')
+        forum_link_selector = selector('index_forum_link')
         a = forum_link_selector(elem).pop()
         _, fid = a.attrib['href'].split('=')
         return int(fid)
 
     def index_title(self, elem):
-        title_link_selector = cssselect.CSSSelector('td.t-title div.t-title a')
+        title_link_selector = selector('index_title_link')
         a = title_link_selector(elem).pop()
         return unicode(a.text)
 
     def index_dt(self, elem):
-        timestamp_selector = cssselect.CSSSelector('td:last-child u')
+        timestamp_selector = selector('index_timestamp')
         timestamp = timestamp_selector(elem)[0].text
         return datetime.datetime.utcfromtimestamp(int(timestamp))
 
     def index_nbytes(self, elem):
-        nbytes_selector = cssselect.CSSSelector('td.tor-size u')
+        nbytes_selector = selector('index_nbytes')
         nbytes = nbytes_selector(elem)[0].text
         return int(nbytes)
 
     def torrent_categories(self, tree):
-        cat_selector = cssselect.CSSSelector('td.nav.w100.pad_2.brand-bg-white > span > a')
+        cat_selector = selector('category_links')
         cat_links = cat_selector(tree)
         return [self.parse_category_link(elem) for elem in cat_links]
 
@@ -112,15 +136,21 @@ class Parser(object):
         return (cat_id, cat_kind, link.text)
 
     def torrent_description(self, tree):
-        desc_selector = cssselect.CSSSelector('div.post_body')
+        """Returns tuple (sanitized description html, size of original description html)"""
+        desc_selector = selector('description')
         desc = desc_selector(tree)[0]
 
-        contents_list = [etree.tostring(e, encoding='utf-8') for e in desc.iterchildren() if not is_garbage(e)]
+        elements = [e for e in desc.iterchildren() if not is_garbage(e)]
+        raw_size = sum(len(etree.tostring(e, encoding='utf-8')) for e in elements)
+        for elem in elements:
+            sanitize(elem)
+
+        contents_list = [etree.tostring(e, encoding='utf-8') for e in elements]
         desc_str = ''.join(contents_list)
-        return desc_str.strip()
+        return desc_str.strip(), raw_size
 
     def torrent_btih(self, tree):
-        btih_link_selector = cssselect.CSSSelector('a.med.magnet-link-16')
+        btih_link_selector = selector('magnet_link')
         elem = btih_link_selector(tree)[0]
 
         return btih_from_href(elem.attrib['href'])
@@ -140,6 +170,53 @@ def is_garbage(elem):
     return False
 
 
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def sanitize(elem):
+    """Sanitize description element in place: drop inline styles, simplify spoilers, collapse whitespace"""
+    for spoiler in selector('spoiler')(elem):
+        simplify_spoiler(spoiler)
+
+    for e in elem.iter():
+        if e.tag is etree.Comment:
+            continue
+        e.attrib.pop('style', None)
+        if e.tag == 'pre' or any(True for _ in e.iterancestors('pre')):   # Preformatted text is kept as is
+            continue
+        e.text = collapse_whitespace(e.text)
+        e.tail = collapse_whitespace(e.tail)
+
+    return elem
+
+
+def simplify_spoiler(wrap):
+    """Replace spoiler markup with <details> element holding spoiler title and body"""
+    bodies = [e for e in wrap.iterchildren() if e.attrib.get('class', '').startswith('sp-body')]
+    if not bodies:
+        return
+
+    body = bodies[0]
+    title = body.attrib.get('title') or u''
+    wrap.attrib.clear()
+    wrap.tag = 'details'
+    for e in list(wrap):
+        wrap.remove(e)
+    wrap.text = None
+
+    summary = etree.SubElement(wrap, 'summary')
+    summary.text = title
+    summary.tail = body.text
+    wrap.extend(list(body))
+
+
+def collapse_whitespace(text):
+    """Collapse runs of whitespace to single space"""
+    if text:
+        return WHITESPACE_RE.sub(' ', text)
+    return text
+
+
 def btih_from_href(url):
     """Extracts infohash from magnet link"""
     parsed = urlparse.urlparse(url)
@@ -149,9 +226,34 @@ def btih_from_href(url):
 
 
 def make_tree(html):
-    """Make lxml.etree from html"""
-    htmlparser = etree.HTMLParser(encoding='utf-8')
-    return etree.fromstring(html, parser=htmlparser)
+    """Make lxml.etree from html, either raw windows-1251 bytes or unicode"""
+    if isinstance(html, unicode):
+        return etree.fromstring(html.encode('utf-8'), parser=get_html_parser('utf-8'))
+    return etree.fromstring(html, parser=get_html_parser(PAGE_ENCODING))
+
+
+def get_html_parser(encoding):
+    """Returns HTML parser for encoding. Parsers are reused, but not shared between threads"""
+    parsers = _parsers.__dict__
+    if encoding not in parsers:
+        parsers[encoding] = etree.HTMLParser(encoding=encoding)
+    return parsers[encoding]
+
+
+def selector(name):
+    """Returns compiled CSS selector by name from SELECTORS. Selectors are compiled once per thread"""
+    compiled = _selectors.__dict__
+    if name not in compiled:
+        compiled[name] = cssselect.CSSSelector(SELECTORS[name])
+    return compiled[name]
+
+
+def warm_up():
+    """Compile all selectors and create parsers for current thread"""
+    for name in SELECTORS:
+        selector(name)
+    get_html_parser(PAGE_ENCODING)
+    get_html_parser('utf-8')
 
 
 def validate_torrent(tree):
@@ -164,7 +266,7 @@ def validate_torrent(tree):
 
 def check_topic_deleted(tree):
     """Checks if torrent was deleted"""
-    sel = cssselect.CSSSelector('table.message tr > td > div.mrg_16')
+    sel = selector('message')
     block = sel(tree)
     if block and block[0].text == u'Тема не найдена':
         raise SkipTorrent('Torrent deleted')
@@ -179,7 +281,7 @@ def check_torrent_status(tree):
         u'сомнительно',
         u'временная'
     ]
-    sel = cssselect.CSSSelector('#tor-reged #tor-status-resp > a > b')
+    sel = selector('torrent_status')
     tags = sel(tree)
     if not tags:
         raise SkipTorrent('Status not found')
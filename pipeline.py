@@ -0,0 +1,334 @@
+"""Runs import pipeline in-process, without task queue and HTTP handlers
+
+Tasks enqueued by flow functions are collected by CollectingBackend and executed by one of
+executors: SyncExecutor or ThreadExecutor. Runs of consecutive tasks with the same url are executed
+concurrently, the same way task queue executes them. Torrent pages may be parsed in worker processes
+by ProcessParser. Parsing is CPU-bound and needs no services, so all tasks still run in this process,
+which keeps datastore, memcache, storage and stats stubs in one place."""
+import collections
+import logging
+import multiprocessing
+import optparse
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+USAGE = """%prog SDK_PATH [options]
+Run import pipeline in-process and report per-stage throughput.
+
+SDK_PATH    Path to Google Cloud or Google App Engine SDK installation, usually
+            ~/google_cloud_sdk"""
+
+
+QueuedTask = collections.namedtuple('QueuedTask', 'url payload name eta')
+TaskResult = collections.namedtuple('TaskResult', 'url elapsed spawned')
+
+
+def import_index(payload):
+    import flow
+    return flow.import_index()
+
+
+def import_torrent(payload):
+    import flow
+    return flow.import_torrent(payload)
+
+
+def add_feed_tasks(payload):
+    import flow
+    return flow.add_feed_tasks()
+
+
+def build_feed(payload):
+    import flow
+    return flow.build_feed(payload)
+
+
+def rebuild_category_map(payload):
+    import flow
+    return flow.rebuild_category_map()
+
+
+def recount_categories(payload):
+    import flow
+    return flow.recount_categories(payload)
+
+
+def migrate_descriptions(payload):
+    import flow
+    return flow.migrate_descriptions(payload)
+
+
+STAGES = collections.OrderedDict([
+    ('/task/index', import_index),
+    ('/task/torrent', import_torrent),
+    ('/task/update_feeds', add_feed_tasks),
+    ('/task/build_feed', build_feed),
+    ('/task/buildmap', rebuild_category_map),
+    ('/task/recount', recount_categories),
+    ('/task/migrate_descriptions', migrate_descriptions),
+])
+
+
+class CollectingBackend(object):
+    """Taskmaster backend which collects enqueued tasks instead of sending them to task queue"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = []
+
+    def add(self, tasks):
+        queued = [QueuedTask(t.url, t.payload, t.name, t.eta_posix) for t in tasks]
+        with self.lock:
+            self.tasks.extend(queued)
+
+    def drain(self):
+        """Return and forget all collected tasks"""
+        with self.lock:
+            rv, self.tasks = self.tasks, []
+        return rv
+
+
+_collector = None
+
+
+def install_collector():
+    """Make taskmaster send tasks to collecting backend"""
+    global _collector
+    import taskmaster
+    _collector = CollectingBackend()
+    taskmaster.set_backend(_collector)
+    return _collector
+
+
+def execute_task(task):
+    """Execute single task, return TaskResult with tasks it enqueued"""
+    func = STAGES[task.url]
+    started = time.time()
+    try:
+        func(task.payload)
+    except Exception:
+        logging.exception('Task %s %s failed', task.url, task.name)
+    elapsed = time.time() - started
+    return TaskResult(task.url, elapsed, _collector.drain())
+
+
+class SyncExecutor(object):
+    """Executes tasks one by one in current thread"""
+
+    def map(self, func, tasks):
+        return [func(t) for t in tasks]
+
+    def close(self):
+        pass
+
+
+class ThreadExecutor(SyncExecutor):
+    """Executes tasks in thread pool"""
+
+    def __init__(self, workers=8):
+        self.pool = ThreadPool(workers)
+
+    def map(self, func, tasks):
+        return self.pool.map(func, tasks, chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def parse_torrent_page(html, with_categories):
+    import parsing
+    return parsing.Parser().parse_torrent_page(html, with_categories)
+
+
+class ProcessParser(object):
+    """Torrent page parser which hands pages to pool of worker processes, see flow.set_parser_factory
+
+    Parse errors, like SkipTorrent, are raised in the calling thread"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def parse_torrent_page(self, html, with_categories=True):
+        return self.pool.apply(parse_torrent_page, (html, with_categories))
+
+
+class StageStats(object):
+    """Accumulates task count and timings for pipeline stage"""
+
+    def __init__(self):
+        self.tasks = 0
+        self.task_time = 0.0
+        self.wall_time = 0.0
+
+    def add_batch(self, results, wall_time):
+        self.tasks += len(results)
+        self.task_time += sum(r.elapsed for r in results)
+        self.wall_time += wall_time
+
+    @property
+    def throughput(self):
+        """Tasks per second of wall time"""
+        return self.tasks / self.wall_time if self.wall_time else 0.0
+
+    def __repr__(self):
+        return '<StageStats tasks={} wall={:.3f}s task={:.3f}s rate={:.2f}/s>'.format(
+            self.tasks, self.wall_time, self.task_time, self.throughput)
+
+
+class Runner(object):
+    """Runs pipeline tasks until none left. Executors may be set per stage url"""
+
+    def __init__(self, executor, stage_executors=None):
+        self.executor = executor
+        self.stage_executors = stage_executors or {}
+        self.stats = collections.OrderedDict((url, StageStats()) for url in STAGES)
+        self.seen_names = set()
+
+    def run(self, tasks=None):
+        """Run tasks (index task by default) and everything they enqueue, return stats per stage"""
+        pending = collections.deque(tasks or [QueuedTask('/task/index', None, None, 0)])
+
+        while pending:
+            batch = next_batch(pending)
+            url = batch[0].url
+            delay = max(t.eta for t in batch) - time.time()
+            if delay > 0:       # Deferred tasks
+                time.sleep(delay)
+            executor = self.stage_executors.get(url, self.executor)
+            started = time.time()
+            results = executor.map(execute_task, batch)
+            self.stats[url].add_batch(results, time.time() - started)
+
+            for result in results:
+                pending.extend(self.dedupe(result.spawned))
+
+        return self.stats
+
+    def dedupe(self, tasks):
+        """Drop named tasks that were already run, like task queue does"""
+        for task in tasks:
+            if task.name:
+                if task.name in self.seen_names:
+                    continue
+                self.seen_names.add(task.name)
+            yield task
+
+
+def next_batch(pending):
+    """Pop run of consecutive tasks with the same url from the queue"""
+    batch = [pending.popleft()]
+    while pending and pending[0].url == batch[0].url:
+        batch.append(pending.popleft())
+    return batch
+
+
+def local_services(datastore_path=None):
+    """Activate local service stubs for running pipeline outside of App Engine"""
+    from google.appengine.ext import testbed
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.setup_env(app_id='rutracker-rss', overwrite=True)
+    tb.init_datastore_v3_stub(datastore_file=datastore_path, use_sqlite=bool(datastore_path))
+    tb.init_memcache_stub()
+    tb.init_app_identity_stub()
+    tb.init_urlfetch_stub()
+    tb.init_blobstore_stub()
+
+    import staticstorage
+    staticstorage.set_storage(staticstorage.MemoryStorage())
+    return tb
+
+
+def use_dao(module):
+    """Make flow and feeds use alternative data access module, like sqlitedao"""
+    import flow
+    import feeds
+    flow.dao = feeds.dao = module
+
+
+def setup_sdk(sdk_path):
+    """Make App Engine SDK and vendored libraries importable"""
+    if os.path.exists(os.path.join(sdk_path, 'platform/google_appengine')):
+        sys.path.insert(0, os.path.join(sdk_path, 'platform/google_appengine'))
+    else:
+        sys.path.insert(0, sdk_path)
+
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    import appengine_config
+    (appengine_config)
+
+
+def main(sdk_path, options):
+    setup_sdk(sdk_path)
+    local_services(options.datastore_path)
+    install_collector()
+    if options.tracker_url:
+        import fake_tracker
+        fake_tracker.use_tracker(options.tracker_url)
+    if options.sqlite_path:
+        import sqlitedao
+        sqlitedao.connect(options.sqlite_path)
+        use_dao(sqlitedao)
+
+    if options.sqlite_path:
+        import sqlitedao
+        if options.username and not sqlitedao.get_account():
+            sqlitedao.make_account(options.username, options.password, options.userid).put()
+    else:
+        from models import Account
+        if options.username and not Account.query().get():
+            Account(username=options.username, password=options.password, userid=options.userid).put()
+
+    executor = ThreadExecutor(options.workers) if options.executor == 'thread' else SyncExecutor()
+    stage_executors = {}
+    parse_pool = None
+    if options.parse_workers:
+        import flow
+        parse_pool = multiprocessing.Pool(options.parse_workers)
+        flow.set_parser_factory(lambda: ProcessParser(parse_pool))
+        stage_executors['/task/torrent'] = ThreadExecutor(options.parse_workers)   # Keeps every worker busy
+
+    runner = Runner(executor, stage_executors)
+    started = time.time()
+    try:
+        stats = runner.run()
+    finally:
+        for ex in [executor] + stage_executors.values():
+            ex.close()
+        if parse_pool:
+            parse_pool.close()
+            parse_pool.join()
+
+    print 'Pipeline finished in {:.3f}s'.format(time.time() - started)
+    for url, stage in stats.items():
+        print '{:<20} {}'.format(url, stage)
+
+
+def parse_args(argv):
+    """Returns (SDK path, options) parsed from command line arguments, exits with usage on bad arguments"""
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--executor', choices=['sync', 'thread'], default='sync',
+                      help='how to execute tasks: sync or thread [default: %default]')
+    parser.add_option('--workers', type='int', default=8, help='number of threads')
+    parser.add_option('--parse-workers', type='int', default=0,
+                      help='parse torrent pages in this many worker processes')
+    parser.add_option('--datastore-path', help='sqlite file for datastore stub, in memory by default')
+    parser.add_option('--sqlite-path', help='use SQLite data access layer with database at this path')
+    parser.add_option('--tracker-url', help='base URL of fake tracker to use instead of real one, see fake_tracker.py')
+    parser.add_option('--username', help='tracker username')
+    parser.add_option('--password', help='tracker password')
+    parser.add_option('--userid', type='int', help='tracker user id')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('exactly 1 argument required')
+    return args[0], options
+
+
+if __name__ == '__main__':
+    main(*parse_args(sys.argv[1:]))
@@ -0,0 +1,92 @@
+"""Opt-in sampling profiler for request handlers, writes collapsed stacks via debug.debug_dump"""
+import collections
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import debug
+
+
+PROFILE_HEADER = 'X-Profile'
+PROFILED_PATH_PREFIXES = ('/task/',)        # Only admin-only handlers can be profiled
+SAMPLE_INTERVAL = 0.005                     # Seconds between stack samples
+MAX_DEPTH = 100
+
+
+def sample_rate():
+    """Returns fraction of requests to profile, from PROFILE_SAMPLE_RATE environment variable"""
+    try:
+        return float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    except ValueError:
+        return 0.0
+
+
+def should_profile(request):
+    """Returns True if request asks for profiling with header or was picked by sampling"""
+    if not request.path.startswith(PROFILED_PATH_PREFIXES):
+        return False
+    if request.headers.get(PROFILE_HEADER):
+        return True
+    rate = sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+class SamplingProfiler(object):
+    """Samples stack of one thread from background thread and counts collapsed stacks"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.target_id = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start sampling current thread"""
+        self.target_id = threading.current_thread().ident
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            frame = sys._current_frames().get(self.target_id)
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """Returns profile in collapsed stack format, one 'frame;frame;frame count' line per stack"""
+        lines = ['{} {}'.format(stack, count) for stack, count in self.samples.most_common()]
+        return '\n'.join(lines) + '\n'
+
+
+def collapse_stack(frame):
+    """Returns stack of frame as semicolon-separated string, outermost frame first"""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+@contextmanager
+def profile(name):
+    """Profile code block and dump collapsed stacks to profiles/<name>.txt"""
+    prof = SamplingProfiler()
+    prof.start()
+    try:
+        yield prof
+    finally:
+        prof.stop()
+        logging.info('Profiled %s: %d samples', name, sum(prof.samples.values()))
+        debug.debug_dump('profiles/{}.txt'.format(name), prof.collapsed())
@@ -0,0 +1,156 @@
+# coding: utf-8
+"""Torrent search: title tokenization and inverted index operations
+
+Posting lists are sorted arrays of torrent ids. Topic ids grow with time, so the newest matches are at the end.
+Posting lists are stored split into shards by torrent id, so that frequent tokens don't make hot entities."""
+import array
+import bisect
+import heapq
+import itertools
+import re
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MIN_TOKEN_LENGTH = 2
+MAX_POSTINGS = 20000        # Per token, oldest torrent ids are dropped beyond this
+CATEGORY_PREFIX = 'cat:'
+POSTING_SHARDS = 8          # Stored posting list shards per token
+SHARD_POSTINGS = MAX_POSTINGS // POSTING_SHARDS
+CANDIDATES_FACTOR = 2       # Search orders this many times k newest matching ids by torrent update time
+POSTINGS_TYPECODE = 'I' if array.array('I').itemsize >= 4 else 'L'
+
+
+def normalize(text):
+    """Lowercase text and fold Cyrillic yo to ye, as users type it either way"""
+    return text.lower().replace(u'ё', u'е')
+
+
+def tokenize(text):
+    """Returns list of unique normalized tokens in text, in order of appearance"""
+    seen = set()
+    rv = []
+    for token in TOKEN_RE.findall(normalize(text)):
+        if (len(token) >= MIN_TOKEN_LENGTH or token.isdigit()) and token not in seen:
+            seen.add(token)
+            rv.append(token)
+    return rv
+
+
+def category_token(cat_id):
+    return CATEGORY_PREFIX + cat_id
+
+
+def document_tokens(title, cat_ids):
+    """Returns all tokens torrent is indexed under: title tokens and its category ids except root"""
+    return tokenize(title) + [category_token(cid) for cid in cat_ids if cid != 'r0']
+
+
+def query_tokens(query, cat_id=None):
+    """Returns tokens for search query, optionally restricted to category"""
+    tokens = tokenize(query)
+    if cat_id and cat_id != 'r0':
+        tokens.append(category_token(cat_id))
+    return tokens
+
+
+def posting_shard(token, tid):
+    """Returns name of posting list shard which torrent id is added to"""
+    return u'{}#{}'.format(token, tid % POSTING_SHARDS)
+
+
+def posting_shards(token):
+    """Returns names of all posting list shards of token"""
+    return [u'{}#{}'.format(token, i) for i in range(POSTING_SHARDS)]
+
+
+def merge_postings(shards):
+    """Returns posting list with ids of all shards, shards hold disjoint ids"""
+    if len(shards) == 1:
+        return shards[0]
+    postings = make_postings()
+    postings.extend(heapq.merge(*shards))
+    return postings
+
+
+def make_postings(packed=None):
+    """Returns posting list, optionally unpacked from string"""
+    postings = array.array(POSTINGS_TYPECODE)
+    if packed:
+        postings.fromstring(packed)
+    return postings
+
+
+def add_posting(postings, tid, limit=MAX_POSTINGS):
+    """Add torrent id to sorted posting list in place, keeping about limit newest ids
+
+    List is trimmed back to limit once it grows 10% past it, so trimming doesn't shift the array on every add"""
+    if postings and postings[-1] < tid:
+        postings.append(tid)
+    else:
+        pos = bisect.bisect_left(postings, tid)
+        if pos < len(postings) and postings[pos] == tid:
+            return
+        postings.insert(pos, tid)
+
+    if len(postings) > limit + limit // 10:
+        del postings[:len(postings) - limit]
+
+
+def contains(postings, tid):
+    pos = bisect.bisect_left(postings, tid)
+    return pos < len(postings) and postings[pos] == tid
+
+
+def iter_newest(posting_lists):
+    """Yields torrent ids present in all posting lists, newest first"""
+    if not posting_lists or not all(posting_lists):
+        return
+
+    lists = sorted(posting_lists, key=len)
+    shortest, others = lists[0], lists[1:]
+    for i in xrange(len(shortest) - 1, -1, -1):
+        tid = shortest[i]
+        if all(contains(p, tid) for p in others):
+            yield tid
+
+
+def intersect_newest(posting_lists, k):
+    """Returns up to k newest torrent ids present in all posting lists, newest first"""
+    return list(itertools.islice(iter_newest(posting_lists), k))
+
+
+def most_recent(tids, load, k):
+    """Returns up to k most recently updated torrents for matching ids, ordered by torrent dt
+
+    load(tids) returns torrents for ids which still match, skipping deleted torrents and changed titles.
+    Ids are loaded newest first in chunks until CANDIDATES_FACTOR * k torrents are found or ids run out, so stale
+    ids don't leave result short, and torrents bumped on tracker are ordered by their new dt"""
+    wanted = k * CANDIDATES_FACTOR
+    tids = iter(tids)
+    found = []
+    while len(found) < wanted:
+        chunk = list(itertools.islice(tids, wanted - len(found)))
+        if not chunk:
+            break
+        found.extend(load(chunk))
+    found.sort(key=lambda t: t.dt, reverse=True)
+    return found[:k]
+
+
+class InvertedIndex(object):
+    """In-memory inverted index, same operations as the datastore-backed one in dao"""
+
+    def __init__(self):
+        self.postings = {}
+
+    def add(self, tid, title, cat_ids=()):
+        for token in document_tokens(title, cat_ids):
+            if token not in self.postings:
+                self.postings[token] = make_postings()
+            add_posting(self.postings[token], tid)
+
+    def search(self, query, cat_id=None, k=20):
+        tokens = query_tokens(query, cat_id)
+        if not tokens:
+            return []
+        return intersect_newest([self.postings.get(t) for t in tokens], k)
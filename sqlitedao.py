@@ -0,0 +1,755 @@
+"""SQLite data access layer, a drop-in replacement for dao module outside of App Engine
+
+Category and torrent keys are represented with Key objects mimicking the parts of ndb.Key the app uses.
+Category path (ids of category and its parents joined with '/') is used for subtree queries."""
+import datetime
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+
+import search
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS category (
+    path TEXT PRIMARY KEY,
+    title TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS forum_category (
+    forum_id INTEGER PRIMARY KEY,
+    cat_path TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS category_counter (
+    cat_id TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    nbytes INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS torrent (
+    tid INTEGER PRIMARY KEY,
+    cat_path TEXT NOT NULL,
+    title TEXT NOT NULL,
+    btih TEXT NOT NULL,
+    dt TIMESTAMP NOT NULL,
+    nbytes INTEGER NOT NULL,
+    forum_id INTEGER NOT NULL,
+    counted TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS torrent_description (
+    tid INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    raw_size INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS torrent_cat_dt ON torrent (cat_path, dt DESC, tid, title, btih, nbytes, forum_id);
+CREATE INDEX IF NOT EXISTS torrent_dt ON torrent (dt DESC, cat_path, tid);
+
+CREATE TABLE IF NOT EXISTS account (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    password TEXT NOT NULL,
+    userid INTEGER NOT NULL,
+    cookies TEXT
+);
+
+CREATE TABLE IF NOT EXISTS search_posting (
+    token TEXT PRIMARY KEY,
+    tids BLOB NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS feed_snapshot (
+    cat_id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    items TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS persistent_value (
+    name TEXT PRIMARY KEY,
+    value BLOB
+) WITHOUT ROWID;
+"""
+
+TORRENT_COLUMNS = ('tid', 'cat_path', 'title', 'btih', 'dt', 'nbytes', 'forum_id')
+
+ROOT_CATEGORY_PATH = 'r0'
+FIRST_COUNTERS_DT = datetime.datetime(2000, 1, 1)   # Counter marker of torrents counted before counters were reset
+COUNTED = 'COALESCE(counted, ?) = ?'                # Row is counted since last counter reset, see count_torrent
+
+_db = None
+_lock = threading.RLock()
+_owner_pid = None       # Process which opened the database, the only one caching persistent values
+
+
+def connect(path=':memory:'):
+    """Open (and create if needed) database at path, must be called before any other function"""
+    global _db, _owner_pid
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    if 'counted' not in [row[1] for row in conn.execute('PRAGMA table_info(torrent)')]:    # Older databases
+        conn.execute('ALTER TABLE torrent ADD COLUMN counted TIMESTAMP')
+    _db = conn
+    _owner_pid = os.getpid()
+    return conn
+
+
+@contextmanager
+def cursor():
+    """Yields database cursor, serializing access to shared connection"""
+    with _lock:
+        yield _db.cursor()
+
+
+@contextmanager
+def transaction():
+    """Yields database cursor, commits on success and rolls back on error"""
+    with _lock:
+        with _db:
+            yield _db.cursor()
+
+
+class Key(object):
+    """Entity key, a sequence of (kind, id) pairs like ndb.Key"""
+    __slots__ = ('_pairs',)
+
+    def __init__(self, pairs):
+        self._pairs = tuple(pairs)
+
+    def pairs(self):
+        return self._pairs
+
+    def kind(self):
+        return self._pairs[-1][0]
+
+    def id(self):
+        return self._pairs[-1][1]
+
+    def parent(self):
+        if len(self._pairs) > 1:
+            return Key(self._pairs[:-1])
+
+    def get(self):
+        return get_from_key(self)
+
+    @property
+    def path(self):
+        """Category path for category keys, category path of parent for torrent keys"""
+        return '/'.join(str(i) for k, i in self._pairs if k == 'Category')
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self._pairs == other._pairs
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._pairs)
+
+    def __reduce__(self):       # Keys are pickled in task payloads
+        return Key, (self._pairs,)
+
+    def __repr__(self):
+        return 'Key({!r})'.format(self._pairs)
+
+
+def category_key_from_path(path):
+    """Makes full category key from category path"""
+    return Key(('Category', cid) for cid in path.split('/'))
+
+
+ROOT_CATEGORY_KEY = category_key_from_path(ROOT_CATEGORY_PATH)
+
+
+class Record(object):
+    """Base class for plain entities stored in SQLite"""
+    fields = ()
+
+    def __init__(self, key=None, **kwargs):
+        self.key = key
+        for name in self.fields:
+            setattr(self, name, kwargs.get(name))
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+    def put(self):
+        write_multi([self])
+        return self.key
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key == other.key and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}(key={!r}, {})'.format(type(self).__name__, self.key, self.to_dict())
+
+
+class Torrent(Record):
+    fields = ('title', 'btih', 'dt', 'nbytes', 'forum_id')
+
+
+class TorrentDescription(Record):
+    fields = ('data', 'raw_size')
+
+    @property
+    def text(self):
+        """Description html, decompressed"""
+        return zlib.decompress(self.data).decode('utf-8')
+
+
+class TorrentFingerprint(Record):
+    """Index row fields of torrent. Derived from torrent table, never written on its own"""
+    fields = ('title', 'nbytes', 'forum_id', 'torrent_key')
+
+
+class Category(Record):
+    fields = ('title',)
+
+
+class ForumCategory(Record):
+    fields = ('cat_key',)
+
+
+class Account(Record):
+    fields = ('username', 'password', 'userid', 'cookies')
+
+
+class FeedSnapshot(Record):
+    fields = ('title', 'items')
+
+
+# Generic functions
+
+def get_from_key(key):
+    """Return entity from key"""
+    kind = key.kind()
+    with cursor() as cur:
+        if kind == 'Category':
+            cur.execute('SELECT title FROM category WHERE path = ?', (key.path,))
+            row = cur.fetchone()
+            return row and Category(key=key, title=row[0])
+
+        elif kind == 'Torrent':
+            cur.execute('SELECT title, btih, dt, nbytes, forum_id FROM torrent WHERE tid = ?', (key.id(),))
+            row = cur.fetchone()
+            return row and Torrent(key=key, **dict(zip(Torrent.fields, row)))
+
+        elif kind == 'TorrentDescription':
+            cur.execute('SELECT data, raw_size FROM torrent_description WHERE tid = ?', (key.parent().id(),))
+            row = cur.fetchone()
+            return row and TorrentDescription(key=key, data=str(row[0]), raw_size=row[1])
+
+        elif kind == 'Account':
+            return _fetch_account(cur, 'SELECT * FROM account WHERE id = ?', (key.id(),))
+
+    raise ValueError('Unknown kind {}'.format(kind))
+
+
+def write_multi(entities):
+    """Write multiple entities at once, in one transaction"""
+    torrents = [_torrent_row(e) for e in entities if isinstance(e, Torrent)]
+    descriptions = [(e.key.parent().id(), sqlite3.Binary(e.data), e.raw_size)
+                    for e in entities if isinstance(e, TorrentDescription)]
+    categories = [(e.key.path, e.title) for e in entities if isinstance(e, Category)]
+    forums = [(e.key.id(), e.cat_key.path) for e in entities if isinstance(e, ForumCategory)]
+    accounts = [e for e in entities if isinstance(e, Account)]
+
+    with transaction() as cur:
+        if categories:
+            cur.executemany('INSERT OR REPLACE INTO category (path, title) VALUES (?, ?)', categories)
+        if forums:
+            cur.executemany('INSERT OR REPLACE INTO forum_category (forum_id, cat_path) VALUES (?, ?)', forums)
+        if torrents:
+            cur.executemany('INSERT OR REPLACE INTO torrent ({}) VALUES ({})'.format(
+                ', '.join(TORRENT_COLUMNS), ', '.join('?' * len(TORRENT_COLUMNS))), torrents)
+        if descriptions:
+            cur.executemany('INSERT OR REPLACE INTO torrent_description (tid, data, raw_size) VALUES (?, ?, ?)',
+                            descriptions)
+        for acc in accounts:
+            row = (acc.username, acc.password, acc.userid, json.dumps(acc.cookies))
+            if acc.key is None:
+                cur.execute('INSERT INTO account (username, password, userid, cookies) VALUES (?, ?, ?, ?)', row)
+                acc.key = Key([('Account', cur.lastrowid)])
+            else:
+                cur.execute('UPDATE account SET username = ?, password = ?, userid = ?, cookies = ? WHERE id = ?',
+                            row + (acc.key.id(),))
+
+
+def _torrent_row(torrent):
+    return (torrent.key.id(), torrent.key.path, torrent.title, torrent.btih, torrent.dt,
+            torrent.nbytes, torrent.forum_id)
+
+
+def get_all_parents(key):
+    """"Returns list of all parent keys for key"""
+    parent = key.parent()
+    if parent:
+        rv = get_all_parents(parent)
+        rv.append(parent)
+        return rv
+    else:
+        return []
+
+
+def get_all_parents_multi(keys):
+    """Returns all parents for multiple keys"""
+    rv = set()
+    for key in keys:
+        rv.update(get_all_parents(key))
+    return rv
+
+
+# Torrent-related functions
+
+def latest_torrent_dt():
+    """Returns datetime for most recent torrent or start of epoch if no torrents"""
+    with cursor() as cur:
+        cur.execute('SELECT dt FROM torrent ORDER BY dt DESC LIMIT 1')
+        row = cur.fetchone()
+    return row[0] if row else datetime.datetime.utcfromtimestamp(0)
+
+
+def latest_torrents(num_items, cat_key=None):
+    """Returns num_items torrent in specified category and/or its subcategories"""
+    path = (cat_key or ROOT_CATEGORY_KEY).path
+    columns = ', '.join(TORRENT_COLUMNS)
+
+    with cursor() as cur:
+        if path == ROOT_CATEGORY_PATH:
+            cur.execute('SELECT {} FROM torrent ORDER BY dt DESC LIMIT ?'.format(columns), (num_items,))
+        else:       # '0' follows '/', so the range covers all subcategory paths
+            cur.execute('SELECT {} FROM torrent WHERE cat_path = ? OR (cat_path >= ? AND cat_path < ?) '
+                        'ORDER BY dt DESC LIMIT ?'.format(columns), (path, path + '/', path + '0', num_items))
+        rows = cur.fetchall()
+
+    return [_torrent_from_row(row) for row in rows]
+
+
+def latest_forum_torrents(num_items, cat_key):
+    """Returns num_items latest torrents of forum itself, without its subforums"""
+    with cursor() as cur:
+        cur.execute('SELECT {} FROM torrent WHERE cat_path = ? ORDER BY dt DESC LIMIT ?'.format(
+            ', '.join(TORRENT_COLUMNS)), (cat_key.path, num_items))
+        rows = cur.fetchall()
+    return [_torrent_from_row(row) for row in rows]
+
+
+def _torrent_from_row(row):
+    values = dict(zip(TORRENT_COLUMNS, row))
+    key = Key(category_key_from_path(values.pop('cat_path')).pairs() + (('Torrent', values.pop('tid')),))
+    return Torrent(key=key, **values)
+
+
+def torrents_page(cutoff_dt, page_cursor=None, page_size=500):
+    """Returns page of torrents created or updated before cutoff_dt, oldest first
+
+    Returns (torrents, cursor, more) tuple. Cursor is (dt, tid) of the last torrent on page"""
+    columns = ', '.join(TORRENT_COLUMNS)
+    last_dt, last_tid = page_cursor or (datetime.datetime.min, 0)
+
+    with cursor() as cur:
+        cur.execute('SELECT {} FROM torrent WHERE dt <= ? AND (dt > ? OR (dt = ? AND tid > ?)) '
+                    'ORDER BY dt, tid LIMIT ?'.format(columns), (cutoff_dt, last_dt, last_dt, last_tid, page_size + 1))
+        rows = cur.fetchall()
+
+    more = len(rows) > page_size
+    torrents = [_torrent_from_row(row) for row in rows[:page_size]]
+    next_cursor = (torrents[-1].dt, torrents[-1].key.id()) if torrents else None
+    return torrents, next_cursor, more
+
+
+def make_torrent(parent, fields):
+    """Make torrent entity with parent category key"""
+    fields = dict(fields)
+    tid = fields.pop('id')
+    return Torrent(key=Key(parent.pairs() + (('Torrent', tid),)), **fields)
+
+
+def description_key(torrent_key):
+    """Returns key of description entity for torrent"""
+    return Key(torrent_key.pairs() + (('TorrentDescription', 1),))
+
+
+def make_torrent_description(torrent_key, html, raw_size=None):
+    """Make description entity for torrent, html is compressed here"""
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    return TorrentDescription(key=description_key(torrent_key), data=zlib.compress(html), raw_size=raw_size)
+
+
+def get_torrent_description(torrent_key):
+    """Returns torrent description text, loaded on demand"""
+    desc = get_from_key(description_key(torrent_key))
+    return desc and desc.text
+
+
+def move_descriptions_page(cursor=None, page_size=100):
+    """Descriptions are never stored inline here, so there is nothing to move. Returns (0, None, False)"""
+    return 0, None, False
+
+
+def make_fingerprint(torrent):
+    """Make fingerprint entity for torrent"""
+    return TorrentFingerprint(key=Key([('TorrentFingerprint', torrent.key.id())]), title=torrent.title,
+                              nbytes=torrent.nbytes, forum_id=torrent.forum_id, torrent_key=torrent.key)
+
+
+def get_fingerprints(tids):
+    """Returns list of fingerprints (or None if torrent is unknown) for torrent ids"""
+    if not tids:
+        return []
+
+    with cursor() as cur:
+        cur.execute('SELECT tid, cat_path, title, nbytes, forum_id FROM torrent WHERE tid IN ({})'.format(
+            ', '.join('?' * len(tids))), list(tids))
+        rows = cur.fetchall()
+
+    found = {}
+    for tid, path, title, nbytes, forum_id in rows:
+        torrent_key = Key(category_key_from_path(path).pairs() + (('Torrent', tid),))
+        found[tid] = TorrentFingerprint(key=Key([('TorrentFingerprint', tid)]), title=title, nbytes=nbytes,
+                                        forum_id=forum_id, torrent_key=torrent_key)
+    return [found.get(tid) for tid in tids]
+
+
+def update_torrent_dts(key_dt_pairs):
+    """Set new dt for torrents, specified by list of (key, dt) tuples"""
+    with transaction() as cur:
+        cur.executemany('UPDATE torrent SET dt = ? WHERE tid = ?', [(dt, key.id()) for key, dt in key_dt_pairs])
+
+
+def delete_torrents(keys):
+    """Delete torrents along with their descriptions. Fingerprints are part of torrent rows"""
+    tids = [(key.id(),) for key in keys]
+    with transaction() as cur:
+        cur.executemany('DELETE FROM torrent WHERE tid = ?', tids)
+        cur.executemany('DELETE FROM torrent_description WHERE tid = ?', tids)
+
+
+def torrent_keys_since_dt(dt):
+    """Returns list of keys for torrents added since dt"""
+    with cursor() as cur:
+        cur.execute('SELECT cat_path, tid FROM torrent WHERE dt > ?', (dt,))
+        rows = cur.fetchall()
+    return [Key(category_key_from_path(path).pairs() + (('Torrent', tid),)) for path, tid in rows]
+
+
+# Category-related functions
+
+def get_all_categories():
+    """Returns all categories"""
+    with cursor() as cur:
+        cur.execute('SELECT path, title FROM category')
+        rows = cur.fetchall()
+    return [Category(key=category_key_from_path(path), title=title) for path, title in rows]
+
+
+def all_changed_categories_since(dt):
+    """Returns all categories with torrents added since dt"""
+    changed_keys = set(key.parent() for key in torrent_keys_since_dt(dt))
+    changed_keys.update(get_all_parents_multi(changed_keys))
+    return [get_from_key(key) for key in changed_keys]
+
+
+def category_key_from_tuples(cat_tuples):
+    """"Makes full category key from list of category tuples"""
+    return Key(('Category', '{}{}'.format(cat[1], cat[0])) for cat in cat_tuples)
+
+
+def make_category(key, title):
+    """Make category entity with key and title"""
+    return Category(key=key, title=title)
+
+
+def make_forum_category(forum_id, cat_key):
+    """Make forum index entity, mapping forum id to full category key"""
+    return ForumCategory(key=Key([('ForumCategory', forum_id)]), cat_key=cat_key)
+
+
+def get_forum_category_keys(forum_ids):
+    """Returns list of full category keys (or None for unknown forums) for forum ids"""
+    if not forum_ids:
+        return []
+
+    with cursor() as cur:
+        cur.execute('SELECT forum_id, cat_path FROM forum_category WHERE forum_id IN ({})'.format(
+            ', '.join('?' * len(forum_ids))), list(forum_ids))
+        found = dict((fid, category_key_from_path(path)) for fid, path in cur.fetchall())
+    return [found.get(fid) for fid in forum_ids]
+
+
+def rollup_counter_deltas(changes):
+    """Returns dict of category id to [count, nbytes] deltas, for list of (category key, count, nbytes) changes
+
+    Every change is added to its category and all parents, categories with zero deltas are left out"""
+    deltas = {}
+    for cat_key, count, nbytes in changes:
+        for key in [cat_key] + get_all_parents(cat_key):
+            delta = deltas.setdefault(key.id(), [0, 0])
+            delta[0] += count
+            delta[1] += nbytes
+    return dict((cat_id, delta) for cat_id, delta in deltas.items() if delta != [0, 0])
+
+
+def update_category_counters(changes):
+    """Add torrent count and size changes, list of (category key, count, nbytes) tuples, to category counters
+
+    Single writer, so counters are not sharded"""
+    with transaction() as cur:
+        _add_to_counters(cur, changes)
+
+
+def count_torrent(torrent, description, previous_key=None):
+    """Write imported torrent with its description, and add it to category counters, in one transaction
+
+    Torrent rows are keyed by torrent id, so stored row is replaced, and subtracted if it was counted since counters
+    were reset. That covers previous_key of moved torrent too"""
+    reset_dt = get_counters_reset_dt()
+    with transaction() as cur:
+        cur.execute('SELECT cat_path, nbytes FROM torrent WHERE tid = ? AND {}'.format(COUNTED),
+                    (torrent.key.id(), FIRST_COUNTERS_DT, reset_dt))
+        changes = [(torrent.key.parent(), 1, torrent.nbytes)]
+        changes.extend((category_key_from_path(path), -1, -nbytes) for path, nbytes in cur.fetchall())
+        cur.execute('INSERT OR REPLACE INTO torrent ({}, counted) VALUES ({}, ?)'.format(
+            ', '.join(TORRENT_COLUMNS), ', '.join('?' * len(TORRENT_COLUMNS))), _torrent_row(torrent) + (reset_dt,))
+        cur.execute('INSERT OR REPLACE INTO torrent_description (tid, data, raw_size) VALUES (?, ?, ?)',
+                    (torrent.key.id(), sqlite3.Binary(description.data), description.raw_size))
+        _add_to_counters(cur, changes)
+
+
+def count_stored_torrents(keys, reset_dt):
+    """Add stored torrents which were not counted since counters were reset at reset_dt to counters, and mark them
+
+    Returns number of torrents counted"""
+    tids = [key.id() for key in keys]
+    if not tids:
+        return 0
+    with transaction() as cur:
+        cur.execute('SELECT tid, cat_path, nbytes FROM torrent WHERE tid IN ({}) AND NOT {}'.format(
+            ', '.join('?' * len(tids)), COUNTED), tids + [FIRST_COUNTERS_DT, reset_dt])
+        rows = cur.fetchall()
+        cur.executemany('UPDATE torrent SET counted = ? WHERE tid = ?', [(reset_dt, tid) for tid, _, _ in rows])
+        _add_to_counters(cur, [(category_key_from_path(path), 1, nbytes) for _, path, nbytes in rows])
+    return len(rows)
+
+
+def delete_counted_torrents(keys):
+    """Delete torrents along with their descriptions, and subtract counted ones from counters, in one transaction"""
+    tids = [key.id() for key in keys]
+    if not tids:
+        return
+    with transaction() as cur:
+        cur.execute('SELECT cat_path, nbytes FROM torrent WHERE tid IN ({}) AND {}'.format(
+            ', '.join('?' * len(tids)), COUNTED), tids + [FIRST_COUNTERS_DT, get_counters_reset_dt()])
+        changes = [(category_key_from_path(path), -1, -nbytes) for path, nbytes in cur.fetchall()]
+        cur.executemany('DELETE FROM torrent WHERE tid = ?', [(tid,) for tid in tids])
+        cur.executemany('DELETE FROM torrent_description WHERE tid = ?', [(tid,) for tid in tids])
+        _add_to_counters(cur, changes)
+
+
+def _add_to_counters(cur, changes):
+    deltas = rollup_counter_deltas(changes)
+    cur.executemany('INSERT OR IGNORE INTO category_counter (cat_id, count, nbytes) VALUES (?, 0, 0)',
+                    [(cat_id,) for cat_id in deltas])
+    cur.executemany('UPDATE category_counter SET count = count + ?, nbytes = nbytes + ? WHERE cat_id = ?',
+                    [(count, nbytes, cat_id) for cat_id, (count, nbytes) in deltas.items()])
+
+
+def get_category_counters(cat_ids):
+    """Returns list of (torrent count, total nbytes) tuples for category ids, subcategories included"""
+    if not cat_ids:
+        return []
+
+    with cursor() as cur:
+        cur.execute('SELECT cat_id, count, nbytes FROM category_counter WHERE cat_id IN ({})'.format(
+            ', '.join('?' * len(cat_ids))), list(cat_ids))
+        found = dict((cat_id, (count, nbytes)) for cat_id, count, nbytes in cur.fetchall())
+    return [found.get(cat_id, (0, 0)) for cat_id in cat_ids]
+
+
+def reset_category_counters():
+    """Delete all category counters. Returns reset time, torrents counted after it are marked with it"""
+    reset_dt = datetime.datetime.utcnow()
+    CachedPersistentValue('counters_reset_dt').put(reset_dt)
+    with transaction() as cur:
+        cur.execute('DELETE FROM category_counter')
+    return reset_dt
+
+
+def get_counters_reset_dt():
+    """Returns time category counters were last reset, see count_torrent"""
+    return CachedPersistentValue('counters_reset_dt').get() or FIRST_COUNTERS_DT
+
+
+# Search-related functions
+
+def add_to_search_index(tid, tokens):
+    """Add torrent id to posting lists of tokens"""
+    to_write = []
+    with transaction() as cur:
+        for token, postings in zip(tokens, _get_postings(cur, tokens)):
+            if not search.contains(postings, tid):
+                search.add_posting(postings, tid)
+                to_write.append((token, sqlite3.Binary(postings.tostring())))
+        cur.executemany('INSERT OR REPLACE INTO search_posting (token, tids) VALUES (?, ?)', to_write)
+
+
+def get_postings(tokens):
+    """Returns list of posting lists for tokens, empty for unknown ones"""
+    with cursor() as cur:
+        return _get_postings(cur, tokens)
+
+
+def _get_postings(cur, tokens):
+    if not tokens:
+        return []
+    cur.execute('SELECT token, tids FROM search_posting WHERE token IN ({})'.format(
+        ', '.join('?' * len(tokens))), list(tokens))
+    found = dict((token, str(tids)) for token, tids in cur.fetchall())
+    return [search.make_postings(found.get(t)) for t in tokens]
+
+
+def search_torrents(query, cat_id=None, k=20):
+    """Returns up to k most recently updated torrents matching query, optionally in category and its subcategories"""
+    tokens = search.query_tokens(query, cat_id)
+    if not tokens:
+        return []
+
+    def load(tids):
+        rv = []
+        for fp in get_fingerprints(tids):
+            if not fp:
+                continue
+            cat_ids = [key.id() for key in get_all_parents(fp.torrent_key)]
+            if set(tokens).issubset(search.document_tokens(fp.title, cat_ids)):
+                rv.append(get_from_key(fp.torrent_key))
+        return rv
+
+    return search.most_recent(search.iter_newest(get_postings(tokens)), load, k)
+
+
+# Account-related functions
+
+def _fetch_account(cur, query, params=()):
+    cur.execute(query, params)
+    row = cur.fetchone()
+    if row is None:
+        return None
+    acc_id, username, password, userid, cookies = row
+    return Account(key=Key([('Account', acc_id)]), username=username, password=password, userid=userid,
+                   cookies=json.loads(cookies) if cookies else None)
+
+
+def get_account():
+    """Return one account"""
+    with cursor() as cur:
+        return _fetch_account(cur, 'SELECT * FROM account LIMIT 1')
+
+
+def make_account(username, password, userid):
+    """Make account entity"""
+    return Account(username=username, password=password, userid=userid)
+
+
+@contextmanager
+def account_context(acc=None):
+    """Provides account context and saves account entry if it was changed"""
+    account = acc or get_account()
+    values = account.to_dict()
+
+    try:
+        yield account
+    finally:
+        if account.to_dict() != values:
+            account.put()
+
+
+#  Feed-related functions
+
+def get_last_feed_rebuild_dt():
+    """Returns datatime of last feed rebuild"""
+    cts = CachedPersistentValue('feed_build_date')
+    return cts.get() or datetime.datetime.utcfromtimestamp(0)
+
+
+def set_last_feed_rebuild_dt(dt):
+    """Saves datatime of last feed rebuild"""
+    cts = CachedPersistentValue('feed_build_date')
+    cts.put(dt)
+
+
+def save_feed_snapshot(cat_id, title, rows):
+    """Save newest items of category feed"""
+    with transaction() as cur:
+        cur.execute('INSERT OR REPLACE INTO feed_snapshot (cat_id, title, items) VALUES (?, ?, ?)',
+                    (cat_id, title, json.dumps(rows)))
+
+
+def get_feed_snapshots(cat_ids):
+    """Returns list of feed snapshots (or None if category has no feed yet) for category ids"""
+    if not cat_ids:
+        return []
+
+    with cursor() as cur:
+        cur.execute('SELECT cat_id, title, items FROM feed_snapshot WHERE cat_id IN ({})'.format(
+            ', '.join('?' * len(cat_ids))), list(cat_ids))
+        rows = cur.fetchall()
+
+    found = dict((cid, FeedSnapshot(key=Key([('FeedSnapshot', cid)]), title=title, items=json.loads(items)))
+                 for cid, title, items in rows)
+    return [found.get(cid) for cid in cat_ids]
+
+
+class CachedPersistentValue(object):
+    """Persistent value, cached in memory of process which opened the database, local flag changes nothing
+
+    Processes forked after connect may write the database too, so they always read values from it"""
+    _cache = {}
+
+    def __init__(self, key, local=False):
+        self.key = key
+
+    @classmethod
+    def _process_cache(cls):
+        return cls._cache if os.getpid() == _owner_pid else {}
+
+    def put(self, value, async=False):
+        with transaction() as cur:
+            cur.execute('INSERT OR REPLACE INTO persistent_value (name, value) VALUES (?, ?)',
+                        (self.key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+        self._process_cache()[self.key] = value
+
+    def get(self):
+        cache = self._process_cache()
+        if self.key in cache:
+            return cache[self.key]
+
+        with cursor() as cur:
+            cur.execute('SELECT value FROM persistent_value WHERE name = ?', (self.key,))
+            row = cur.fetchone()
+        if row is None:
+            return None
+
+        value = pickle.loads(str(row[0]))
+        cache[self.key] = value
+        return value
+
+    @classmethod
+    def get_multi(cls, keys, local=False):
+        """Returns list of values for keys"""
+        return [cls(key).get() for key in keys]
+
+    def delete(self, async=False):
+        self._process_cache().pop(self.key, None)
+        with transaction() as cur:
+            cur.execute('DELETE FROM persistent_value WHERE name = ?', (self.key,))
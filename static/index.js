@@ -1,10 +1,17 @@
 $(function(){
     var url = 'https://storage.googleapis.com/rutracker-rss.appspot.com/category_map.json';
 
+    function addTags(node){
+        if (node.count !== undefined) node.tags = [node.count];
+        $.each(node.nodes || [], function(i, child){ addTags(child); });
+    }
+
     $.getJSON(url, {}, function(data, textStatus){
+        $.each(data, function(i, node){ addTags(node); });
 
         var tree = $('#ctree').treeview({
-          data: JSON.stringify(data)
+          data: JSON.stringify(data),
+          showTags: true
         });
     });
 });
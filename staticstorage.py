@@ -2,6 +2,11 @@
 import cloudstorage as gcs
 from google.appengine.api import app_identity
 
+import debug
+
+
+_storage = None
+
 
 class BaseStaticStorage(object):
     """Base class for storage adapters. All subclasses must implement put and url_for_path methods"""
@@ -14,25 +19,72 @@ class BaseStaticStorage(object):
         """Get absolute url for object stored at path"""
         raise NotImplementedError()
 
+    def put_multi(self, objects):
+        """Put multiple objects into storage, objects are (path, content, content_type) tuples"""
+        for path, content, content_type in objects:
+            self.put(path, content, content_type)
+
 
 class GCSStorage(BaseStaticStorage):
     """Google cloud storage backend"""
-    _default_bucket_name = app_identity.get_default_gcs_bucket_name()
+    _default_bucket_name = None     # Looked up on first use, it takes app_identity RPC
 
     def __init__(self, bucket_name=None):
-        self.bucket_name = bucket_name or self._default_bucket_name
+        self._bucket_name = bucket_name
+
+    @property
+    def bucket_name(self):
+        if self._bucket_name is None:
+            if GCSStorage._default_bucket_name is None:
+                GCSStorage._default_bucket_name = app_identity.get_default_gcs_bucket_name()
+            self._bucket_name = GCSStorage._default_bucket_name
+        return self._bucket_name
 
     def make_full_path(self, path):
         """Build full path from bucket name and given file path"""
         return '/' + self.bucket_name + '/' + path.strip('/')
 
     def put(self, path, content, content_type='text/html'):
-        fullname = self.make_full_path(path)
-        gcs_file = gcs.open(fullname, 'w', content_type=content_type)
+        with debug.span('storage', len(content)):
+            self._write(path, content, content_type)
+
+    def put_multi(self, objects):
+        """Put multiple objects, in one storage span. Each object is still a separate upload"""
+        with debug.span('storage', sum(len(content) for _, content, _ in objects)):
+            for path, content, content_type in objects:
+                self._write(path, content, content_type)
+
+    def _write(self, path, content, content_type):
+        gcs_file = gcs.open(self.make_full_path(path), 'w', content_type=content_type)
         try:
             gcs_file.write(content)
         finally:
             gcs_file.close()
 
     def url_for_path(self, path):
-        return 'https://storage.googleapis.com/{}.appspot.com/{}'.format(self.bucket_name, path.strip('/'))
+        return 'https://storage.googleapis.com/{}/{}'.format(self.bucket_name, path.strip('/'))
+
+
+class MemoryStorage(BaseStaticStorage):
+    """In-memory storage backend, for running pipeline locally"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, path, content, content_type='text/html'):
+        self.objects[path.strip('/')] = (content, content_type)
+
+    def url_for_path(self, path):
+        return 'memory:///{}'.format(path.strip('/'))
+
+
+def get_storage():
+    """Returns storage backend set with set_storage or new GCSStorage instance"""
+    return _storage or GCSStorage()
+
+
+def set_storage(storage):
+    """Set storage backend used by get_storage, returns previous one"""
+    global _storage
+    previous, _storage = _storage, storage
+    return previous
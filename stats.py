@@ -0,0 +1,80 @@
+"""Rolling pipeline statistics, kept in memcache as per-minute counters"""
+import time
+
+from google.appengine.api import memcache
+
+
+PREFIX = 'stats.'
+LAG_BOUNDS = (60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 7200, 14400, 43200, 86400)    # Seconds
+
+
+def current_minute(ts=None):
+    """Returns number of minute since epoch"""
+    return int((ts or time.time()) // 60)
+
+
+def make_key(name, minute):
+    return '{}{}.{}'.format(PREFIX, name, minute)
+
+
+def incr(name, delta=1):
+    """Add delta to counter for current minute"""
+    incr_multi({name: delta})
+
+
+def incr_multi(deltas):
+    """Add deltas to multiple counters for current minute in one memcache call"""
+    minute = current_minute()
+    memcache.offset_multi(dict((make_key(name, minute), delta) for name, delta in deltas.items()), initial_value=0)
+
+
+def lag_bucket(seconds):
+    """Returns lag histogram bucket index for lag in seconds"""
+    for i, bound in enumerate(LAG_BOUNDS):
+        if seconds <= bound:
+            return i
+    return len(LAG_BOUNDS)
+
+
+def record_lags(name, lags):
+    """Add multiple lag measurements (seconds) to lag histogram"""
+    deltas = {}
+    for lag in lags:
+        bucket = '{}.lag{}'.format(name, lag_bucket(lag))
+        deltas[bucket] = deltas.get(bucket, 0) + 1
+    if deltas:
+        incr_multi(deltas)
+
+
+def totals(names, minutes):
+    """Returns dict with counter totals for last number of minutes, including current one"""
+    now = current_minute()
+    keys = dict(((name, m), make_key(name, m)) for name in names for m in range(now - minutes + 1, now + 1))
+    values = memcache.get_multi(keys.values())
+    rv = dict((name, 0) for name in names)
+
+    for (name, _), key in keys.items():
+        rv[name] += int(values.get(key, 0))
+
+    return rv
+
+
+def lag_percentiles(name, minutes, fractions=(0.5, 0.95, 0.99)):
+    """Returns dict of lag percentiles (bucket upper bounds, seconds) for last number of minutes"""
+    bucket_names = ['{}.lag{}'.format(name, i) for i in range(len(LAG_BOUNDS) + 1)]
+    counts = totals(bucket_names, minutes)
+    histogram = [counts[b] for b in bucket_names]
+    total = sum(histogram)
+    rv = {'count': total}
+
+    for fraction in fractions:
+        label = 'p{}'.format(int(fraction * 100))
+        rv[label] = None
+        running = 0
+        for i, count in enumerate(histogram):
+            running += count
+            if total and running >= total * fraction:
+                rv[label] = LAG_BOUNDS[min(i, len(LAG_BOUNDS) - 1)]
+                break
+
+    return rv
@@ -1,30 +1,75 @@
 """Adds tasks to task queue"""
 import pickle
+import logging
+
 from google.appengine.api import taskqueue
 
+import util
+
+
+class TaskQueueBackend(object):
+    """Sends tasks to App Engine task queue. Alternative backends must implement add method"""
+
+    def add(self, tasks):
+        """Enqueue list of taskqueue.Task objects"""
+        _add_multi(taskqueue.Queue(), tasks)
+
+
+_backend = TaskQueueBackend()
+
+
+def set_backend(backend):
+    """Set backend used for enqueueing tasks, returns previous one"""
+    global _backend
+    previous, _backend = _backend, backend
+    return previous
+
+
+def add_deferred_torrent_task(payload, countdown):
+    """Enqueue torrent task again with its packed payload, to run after countdown seconds"""
+    _backend.add([taskqueue.Task(url='/task/torrent', payload=payload, countdown=int(countdown) + 1)])
+
 
 def add_feeds_update_task():
     """Enqueue task updating feeds"""
-    taskqueue.add(url='/task/update_feeds')
+    _backend.add([taskqueue.Task(url='/task/update_feeds')])
+
 
+def add_feed_build_task(cat_ids, generation, since_dt, part=0):
+    """Enqueue task building feeds for categories in given order, with torrents added since since_dt
 
-def add_feed_build_tasks(params_list):
-    """Enqueue task for building feed for specific category"""
-    q = taskqueue.Queue()
-    tasks = [taskqueue.Task(url='/task/build_feed', payload=pack_payload(p)) for p in params_list]
-    _add_multi(q, tasks)
+    Tasks are named after feed generation and part number of the pass, counted by continuation tasks,
+    so every part runs at most once per generation"""
+    payload = pack_payload((cat_ids, generation, since_dt, part))
+    _backend.add([taskqueue.Task(url='/task/build_feed', payload=payload, name=feed_task_name(generation, part))])
 
 
 def add_torrent_tasks(params_list):
     """"Enqueue task for torrent entry represented by dict"""
-    q = taskqueue.Queue()
-    tasks = [taskqueue.Task(url='/task/torrent', payload=pack_payload(p)) for p in params_list]
-    _add_multi(q, tasks)
+    tasks = [taskqueue.Task(url='/task/torrent', payload=pack_payload(p), name=torrent_task_name(p))
+             for p in params_list]
+    _backend.add(tasks)
 
 
 def add_map_rebuild_task():
     """"Enqueue task for rebuilding category map"""
-    taskqueue.add(url='/task/buildmap')
+    _backend.add([taskqueue.Task(url='/task/buildmap')])
+
+
+def add_cleanup_task(cursor):
+    """"Enqueue task continuing removal of old torrents from cursor"""
+    _backend.add([taskqueue.Task(url='/task/cleanup', payload=pack_payload(cursor))])
+
+
+def add_recount_task(cursor, cutoff_dt):
+    """"Enqueue task continuing category counters rebuild from cursor"""
+    _backend.add([taskqueue.Task(url='/task/recount', payload=pack_payload((cursor, cutoff_dt)))])
+
+
+def add_description_migration_task(cursor=None):
+    """"Enqueue task moving inline descriptions to separate entities, starting at cursor"""
+    payload = pack_payload(cursor) if cursor else None
+    _backend.add([taskqueue.Task(url='/task/migrate_descriptions', payload=payload)])
 
 
 def pack_payload(value):
@@ -37,10 +82,31 @@ def unpack_payload(payload):
     return pickle.loads(payload)
 
 
+def torrent_task_name(entry):
+    """Returns task name for torrent entry, unique for torrent id and its update time"""
+    return 'torrent-{}-{}'.format(entry['id'], int(util.datetime_to_timestamp(entry['dt'])))
+
+
+def feed_task_name(generation, part):
+    """Returns task name for feed build pass, unique for feed generation and part number of the pass"""
+    return 'feeds-{}-{}'.format(int(util.datetime_to_timestamp(generation)), part)
+
+
 def _add_multi(queue, tasks, *args, **kwargs):
-    """Enqeue multiple tasks, splitting batch adds if needed"""
-    for chunk in chunks(tasks, taskqueue.MAX_TASKS_PER_ADD):
-        queue.add(chunk, *args, **kwargs)
+    """Enqeue multiple tasks, sending all batch adds concurrently
+
+    Tasks which already exist (or existed recently) in the queue are skipped"""
+    rpcs = [queue.add_async(chunk, *args, **kwargs) for chunk in chunks(tasks, taskqueue.MAX_TASKS_PER_ADD)]
+    num_skipped = 0
+
+    for rpc in rpcs:
+        try:
+            rpc.get_result()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            num_skipped += 1
+
+    if num_skipped:
+        logging.debug('%d batch adds had duplicate tasks', num_skipped)
 
 
 def chunks(seq, n):
@@ -3,4 +3,52 @@ import webtest
 import unittest
 from mock import Mock, patch
 
+from google.appengine.ext import testbed
+
+import taskmaster
 from apps import task_app, manage_app
+
+
+class DescriptionMigrationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.app = webtest.TestApp(task_app)
+        self.patches = [patch('flow.dao.move_descriptions_page'),
+                        patch('flow.taskmaster.add_description_migration_task')]
+        self.move_page, self.add_task = [p.start() for p in self.patches]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.testbed.deactivate()
+
+    def test_dashboard_post_starts_from_first_page(self):
+        self.move_page.return_value = (100, 'page-2', True)
+
+        resp = self.app.post('/task/migrate_descriptions')
+
+        self.move_page.assert_called_once_with(None)
+        self.add_task.assert_called_once_with('page-2')
+        self.assertEqual(resp.json['message'], '100 descriptions moved')
+
+    def test_task_continues_from_cursor(self):
+        self.move_page.return_value = (100, 'page-3', True)
+
+        self.app.post('/task/migrate_descriptions', taskmaster.pack_payload('page-2'))
+
+        self.move_page.assert_called_once_with('page-2')
+        self.add_task.assert_called_once_with('page-3')
+
+    def test_last_page_ends_migration(self):
+        self.move_page.return_value = (10, None, False)
+
+        self.app.post('/task/migrate_descriptions', taskmaster.pack_payload('page-3'))
+
+        self.assertFalse(self.add_task.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
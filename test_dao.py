@@ -0,0 +1,189 @@
+import datetime
+import unittest
+
+from google.appengine.ext import ndb
+
+import dao
+import search
+from models import Category, CategoryCounter, SearchPosting, Torrent, TorrentFingerprint
+from test_models import DatastoreTestCase
+
+
+FORUM_KEY = ndb.Key(Category, 'r0', Category, 'c1', Category, 'f2')
+OTHER_FORUM_KEY = ndb.Key(Category, 'r0', Category, 'c1', Category, 'f3')
+
+
+def index_entry(tid, dt, title='Torrent title', nbytes=1024, forum_id=2):
+    """Returns dict as parsed from tracker index row"""
+    return {'id': tid, 'title': title, 'dt': dt, 'nbytes': nbytes, 'forum_id': forum_id}
+
+
+def write_torrent(entry, parent=FORUM_KEY):
+    """Write torrent with its description and fingerprint like import task does, returns torrent"""
+    torrent = dao.make_torrent(parent, dict(entry, btih='1234567890ABCDEF'))
+    desc = dao.make_torrent_description(torrent.key, u'<p>Description</p>')
+    dao.write_multi([torrent, desc, dao.make_fingerprint(torrent)])
+    return torrent
+
+
+class FingerprintTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(FingerprintTestCase, self).setUp()
+        self.dt = datetime.datetime(2020, 1, 1, 12, 0)
+        self.torrent = write_torrent(index_entry(1, self.dt))
+
+    def test_fingerprint_holds_index_fields(self):
+        fp = TorrentFingerprint.get_by_id(1)
+
+        self.assertEqual(fp.title, 'Torrent title')
+        self.assertEqual(fp.nbytes, 1024)
+        self.assertEqual(fp.forum_id, 2)
+        self.assertEqual(fp.torrent_key, self.torrent.key)
+
+    def test_get_fingerprints_keeps_order_and_returns_none_for_unknown(self):
+        write_torrent(index_entry(2, self.dt, title='Other'))
+
+        rv = dao.get_fingerprints([2, 3, 1])
+
+        self.assertEqual(rv[0].title, 'Other')
+        self.assertIsNone(rv[1])
+        self.assertEqual(rv[2].torrent_key, self.torrent.key)
+
+    def test_update_torrent_dts(self):
+        new_dt = self.dt + datetime.timedelta(hours=1)
+        missing_key = ndb.Key(Torrent, 100, parent=FORUM_KEY)
+
+        dao.update_torrent_dts([(self.torrent.key, new_dt), (missing_key, new_dt)])
+
+        self.assertEqual(self.torrent.key.get().dt, new_dt)
+        self.assertIsNone(missing_key.get())
+
+    def test_update_torrent_dts_accepts_empty_list(self):
+        dao.update_torrent_dts([])
+
+        self.assertEqual(self.torrent.key.get().dt, self.dt)
+
+    def test_delete_torrents_deletes_description_and_fingerprint(self):
+        dao.delete_torrents([self.torrent.key])
+
+        self.assertIsNone(self.torrent.key.get())
+        self.assertIsNone(dao.description_key(self.torrent.key).get())
+        self.assertIsNone(TorrentFingerprint.get_by_id(1))
+
+
+class CategoryCounterTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(CategoryCounterTestCase, self).setUp()
+        self.dt = datetime.datetime(2020, 1, 1, 12, 0)
+
+    def test_counters_roll_up_to_parents(self):
+        dao.update_category_counters([(FORUM_KEY, 1, 100), (OTHER_FORUM_KEY, 1, 50)])
+        dao.update_category_counters([(OTHER_FORUM_KEY, 1, 10), (FORUM_KEY, -1, -100)])
+
+        self.assertEqual(dao.get_category_counters(['r0', 'c1', 'f2', 'f3', 'c10']),
+                         [(2, 60), (2, 60), (0, 0), (2, 60), (0, 0)])
+
+    def test_counters_are_summed_over_shards(self):
+        for _ in range(50):
+            dao.update_category_counters([(FORUM_KEY, 1, 10)])
+
+        shards = CategoryCounter.query().fetch()
+
+        self.assertGreater(len([s for s in shards if s.key.id().startswith('r0.')]), 1)
+        self.assertEqual(dao.get_category_counters(['r0', 'f2']), [(50, 500), (50, 500)])
+
+    def import_torrent(self, entry, parent=FORUM_KEY, previous_key=None):
+        torrent = dao.make_torrent(parent, dict(entry, btih='ABCDEF'))
+        dao.count_torrent(torrent, dao.make_torrent_description(torrent.key, u'<p>Description</p>'), previous_key)
+        return torrent
+
+    def test_retried_import_is_counted_once(self):
+        torrent = self.import_torrent(index_entry(1, self.dt))
+        self.import_torrent(index_entry(1, self.dt))
+
+        self.assertEqual(dao.get_category_counters(['r0', 'f2']), [(1, 1024), (1, 1024)])
+        self.assertEqual(TorrentFingerprint.get_by_id(1).torrent_key, torrent.key)
+
+    def test_changed_torrent_is_counted_again(self):
+        old = self.import_torrent(index_entry(1, self.dt))
+
+        moved = self.import_torrent(index_entry(1, self.dt, nbytes=2048, forum_id=3), OTHER_FORUM_KEY, old.key)
+
+        self.assertEqual(dao.get_category_counters(['r0', 'f2', 'f3']), [(1, 2048), (0, 0), (1, 2048)])
+        self.assertIsNone(old.key.get())
+        self.assertEqual(moved.key.get().nbytes, 2048)
+
+    def test_unmarked_torrent_is_not_counted_again(self):
+        write_torrent(index_entry(1, self.dt))      # Stored before torrents were marked, counted by recount
+        dao.update_category_counters([(FORUM_KEY, 1, 1024)])
+
+        self.import_torrent(index_entry(1, self.dt))
+
+        self.assertEqual(dao.get_category_counters(['r0', 'f2']), [(1, 1024), (1, 1024)])
+
+    def test_retried_delete_is_subtracted_once(self):
+        torrents = [self.import_torrent(index_entry(tid, self.dt)) for tid in range(1, 4)]
+
+        dao.delete_counted_torrents([t.key for t in torrents[:2]])
+        dao.delete_counted_torrents([t.key for t in torrents[:2]])
+
+        self.assertEqual(dao.get_category_counters(['r0', 'f2']), [(1, 1024), (1, 1024)])
+        self.assertEqual(Torrent.query().count(), 1)
+        self.assertIsNone(TorrentFingerprint.get_by_id(1))
+
+    def test_stored_torrents_are_counted_once_after_reset(self):
+        torrents = [self.import_torrent(index_entry(tid, self.dt)) for tid in range(1, 4)]
+        reset_dt = dao.reset_category_counters()
+        self.import_torrent(index_entry(3, self.dt))        # Imported during recount
+
+        self.assertEqual(dao.count_stored_torrents([t.key for t in torrents], reset_dt), 2)
+        self.assertEqual(dao.count_stored_torrents([t.key for t in torrents], reset_dt), 0)
+
+        self.assertEqual(dao.get_category_counters(['r0', 'f2']), [(3, 3072), (3, 3072)])
+        self.assertEqual(Torrent.get_by_id(1, parent=FORUM_KEY).counted, reset_dt)
+
+    def test_reset_deletes_all_shards(self):
+        dao.update_category_counters([(FORUM_KEY, 1, 100)])
+
+        dao.reset_category_counters()
+
+        self.assertEqual(dao.get_category_counters(['r0', 'f2']), [(0, 0), (0, 0)])
+
+
+class SearchIndexTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(SearchIndexTestCase, self).setUp()
+        self.dt = datetime.datetime(2020, 1, 1, 12, 0)
+
+    def index(self, torrent):
+        cat_ids = [key.id() for key in dao.get_all_parents(torrent.key)]
+        dao.add_to_search_index(torrent.key.id(), search.document_tokens(torrent.title, cat_ids))
+
+    def test_postings_are_sharded(self):
+        for tid in range(1, 4):
+            self.index(write_torrent(index_entry(tid, self.dt)))
+
+        for token in [u'title', 'cat:f2']:
+            shard = SearchPosting.get_by_id(search.posting_shard(token, 1))
+            self.assertEqual(list(search.make_postings(shard.tids)), [1])
+            self.assertIsNone(SearchPosting.get_by_id(token))
+        self.assertEqual([list(p) for p in dao.get_postings([u'title', 'cat:f2'])], [[1, 2, 3], [1, 2, 3]])
+
+    def test_search_skips_deleted_torrents_and_orders_by_dt(self):
+        torrents = [write_torrent(index_entry(tid, self.dt + datetime.timedelta(hours=tid))) for tid in range(1, 10)]
+        for torrent in torrents:
+            self.index(torrent)
+        dao.update_torrent_dts([(torrents[0].key, self.dt + datetime.timedelta(days=1))])
+        dao.delete_torrents([t.key for t in torrents[3:]])
+
+        rv = dao.search_torrents(u'title', 'f2', k=2)
+
+        self.assertEqual([t.key.id() for t in rv], [1, 3])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+
+from google.appengine.ext import testbed
+from mock import patch
+
+import debug
+from debug import HISTOGRAM_BOUNDS
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_bucket_upper_bound_is_inclusive(self):
+        self.assertEqual(debug.histogram_bucket(0), 0)
+        self.assertEqual(debug.histogram_bucket(1), 0)
+        self.assertEqual(debug.histogram_bucket(1.5), 1)
+        self.assertEqual(debug.histogram_bucket(100), HISTOGRAM_BOUNDS.index(100))
+
+    def test_slow_spans_go_to_overflow_bucket(self):
+        self.assertEqual(debug.histogram_bucket(HISTOGRAM_BOUNDS[-1] + 1), len(HISTOGRAM_BOUNDS))
+
+    def test_percentile_is_bucket_upper_bound(self):
+        histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        histogram[debug.histogram_bucket(3)] = 90
+        histogram[debug.histogram_bucket(150)] = 10
+
+        self.assertEqual(debug.histogram_percentile(histogram, 0.5), 5)
+        self.assertEqual(debug.histogram_percentile(histogram, 0.9), 5)
+        self.assertEqual(debug.histogram_percentile(histogram, 0.95), 200)
+
+    def test_percentile_in_overflow_bucket_is_largest_bound(self):
+        histogram = [0] * len(HISTOGRAM_BOUNDS) + [1]
+
+        self.assertEqual(debug.histogram_percentile(histogram, 0.5), HISTOGRAM_BOUNDS[-1])
+
+    def test_percentile_of_empty_histogram_is_none(self):
+        self.assertIsNone(debug.histogram_percentile([0] * (len(HISTOGRAM_BOUNDS) + 1), 0.5))
+
+
+class SpanStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        debug.flush_spans()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_spans_are_aggregated_per_stage(self):
+        debug.record_span('parse', 3, nbytes=1000)
+        debug.record_span('parse', 150, nbytes=500)
+        debug.record_span('storage', 10)
+        debug.flush_spans()
+
+        rv = debug.span_stats()
+
+        self.assertEqual(rv['parse']['count'], 2)
+        self.assertEqual(rv['parse']['ms'], 153)
+        self.assertEqual(rv['parse']['bytes'], 1500)
+        self.assertEqual(rv['parse']['p50'], 5)
+        self.assertEqual(rv['parse']['p95'], 200)
+        self.assertEqual(rv['storage']['count'], 1)
+        self.assertEqual(rv['webclient']['count'], 0)
+        self.assertIsNone(rv['webclient']['p50'])
+
+    def test_spans_do_not_measure_memory(self):
+        with patch('debug._memory_usage') as memory_usage:
+            with debug.span('datastore'):
+                with debug.span('datastore'):
+                    pass
+            debug.flush_spans()
+
+        self.assertFalse(memory_usage.called)
+        self.assertEqual(debug.span_stats()['datastore']['count'], 2)
+
+    def test_memory_is_measured_once_per_request(self):
+        with patch('debug._memory_usage', side_effect=[100.0, 102.5]) as memory_usage:
+            with debug.request_span():
+                with debug.span('datastore'):
+                    pass
+                with debug.span('render'):
+                    pass
+
+        rv = debug.span_stats()
+        self.assertEqual(memory_usage.call_count, 2)
+        self.assertEqual(rv['request']['count'], 1)
+        self.assertEqual(rv['request']['mem_kb'], 2560)
+        self.assertEqual(rv['render']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from mock import Mock
+
+import fake_tracker
+import parsing
+import webclient
+
+
+class FakeTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = fake_tracker.Config(rate=0, backlog=30, forums=5, page_size=10)
+        self.server = fake_tracker.start_server(self.config)
+        cls = webclient.RutrackerWebClient
+        self.urls = (cls.TORRENT_PAGE_URL, cls.LOGIN_URL, cls.INDEX_URL)
+        fake_tracker.use_tracker(self.server.base_url)
+        self.breaker_factory = webclient.set_breaker_factory(lambda: None)
+        self.account = Mock(username='user', password='password', userid=self.config.userid, cookies=None)
+        self.wc = webclient.RutrackerWebClient()
+        self.parser = parsing.Parser()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        cls = webclient.RutrackerWebClient
+        cls.TORRENT_PAGE_URL, cls.LOGIN_URL, cls.INDEX_URL = self.urls
+        webclient.set_breaker_factory(self.breaker_factory)
+
+    def test_index_page_is_parsed(self):
+        entries = self.parser.parse_index(self.wc.get_index_page(self.account))
+
+        self.assertEqual(len(entries), 10)
+        self.assertEqual(entries[0]['id'], fake_tracker.BASE_TID + 29)
+        self.assertEqual(entries[0]['title'], self.server.tracker.torrent(entries[0]['id'])['title'])
+
+    def test_index_page_is_filtered_by_forum(self):
+        entries = self.parser.parse_index(self.wc.get_index_page(self.account, forum_id=101))
+
+        self.assertTrue(entries)
+        self.assertTrue(all(e['forum_id'] == 101 for e in entries))
+
+    def test_torrent_page_is_parsed(self):
+        torrent = self.server.tracker.torrent(fake_tracker.BASE_TID + 3)
+
+        data, categories = self.parser.parse_torrent_page(self.wc.get_torrent_page(self.account, torrent['id']))
+
+        self.assertEqual(data['btih'], torrent['btih'])
+        self.assertEqual(categories[-1][:2], (torrent['forum_id'], 'f'))
+        self.assertEqual(categories[0][:2], (0, 'r'))
+
+    def test_huge_thread_is_not_read_to_the_end(self):
+        self.config.huge_rate = 1.0
+
+        html = self.wc.get_torrent_page(self.account, fake_tracker.BASE_TID)
+
+        self.assertLess(len(html), fake_tracker.HUGE_THREAD_BYTES // 10)
+        self.assertTrue(self.parser.parse_torrent_page(html)[0]['btih'])
+
+    def test_expired_session_is_not_logged_in(self):
+        self.wc.get_index_page(self.account)
+        self.config.session_ttl = 1
+        self.server.tracker.now = lambda: self.server.tracker.started + 3600
+
+        with self.assertRaises(webclient.NotLoggedIn):
+            self.wc.get_index_page(self.account)
+        self.assertIsNone(self.account.cookies)
+
+    def test_errors_are_injected(self):
+        self.config.error_rate = 1.0
+
+        with self.assertRaises(webclient.RequestError):
+            self.wc.get_index_page(self.account)
@@ -0,0 +1,171 @@
+# coding: utf-8
+import datetime
+import json
+import unittest
+from mock import patch
+
+import feeds
+import sqlitedao
+import staticstorage
+
+
+def make_row(tid, ts, title=None):
+    return [tid, title or u'Torrent {}'.format(tid), 'ABCDEF', ts, 1024, 1]
+
+
+class MergeNewestTestCase(unittest.TestCase):
+
+    def test_items_are_merged_newest_first(self):
+        rows_a = [make_row(5, 500), make_row(3, 300), make_row(1, 100)]
+        rows_b = [make_row(4, 400), make_row(2, 200)]
+
+        items = feeds.merge_newest([rows_a, rows_b], 4)
+
+        self.assertEqual([i.tid for i in items], [5, 4, 3, 2])
+        self.assertEqual(items[0].dt.year, 1970)
+
+    def test_duplicates_are_returned_once(self):
+        forum_rows = [make_row(2, 200), make_row(1, 100)]
+        parent_rows = [make_row(3, 300), make_row(2, 200), make_row(1, 100)]
+
+        items = feeds.merge_newest([forum_rows, parent_rows], 10)
+
+        self.assertEqual([i.tid for i in items], [3, 2, 1])
+
+    def test_keywords_filter_titles(self):
+        rows = [make_row(3, 300, u'Ёлки 2'), make_row(2, 200, u'Палки'), make_row(1, 100, u'елки (2010)')]
+
+        items = feeds.merge_newest([rows], 10, [u'ЕЛКИ'])
+
+        self.assertEqual([i.tid for i in items], [3, 1])
+
+
+class FeedTestCase(unittest.TestCase):
+
+    def make_feed(self, rows):
+        feed = feeds.Feed(title=u'Фильмы', link='http://localhost/')
+        for item in feeds.merge_newest([rows], 10):
+            feed.add_item(item)
+        return feed
+
+    def test_etag_changes_with_items(self):
+        rows = [make_row(2, 200), make_row(1, 100)]
+        etag = self.make_feed(rows).etag()
+
+        self.assertEqual(self.make_feed(rows).etag(), etag)
+        self.assertNotEqual(self.make_feed([make_row(3, 300)] + rows).etag(), etag)
+        self.assertTrue(etag.startswith('"'))
+
+    def test_all_formats_have_same_items(self):
+        feed = self.make_feed([make_row(2, 200, u'Кино & <Сериалы>'), make_row(1, 100)])
+
+        rss, atom, json_feed = feed.render_all('http://localhost/feeds/atom/c1.xml')
+
+        self.assertEqual(rss, feed.render_short_rss())
+        self.assertIn(u'<title>Кино &amp; &lt;Сериалы&gt;</title>', rss)
+        self.assertIn(u'<title>Кино &amp; &lt;Сериалы&gt;</title>', atom)
+        self.assertIn(u'<updated>1970-01-01T00:03:20Z</updated>', atom)
+        self.assertIn(u'<id>http://localhost/feeds/atom/c1.xml</id>', atom)
+        self.assertIn(u'<author>', atom)
+        self.assertEqual(rss.count('<item>'), atom.count('<entry>'))
+        items = json.loads(json_feed)['items']
+        self.assertEqual([i['title'] for i in items], [u'Кино & <Сериалы>', u'Torrent 1'])
+        self.assertEqual(items[0]['url'], feeds.MAGNET_URI.format('ABCDEF'))
+
+    def test_atom_feeds_are_identified_by_their_url(self):
+        store = staticstorage.MemoryStorage()
+
+        feeds.save_feeds(store, self.make_feed([make_row(1, 100)]), 'feeds', 'c1')
+        feeds.save_feeds(store, self.make_feed([make_row(1, 100)]), 'feeds', 'f2')
+
+        for name in ['c1', 'f2']:
+            atom = store.objects['feeds/atom/{}.xml'.format(name)][0]
+            self.assertIn('<id>memory:///feeds/atom/{}.xml</id>'.format(name), atom)
+
+    def test_filter_since_keeps_latest_item_dt(self):
+        feed = self.make_feed([make_row(2, 200), make_row(1, 100)])
+        latest_dt = feed.latest_item_dt
+
+        feed.filter_since(feed.items[1].dt)
+
+        self.assertEqual([i.tid for i in feed.items], [2])
+        self.assertEqual(feed.latest_item_dt, latest_dt)
+
+
+class FeedBuilderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        sqlitedao.connect(':memory:')
+        self.store = {}
+        self.patches = [patch.object(feeds, 'dao', sqlitedao),
+                        patch.object(feeds, 'get_app_url', return_value='http://localhost/'),
+                        patch.object(feeds, 'save_feeds', side_effect=self.save_feeds)]
+        for p in self.patches:
+            p.start()
+
+        tuples = [(0, 'r', 'Root'), (1, 'c', 'Cat'), (2, 'f', 'Forum'), (4, 'f', 'Subforum')]
+        keys = [sqlitedao.category_key_from_tuples(tuples[:n]) for n in (1, 2, 3, 4)]
+        keys.append(sqlitedao.category_key_from_tuples(tuples[:2] + [(3, 'f', 'Other')]))
+        sqlitedao.write_multi([sqlitedao.make_category(key, key.id()) for key in keys])
+        self.forum_key, self.subforum_key, self.other_key = keys[2], keys[3], keys[4]
+
+        dt = datetime.datetime(2016, 2, 19, 10, 25, 21)
+        torrents = []
+        for tid in range(1, 31):
+            cat_key = [self.forum_key, self.subforum_key, self.other_key][tid % 3]
+            fields = {'id': tid, 'title': u'Torrent {}'.format(tid), 'btih': 'ABCDEF',
+                      'dt': dt + datetime.timedelta(hours=tid), 'nbytes': 1024, 'forum_id': int(cat_key.id()[1:])}
+            torrents.append(sqlitedao.make_torrent(cat_key, fields))
+        sqlitedao.write_multi(torrents)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def save_feeds(self, store, feed, prefix, name):
+        self.store[name] = feed
+
+    def make_builder(self):
+        return feeds.FeedBuilder(sqlitedao.get_all_categories(), None, 'feeds')
+
+    def test_parent_feeds_match_subtree_queries(self):
+        builder = self.make_builder()
+        for cat_id in ['f4', 'f3', 'f2', 'c1', 'r0']:
+            builder.build(cat_id)
+
+        for cat_id in ['f2', 'c1', 'r0']:
+            cat = sqlitedao.get_from_key(builder.categories[cat_id].key)
+            expected = [t.key.id() for t in sqlitedao.latest_torrents(feeds.feed_size(cat.key), cat.key)]
+            self.assertEqual([i.tid for i in self.store[cat_id].items], expected)
+
+    def test_parents_are_merged_without_subtree_query(self):
+        builder = self.make_builder()
+        with patch.object(sqlitedao, 'latest_torrents', wraps=sqlitedao.latest_torrents) as latest_torrents:
+            for cat_id in ['f4', 'f3', 'f2', 'c1', 'r0']:
+                builder.build(cat_id)
+
+        self.assertEqual(sorted(c[0][1].id() for c in latest_torrents.call_args_list), ['f3', 'f4'])
+
+    def test_window_covers_feed_and_snapshot(self):
+        for cat_id in ['f2', 'c1', 'r0']:
+            cat_key = self.make_builder().categories[cat_id].key
+
+            self.assertEqual(feeds.window_size(cat_key), feeds.SNAPSHOT_SIZE)
+            self.assertGreaterEqual(feeds.window_size(cat_key), feeds.feed_size(cat_key))
+
+    def test_children_without_snapshot_are_reported(self):
+        builder = self.make_builder()
+
+        self.assertEqual(builder.missing_children('c1'), ['f2', 'f3'])
+        with self.assertRaises(ValueError):
+            builder.build('c1')
+        self.assertEqual(self.store, {})
+
+    def test_snapshots_saved_by_earlier_pass_are_loaded(self):
+        builder = self.make_builder()
+        for cat_id in ['f4', 'f3', 'f2']:
+            builder.build(cat_id)
+
+        builder = self.make_builder()
+        self.assertEqual(builder.missing_children('c1'), [])
+        self.assertEqual(len(builder.build('c1').items), 30)
@@ -0,0 +1,137 @@
+import datetime
+import itertools
+import unittest
+
+from google.appengine.ext import ndb
+from mock import Mock, patch
+
+import dao
+import flow
+import staticstorage
+import taskmaster
+from models import TorrentFingerprint
+from test_dao import FORUM_KEY, index_entry, write_torrent
+from test_models import DatastoreTestCase
+
+
+class FilterNewEntriesTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(FilterNewEntriesTestCase, self).setUp()
+        self.dt = datetime.datetime(2020, 1, 1, 12, 0)
+        self.later = self.dt + datetime.timedelta(hours=1)
+        self.torrent = write_torrent(index_entry(1, self.dt))
+
+    def test_old_entries_are_skipped(self):
+        to_import, num_bumped = flow.filter_new_entries([index_entry(1, self.dt), index_entry(2, self.dt)])
+
+        self.assertEqual(to_import, [])
+        self.assertEqual(num_bumped, 0)
+
+    def test_unknown_torrents_are_imported(self):
+        entry = index_entry(2, self.later)
+
+        to_import, num_bumped = flow.filter_new_entries([entry])
+
+        self.assertEqual(to_import, [entry])
+        self.assertEqual(num_bumped, 0)
+        self.assertNotIn('previous_key', entry)
+
+    def test_bumped_torrents_only_get_dt_updated(self):
+        to_import, num_bumped = flow.filter_new_entries([index_entry(1, self.later)])
+
+        self.assertEqual(to_import, [])
+        self.assertEqual(num_bumped, 1)
+        self.assertEqual(self.torrent.key.get().dt, self.later)
+
+    def test_changed_torrents_are_imported_with_previous_key(self):
+        entry = index_entry(1, self.later, title='New title')
+
+        to_import, num_bumped = flow.filter_new_entries([entry])
+
+        self.assertEqual(to_import, [entry])
+        self.assertEqual(num_bumped, 0)
+        self.assertEqual(entry['previous_key'], self.torrent.key)
+        self.assertEqual(self.torrent.key.get().dt, self.dt)
+
+    def test_moved_torrents_are_imported(self):
+        entry = index_entry(1, self.later, forum_id=3)
+
+        to_import, _ = flow.filter_new_entries([entry])
+
+        self.assertEqual(to_import, [entry])
+        self.assertEqual(entry['previous_key'].parent(), FORUM_KEY)
+        self.assertIsNotNone(TorrentFingerprint.get_by_id(1))
+
+
+class MapRebuildFlagTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(MapRebuildFlagTestCase, self).setUp()
+        dao.CachedPersistentValue._local.clear()
+        self.flag = dao.CachedPersistentValue('map_rebuild_flag', local=True)
+        patcher = patch('flow.taskmaster.add_map_rebuild_task')
+        self.add_task = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pending_rebuild_is_not_requested_again(self):
+        flow.enqueue_map_rebuild_if_needed()
+        flow.enqueue_map_rebuild_if_needed()
+
+        self.assertEqual(self.add_task.call_count, 1)
+
+    def test_stale_flag_does_not_suppress_rebuild(self):
+        self.flag.put(datetime.datetime.utcnow() - flow.MAP_REBUILD_TIMEOUT - datetime.timedelta(minutes=1))
+
+        flow.enqueue_map_rebuild_if_needed()
+
+        self.assertEqual(self.add_task.call_count, 1)
+        self.assertGreater(self.flag.get(), datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+
+    def test_flag_left_by_older_version_does_not_suppress_rebuild(self):
+        self.flag.put(True)
+
+        flow.enqueue_map_rebuild_if_needed()
+
+        self.assertEqual(self.add_task.call_count, 1)
+
+
+class BuildFeedTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(BuildFeedTestCase, self).setUp()
+        self.store = staticstorage.MemoryStorage()
+        self.patches = [patch('flow.staticstorage.get_storage', return_value=self.store),
+                        patch('feeds.get_app_url', return_value='http://localhost/'),
+                        patch('flow.taskmaster.add_feed_build_task')]
+        for p in self.patches:
+            p.start()
+
+        keys = [ndb.Key(pairs=FORUM_KEY.pairs()[:n]) for n in (1, 2, 3)]
+        dao.write_multi([dao.make_category(key, key.id()) for key in keys])
+        self.dt = datetime.datetime(2020, 1, 1, 12, 0)
+        write_torrent(index_entry(1, self.dt))
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        super(BuildFeedTestCase, self).tearDown()
+
+    def test_children_without_feed_are_built_first(self):
+        num_built = flow.build_feed(taskmaster.pack_payload((['r0'], 1, self.dt, 0)))
+
+        self.assertEqual(num_built, 3)
+        self.assertEqual([s.key.id() for s in dao.get_feed_snapshots(['f2', 'c1', 'r0'])], ['f2', 'c1', 'r0'])
+        self.assertFalse(taskmaster.add_feed_build_task.called)
+
+    def test_budget_is_checked_between_subcategories(self):
+        clock = itertools.count(0, flow.FEED_BUILD_TIME_BUDGET / 4.5)      # Time is up after 4 loop passes
+        with patch('flow.time', Mock(time=Mock(side_effect=clock))):
+            num_built = flow.build_feed(taskmaster.pack_payload((['r0'], 1, self.dt, 3)))
+
+        self.assertEqual(num_built, 2)
+        taskmaster.add_feed_build_task.assert_called_once_with(['r0'], 1, self.dt, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
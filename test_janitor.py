@@ -0,0 +1,91 @@
+import datetime
+import itertools
+import unittest
+
+from mock import Mock, patch
+
+import dao
+from janitor import Janitor
+from test_dao import index_entry, write_torrent
+from test_models import DatastoreTestCase
+
+
+class JanitorTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(JanitorTestCase, self).setUp()
+        self.patches = [patch('janitor.feeds.window_size', return_value=2),
+                        patch('janitor.taskmaster.add_cleanup_task')]
+        self.window_size, self.add_cleanup_task = [p.start() for p in self.patches]
+
+        old_dt = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+        self.torrents = [write_torrent(index_entry(tid, old_dt + datetime.timedelta(hours=tid)))
+                         for tid in range(1, 7)]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        super(JanitorTestCase, self).tearDown()
+
+    def remaining_ids(self):
+        return sorted(t.key.id() for t in self.torrents if t.key.get())
+
+    def test_torrents_in_feed_window_are_kept(self):
+        rv = Janitor(retention_days=30).run()
+
+        self.assertEqual(rv['deleted'], 4)
+        self.assertTrue(rv['finished'])
+        self.assertEqual(self.remaining_ids(), [5, 6])
+        self.assertEqual(dao.get_cleanup_state(), (None, None))
+        self.assertFalse(self.add_cleanup_task.called)
+
+    def test_deleted_torrents_are_subtracted_from_counters(self):
+        dao.update_category_counters([(t.key.parent(), 1, t.nbytes) for t in self.torrents])
+
+        Janitor(retention_days=30).run()
+
+        self.assertEqual(dao.get_category_counters(['r0', 'f2']), [(2, 2048), (2, 2048)])
+
+    def test_run_stops_at_time_budget(self):
+        with patch('janitor.time', Mock(time=Mock(side_effect=itertools.count(0, 0.6)))):
+            rv = Janitor(retention_days=30, time_budget=1, batch_size=2).run()
+
+        self.assertEqual(rv['deleted'], 2)
+        self.assertFalse(rv['finished'])
+        self.assertEqual(self.remaining_ids(), [3, 4, 5, 6])
+        cursor, cutoff = dao.get_cleanup_state()
+        self.assertIsNotNone(cutoff)
+        self.add_cleanup_task.assert_called_once_with(cursor)
+
+    def test_continuation_resumes_from_cursor(self):
+        with patch('janitor.time', Mock(time=Mock(side_effect=itertools.count(0, 0.6)))):
+            Janitor(retention_days=30, time_budget=1, batch_size=2).run()
+            cursor = self.add_cleanup_task.call_args[0][0]
+            rv = Janitor(retention_days=30, time_budget=1, batch_size=2).run(cursor)
+
+        self.assertEqual(rv['deleted'], 2)
+        self.assertEqual(self.remaining_ids(), [5, 6])
+
+    def test_stale_continuation_is_skipped(self):
+        with patch('janitor.time', Mock(time=Mock(side_effect=itertools.count(0, 0.6)))):
+            Janitor(retention_days=30, time_budget=1, batch_size=2).run()
+        state = dao.get_cleanup_state()
+
+        rv = Janitor(retention_days=30).run('stale cursor')
+
+        self.assertEqual(rv['deleted'], 0)
+        self.assertEqual(dao.get_cleanup_state(), state)
+        self.assertEqual(self.remaining_ids(), [3, 4, 5, 6])
+
+    def test_concurrent_run_is_skipped(self):
+        dao.acquire_cleanup_lock(60)
+
+        rv = Janitor(retention_days=30).run()
+
+        self.assertEqual(rv['deleted'], 0)
+        self.assertEqual(len(self.remaining_ids()), 6)
+        self.assertFalse(self.add_cleanup_task.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
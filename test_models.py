@@ -6,8 +6,10 @@ from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
 from google.appengine.ext import testbed
 from google.appengine.datastore import datastore_stub_util
+from google.appengine.api import memcache
 
-from models import Account, Torrent
+from dao import CachedPersistentValue
+from models import Account, Torrent, PersistentScalarValue
 
 
 class DatastoreTestCase(unittest.TestCase):
@@ -115,3 +117,37 @@ class TorrentTestCase(DatastoreTestCase):
         rv = Torrent.get_latest_dt()
 
         self.assertEqual(rv, now)
+
+
+class CachedPersistentValueTestCase(DatastoreTestCase):
+
+    def setUp(self):
+        super(CachedPersistentValueTestCase, self).setUp()
+        CachedPersistentValue._local.clear()
+        CachedPersistentValue._local_state.update(version=None, checked=0)
+
+    def test_local_value_is_served_without_memcache(self):
+        CachedPersistentValue.revalidate_local()
+        CachedPersistentValue('name', local=True).put('value')
+        memcache.flush_all()
+        PersistentScalarValue.query().get().key.delete()
+
+        self.assertEqual(CachedPersistentValue('name', local=True).get(), 'value')
+        self.assertIsNone(CachedPersistentValue('name').get())
+
+    def test_local_cache_is_dropped_when_version_changes(self):
+        CachedPersistentValue('name', local=True).put('old')
+        CachedPersistentValue('name', local=True).get()
+        memcache.set('cts.name', 'new')                     # Put on another instance
+        memcache.incr(CachedPersistentValue.VERSION_KEY)
+        CachedPersistentValue._local_state['checked'] = 0
+
+        self.assertEqual(CachedPersistentValue('name', local=True).get(), 'new')
+
+    def test_get_multi(self):
+        CachedPersistentValue('a').put(1)
+        CachedPersistentValue('b').put(2)
+        memcache.delete('cts.b')
+
+        self.assertEqual(CachedPersistentValue.get_multi(['a', 'b', 'c']), [1, 2, None])
+        self.assertEqual(memcache.get('cts.b'), 2)
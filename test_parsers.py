@@ -1,7 +1,9 @@
 # coding: utf-8
 import unittest
 
-from parsing import Parser, make_tree
+from lxml import etree
+
+from parsing import Parser, make_tree, sanitize
 
 
 SAMPLE_ROW = '''
@@ -46,6 +48,13 @@ class ParserTestCase(unittest.TestCase):
 
         self.assertEqual(tid, 'Blah')
 
+    def test_index_title_decodes_windows_1251_bytes(self):
+        p = Parser()
+        html = u'<td class="t-title"><div class="t-title"><a>Фильм</a></div></td>'.encode('windows-1251')
+        title = p.index_title(make_tree(html))
+
+        self.assertEqual(title, u'Фильм')
+
     def test_index_timestamp_returns_timestamp(self):
         p = Parser()
         html = '<tr><td></td><td><u>123456</u></td></tr>'
@@ -59,3 +68,32 @@ class ParserTestCase(unittest.TestCase):
         nbytes = p.index_nbytes(make_tree(html))
 
         self.assertEqual(nbytes, 123456)
+
+
+class SanitizeTestCase(unittest.TestCase):
+
+    def sanitized(self, html):
+        elem = make_tree(html).find('.//body/*')
+        return etree.tostring(sanitize(elem), encoding='utf-8')
+
+    def test_removes_inline_styles(self):
+        html = '<div><span style="color: red" class="post-b">Text</span></div>'
+
+        self.assertEqual(self.sanitized(html), '<div><span class="post-b">Text</span></div>')
+
+    def test_collapses_whitespace(self):
+        html = '<div>  Some \n\n text  <br/>\n  more   </div>'
+
+        self.assertEqual(self.sanitized(html), '<div> Some text <br/> more </div>')
+
+    def test_keeps_preformatted_text(self):
+        html = '<div><pre>a\n  b</pre></div>'
+
+        self.assertEqual(self.sanitized(html), '<div><pre>a\n  b</pre></div>')
+
+    def test_simplifies_spoilers(self):
+        html = ('<div><div class="sp-wrap"><div class="sp-body" title="Screenshots">'
+                '<img src="1.jpg"/></div></div></div>')
+
+        self.assertEqual(self.sanitized(html),
+                         '<div><details><summary>Screenshots</summary><img src="1.jpg"/></details></div>')
@@ -0,0 +1,117 @@
+# coding: utf-8
+import collections
+import multiprocessing
+import time
+import unittest
+
+from mock import patch
+
+import parsing
+import pipeline
+from pipeline import QueuedTask, Runner, SyncExecutor, ThreadExecutor, ProcessParser
+
+
+FakeTask = collections.namedtuple('FakeTask', 'url payload name eta_posix')
+
+
+def fan_out(payload):
+    """Stage enqueueing named leaf tasks, two of them with the same name"""
+    pipeline._collector.add([FakeTask('/leaf', str(i), 'leaf-{}'.format(min(i, 1)), 0) for i in range(3)])
+
+
+def leaf(payload):
+    pass
+
+
+def fail(payload):
+    raise ValueError('Task failed')
+
+
+STAGES = collections.OrderedDict([('/fan_out', fan_out), ('/leaf', leaf), ('/fail', fail)])
+
+
+class ParseArgsTestCase(unittest.TestCase):
+
+    def test_sync_executor_by_default(self):
+        sdk_path, options = pipeline.parse_args(['~/sdk'])
+
+        self.assertEqual(sdk_path, '~/sdk')
+        self.assertEqual(options.executor, 'sync')
+
+    def test_parse_workers_need_no_shared_datastore(self):
+        for argv in [['~/sdk', '--parse-workers', '2'], ['~/sdk', '--parse-workers', '2', '--sqlite-path', 'db']]:
+            options = pipeline.parse_args(argv)[1]
+
+            self.assertEqual(options.parse_workers, 2)
+            self.assertIsNone(options.datastore_path)
+
+    def test_tasks_do_not_run_in_processes(self):
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            pipeline.parse_args(['~/sdk', '--executor', 'process'])
+
+    def test_sdk_path_is_required(self):
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            pipeline.parse_args(['--executor', 'thread'])
+
+
+class RunnerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(pipeline, 'STAGES', STAGES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pipeline.install_collector()
+
+    def run_pipeline(self, executor, tasks):
+        try:
+            return Runner(executor).run(tasks)
+        finally:
+            executor.close()
+
+    def test_spawned_tasks_are_run_and_deduped(self):
+        for executor in [SyncExecutor(), ThreadExecutor(2)]:
+            stats = self.run_pipeline(executor, [QueuedTask('/fan_out', None, None, 0)])
+
+            self.assertEqual(stats['/fan_out'].tasks, 1)
+            self.assertEqual(stats['/leaf'].tasks, 2)
+
+    def test_failed_tasks_are_counted(self):
+        with patch('pipeline.logging'):
+            stats = self.run_pipeline(SyncExecutor(), [QueuedTask('/fail', None, None, 0)] * 2)
+
+        self.assertEqual(stats['/fail'].tasks, 2)
+
+    def test_deferred_tasks_wait_for_eta(self):
+        started = time.time()
+        self.run_pipeline(SyncExecutor(), [QueuedTask('/leaf', None, None, started + 0.2)])
+
+        self.assertGreaterEqual(time.time() - started, 0.2)
+
+    def test_batches_are_runs_of_same_url(self):
+        pending = collections.deque(QueuedTask(url, None, None, 0) for url in ['/leaf', '/leaf', '/fail', '/leaf'])
+
+        self.assertEqual(len(pipeline.next_batch(pending)), 2)
+        self.assertEqual(len(pipeline.next_batch(pending)), 1)
+        self.assertEqual(len(pending), 1)
+
+
+class ProcessParserTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = multiprocessing.Pool(1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+
+    def test_parse_errors_are_raised_in_caller(self):
+        html = (u'<table class="message"><tr><td>'
+                u'<div class="mrg_16">Тема не найдена</div>'
+                u'</td></tr></table>')
+
+        with self.assertRaises(parsing.SkipTorrent):
+            ProcessParser(self.pool).parse_torrent_page(html.encode('windows-1251'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import sys
+import time
+import unittest
+
+from mock import Mock, patch
+
+import profiler
+
+
+def busy(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def test_collapse_stack_starts_with_outermost_frame(self):
+        stack = profiler.collapse_stack(sys._getframe())
+
+        self.assertTrue(stack.endswith('test_profiler.py:test_collapse_stack_starts_with_outermost_frame'))
+
+    def test_profiler_samples_current_thread(self):
+        prof = profiler.SamplingProfiler(interval=0.001)
+        prof.start()
+        busy(0.05)
+        prof.stop()
+
+        self.assertTrue(prof.samples)
+        self.assertIn('test_profiler.py:busy', prof.collapsed())
+
+    def test_should_profile_with_header(self):
+        request = Mock(path='/task/torrent', headers={'X-Profile': '1'})
+
+        self.assertTrue(profiler.should_profile(request))
+
+    def test_should_not_profile_public_paths(self):
+        request = Mock(path='/search', headers={'X-Profile': '1'})
+
+        self.assertFalse(profiler.should_profile(request))
+
+    @patch.dict('os.environ', {'PROFILE_SAMPLE_RATE': '1'})
+    def test_should_profile_sampled(self):
+        request = Mock(path='/task/build_feed', headers={})
+
+        self.assertTrue(profiler.should_profile(request))
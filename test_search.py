@@ -0,0 +1,120 @@
+# coding: utf-8
+import unittest
+
+from mock import Mock
+
+import search
+
+
+class TokenizeTestCase(unittest.TestCase):
+
+    def test_tokens_are_normalized_and_unique(self):
+        tokens = search.tokenize(u'Ёжик в тумане / Hedgehog in the Fog (1975) ЁЖИК')
+
+        self.assertEqual(tokens, [u'ежик', u'тумане', u'hedgehog', u'in', u'the', u'fog', u'1975'])
+
+    def test_short_tokens_are_dropped_except_numbers(self):
+        self.assertEqual(search.tokenize(u'a b 2 cd'), [u'2', u'cd'])
+
+    def test_document_tokens_skip_root_category(self):
+        tokens = search.document_tokens(u'Title', ['r0', 'c1', 'f2'])
+
+        self.assertEqual(tokens, [u'title', 'cat:c1', 'cat:f2'])
+
+    def test_query_tokens_with_category(self):
+        self.assertEqual(search.query_tokens(u'Title', 'f2'), [u'title', 'cat:f2'])
+        self.assertEqual(search.query_tokens(u'Title', 'r0'), [u'title'])
+
+
+class PostingsTestCase(unittest.TestCase):
+
+    def test_add_posting_keeps_list_sorted_and_unique(self):
+        postings = search.make_postings()
+        for tid in [5, 1, 3, 5, 7]:
+            search.add_posting(postings, tid)
+
+        self.assertEqual(list(postings), [1, 3, 5, 7])
+
+    def test_add_posting_drops_oldest_beyond_limit(self):
+        postings = search.make_postings()
+        for tid in range(1, 13):
+            search.add_posting(postings, tid, limit=10)
+
+        self.assertEqual(list(postings), range(3, 13))
+
+    def test_postings_roundtrip_through_string(self):
+        postings = search.make_postings()
+        search.add_posting(postings, 2 ** 31)
+
+        self.assertEqual(search.make_postings(postings.tostring()), postings)
+
+    def test_intersect_newest(self):
+        a = search.make_postings()
+        b = search.make_postings()
+        for tid in range(1, 100):
+            search.add_posting(a, tid)
+            if tid % 3 == 0:
+                search.add_posting(b, tid)
+
+        self.assertEqual(search.intersect_newest([a, b], 3), [99, 96, 93])
+        self.assertEqual(search.intersect_newest([a, search.make_postings()], 3), [])
+
+    def test_postings_are_sharded(self):
+        for token in ['cat:f2', u'ёлки']:
+            shards = search.posting_shards(token)
+
+            self.assertEqual(len(set(shards)), search.POSTING_SHARDS)
+            self.assertIn(search.posting_shard(token, 11), shards)
+            self.assertNotEqual(search.posting_shard(token, 11), search.posting_shard(token, 12))
+
+    def test_merge_postings(self):
+        shards = [search.make_postings() for _ in range(3)]
+        for tid in range(10):
+            search.add_posting(shards[tid % 3], tid)
+
+        self.assertEqual(list(search.merge_postings(shards)), range(10))
+
+
+class MostRecentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.torrents = dict((tid, Mock(tid=tid, dt=tid)) for tid in range(1, 20))
+
+    def load(self, tids):
+        return [self.torrents[tid] for tid in tids if tid in self.torrents]
+
+    def test_refills_until_k_matches(self):
+        for tid in range(5, 20):
+            del self.torrents[tid]
+
+        rv = search.most_recent(reversed(range(1, 20)), self.load, 3)
+
+        self.assertEqual([t.tid for t in rv], [4, 3, 2])
+
+    def test_bumped_torrent_is_ordered_by_dt(self):
+        self.torrents[1].dt = 100
+
+        rv = search.most_recent([3, 2, 1], self.load, 2)
+
+        self.assertEqual([t.tid for t in rv], [1, 3])
+
+    def test_candidates_are_limited(self):
+        load = Mock(side_effect=self.load)
+
+        search.most_recent(reversed(range(1, 20)), load, 2)
+
+        load.assert_called_once_with([19, 18, 17, 16])
+
+
+class InvertedIndexTestCase(unittest.TestCase):
+
+    def test_search_returns_newest_matches_first(self):
+        index = search.InvertedIndex()
+        index.add(1, u'Ёлки (2010) DVDRip', ['r0', 'c1', 'f2'])
+        index.add(2, u'Елки 2 (2011) DVDRip', ['r0', 'c1', 'f3'])
+        index.add(3, u'Другое кино (2011)', ['r0', 'c1', 'f2'])
+
+        self.assertEqual(index.search(u'ёлки'), [2, 1])
+        self.assertEqual(index.search(u'елки', 'f2'), [1])
+        self.assertEqual(index.search(u'2011', 'c1', k=1), [3])
+        self.assertEqual(index.search(u'нет такого'), [])
@@ -0,0 +1,223 @@
+import datetime
+import pickle
+import unittest
+
+from mock import patch
+
+import search
+import sqlitedao
+
+
+class SQLiteDAOTestCase(unittest.TestCase):
+
+    def setUp(self):
+        sqlitedao.connect(':memory:')
+        sqlitedao.CachedPersistentValue._cache.clear()
+        self.cat_key = sqlitedao.category_key_from_tuples([(0, 'r', 'Root'), (1, 'c', 'Cat'), (2, 'f', 'Forum')])
+        self.other_key = sqlitedao.category_key_from_tuples([(0, 'r', 'Root'), (10, 'c', 'Other')])
+        self.dt = datetime.datetime(2016, 2, 19, 10, 25, 21)
+
+    def make_torrent(self, tid, cat_key, hours=0):
+        fields = {
+            'id': tid,
+            'title': u'Torrent {}'.format(tid),
+            'btih': 'ABCDEF',
+            'dt': self.dt + datetime.timedelta(hours=hours),
+            'nbytes': 1024,
+            'forum_id': int(cat_key.id()[1:]),
+        }
+        return sqlitedao.make_torrent(cat_key, fields)
+
+    def test_torrent_is_stored(self):
+        torrent = self.make_torrent(1, self.cat_key)
+        sqlitedao.write_multi([torrent])
+
+        stored = sqlitedao.get_from_key(torrent.key)
+
+        self.assertEqual(stored, torrent)
+
+    def test_description_is_stored_separately(self):
+        torrent = self.make_torrent(1, self.cat_key)
+        desc = sqlitedao.make_torrent_description(torrent.key, u'<b>Description</b>')
+        sqlitedao.write_multi([torrent, desc])
+
+        self.assertEqual(sqlitedao.get_torrent_description(torrent.key), u'<b>Description</b>')
+        self.assertFalse(hasattr(sqlitedao.latest_torrents(1)[0], 'description'))
+
+    def test_get_fingerprints_keeps_order(self):
+        torrent = self.make_torrent(1, self.cat_key)
+        sqlitedao.write_multi([torrent])
+
+        rv = sqlitedao.get_fingerprints([2, 1])
+
+        self.assertIsNone(rv[0])
+        self.assertEqual(rv[1], sqlitedao.make_fingerprint(torrent))
+
+    def test_update_torrent_dts(self):
+        torrent = self.make_torrent(1, self.cat_key)
+        sqlitedao.write_multi([torrent])
+        new_dt = self.dt + datetime.timedelta(days=1)
+
+        sqlitedao.update_torrent_dts([(torrent.key, new_dt)])
+
+        self.assertEqual(sqlitedao.latest_torrent_dt(), new_dt)
+
+    def test_category_is_stored(self):
+        cat = sqlitedao.make_category(self.cat_key, u'Forum')
+        sqlitedao.write_multi([cat])
+
+        self.assertEqual(self.cat_key.get(), cat)
+
+    def test_latest_torrents_returns_subtree_newest_first(self):
+        parent_key = self.cat_key.parent()
+        torrents = [self.make_torrent(i, self.cat_key, hours=i) for i in range(5)]
+        torrents.append(self.make_torrent(100, self.other_key, hours=100))
+        sqlitedao.write_multi(torrents)
+
+        rv = sqlitedao.latest_torrents(3, parent_key)
+
+        self.assertEqual([t.key.id() for t in rv], [4, 3, 2])
+
+    def test_latest_torrents_does_not_match_path_prefix(self):
+        similar_key = sqlitedao.category_key_from_tuples([(0, 'r', 'Root'), (1, 'c', 'Cat'), (22, 'f', 'Forum')])
+        sqlitedao.write_multi([self.make_torrent(1, similar_key)])
+
+        rv = sqlitedao.latest_torrents(10, self.cat_key)
+
+        self.assertEqual(rv, [])
+
+    def test_latest_torrent_dt_defaults_to_epoch(self):
+        self.assertEqual(sqlitedao.latest_torrent_dt(), datetime.datetime.utcfromtimestamp(0))
+
+    def test_torrent_keys_since_dt(self):
+        sqlitedao.write_multi([self.make_torrent(i, self.cat_key, hours=i) for i in range(5)])
+
+        keys = sqlitedao.torrent_keys_since_dt(self.dt + datetime.timedelta(hours=2))
+
+        self.assertEqual(sorted(k.id() for k in keys), [3, 4])
+        self.assertEqual(keys[0].parent(), self.cat_key)
+
+    def test_account_context_saves_changes(self):
+        sqlitedao.make_account('user', 'password', 123).put()
+
+        with sqlitedao.account_context() as account:
+            account.cookies = {'name': 'value'}
+
+        self.assertEqual(sqlitedao.get_account().cookies, {'name': 'value'})
+
+    def test_cached_persistent_value_roundtrip(self):
+        sqlitedao.set_last_feed_rebuild_dt(self.dt)
+        sqlitedao.CachedPersistentValue._cache.clear()
+
+        self.assertEqual(sqlitedao.get_last_feed_rebuild_dt(), self.dt)
+
+    def test_persistent_values_are_not_cached_in_other_processes(self):
+        value = sqlitedao.CachedPersistentValue('name')
+        value.put('parent')
+        with patch('sqlitedao.os.getpid', return_value=-1):
+            value.put('child')
+
+        self.assertEqual(value.get(), 'parent')
+        with patch('sqlitedao.os.getpid', return_value=-1):
+            self.assertEqual(value.get(), 'child')
+
+    def test_search_torrents_filters_by_category_and_stale_titles(self):
+        torrents = [self.make_torrent(1, self.cat_key), self.make_torrent(2, self.other_key, hours=1)]
+        sqlitedao.write_multi(torrents)
+        for torrent in torrents:
+            cat_ids = [key.id() for key in sqlitedao.get_all_parents(torrent.key)]
+            sqlitedao.add_to_search_index(torrent.key.id(), search.document_tokens(u'Old title', cat_ids))
+            sqlitedao.add_to_search_index(torrent.key.id(), search.document_tokens(torrent.title, cat_ids))
+
+        self.assertEqual([t.key.id() for t in sqlitedao.search_torrents(u'torrent')], [2, 1])
+        self.assertEqual([t.key.id() for t in sqlitedao.search_torrents(u'torrent', 'c1')], [1])
+        self.assertEqual(sqlitedao.search_torrents(u'old title'), [])
+
+    def test_search_torrents_skips_deleted_ids_and_orders_by_dt(self):
+        torrents = [self.make_torrent(tid, self.cat_key, hours=10 if tid == 1 else tid) for tid in range(1, 6)]
+        sqlitedao.write_multi(torrents)
+        cat_ids = [key.id() for key in sqlitedao.get_all_parents(self.cat_key)]
+        for tid in range(1, 20):
+            sqlitedao.add_to_search_index(tid, search.document_tokens(u'Torrent', cat_ids))
+
+        self.assertEqual([t.key.id() for t in sqlitedao.search_torrents(u'torrent', k=3)], [1, 5, 4])
+
+    def test_feed_snapshots_keep_order(self):
+        sqlitedao.save_feed_snapshot('f2', u'Forum', [[1, u'Torrent 1', 'ABCDEF', 1455877521.0, 1024, 2]])
+
+        snapshots = sqlitedao.get_feed_snapshots(['c1', 'f2'])
+
+        self.assertIsNone(snapshots[0])
+        self.assertEqual(snapshots[1].title, u'Forum')
+        self.assertEqual(snapshots[1].items, [[1, u'Torrent 1', 'ABCDEF', 1455877521.0, 1024, 2]])
+
+    def test_forum_category_keys(self):
+        sqlitedao.write_multi([sqlitedao.make_forum_category(2, self.cat_key)])
+
+        self.assertEqual(sqlitedao.get_forum_category_keys([3, 2]), [None, self.cat_key])
+
+    def test_category_counters_roll_up_to_parents(self):
+        sqlitedao.update_category_counters([(self.cat_key, 1, 100), (self.other_key, 1, 50)])
+        sqlitedao.update_category_counters([(self.other_key, 1, 10), (self.cat_key, -1, -100)])
+
+        self.assertEqual(sqlitedao.get_category_counters(['r0', 'c1', 'f2', 'c10', 'f3']),
+                         [(2, 60), (0, 0), (0, 0), (2, 60), (0, 0)])
+
+    def test_torrents_page_stops_at_cutoff(self):
+        torrents = [self.make_torrent(tid, self.cat_key, hours=tid // 2) for tid in range(1, 8)]
+        sqlitedao.write_multi(torrents)
+        cutoff = self.dt + datetime.timedelta(hours=2)
+
+        page, cursor, more = sqlitedao.torrents_page(cutoff, None, 3)
+        self.assertEqual([t.key.id() for t in page], [1, 2, 3])
+        self.assertTrue(more)
+        page, cursor, more = sqlitedao.torrents_page(cutoff, cursor, 3)
+        self.assertEqual([t.key.id() for t in page], [4, 5])
+        self.assertFalse(more)
+
+    def import_torrent(self, tid, cat_key, previous_key=None):
+        torrent = self.make_torrent(tid, cat_key)
+        sqlitedao.count_torrent(torrent, sqlitedao.make_torrent_description(torrent.key, u'Description'), previous_key)
+        return torrent
+
+    def test_retried_and_moved_imports_are_counted_once(self):
+        old = self.import_torrent(1, self.cat_key)
+        self.import_torrent(1, self.cat_key)
+        moved = self.import_torrent(1, self.other_key, old.key)
+
+        self.assertEqual(sqlitedao.get_category_counters(['r0', 'f2', 'c10']), [(1, 1024), (0, 0), (1, 1024)])
+        self.assertEqual(sqlitedao.get_torrent_description(moved.key), u'Description')
+
+    def test_retried_delete_is_subtracted_once(self):
+        torrents = [self.import_torrent(tid, self.cat_key) for tid in range(1, 4)]
+
+        sqlitedao.delete_counted_torrents([t.key for t in torrents[:2]])
+        sqlitedao.delete_counted_torrents([t.key for t in torrents[:2]])
+
+        self.assertEqual(sqlitedao.get_category_counters(['r0', 'f2']), [(1, 1024), (1, 1024)])
+        self.assertIsNone(sqlitedao.get_from_key(torrents[0].key))
+
+    def test_stored_torrents_are_counted_once_after_reset(self):
+        legacy = self.make_torrent(1, self.cat_key)
+        sqlitedao.write_multi([legacy])     # Stored before torrents were marked
+        keys = [legacy.key, self.import_torrent(2, self.cat_key).key]
+        reset_dt = sqlitedao.reset_category_counters()
+        self.import_torrent(2, self.cat_key)
+
+        self.assertEqual(sqlitedao.count_stored_torrents(keys, reset_dt), 1)
+        self.assertEqual(sqlitedao.count_stored_torrents(keys, reset_dt), 0)
+
+        self.assertEqual(sqlitedao.get_category_counters(['r0', 'f2']), [(2, 2048), (2, 2048)])
+
+    def test_reset_category_counters(self):
+        sqlitedao.update_category_counters([(self.cat_key, 1, 100)])
+
+        sqlitedao.reset_category_counters()
+
+        self.assertEqual(sqlitedao.get_category_counters(['r0', 'f2']), [(0, 0), (0, 0)])
+
+    def test_no_descriptions_to_move(self):
+        self.assertEqual(sqlitedao.move_descriptions_page(), (0, None, False))
+
+    def test_keys_survive_pickling(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.cat_key)), self.cat_key)
@@ -0,0 +1,27 @@
+import unittest
+
+import staticstorage
+
+
+class GCSStorageTestCase(unittest.TestCase):
+
+    def test_url_for_path_uses_bucket_name_as_is(self):
+        storage = staticstorage.GCSStorage('app.appspot.com')
+
+        self.assertEqual(storage.url_for_path('/feeds/atom.xml'),
+                         'https://storage.googleapis.com/app.appspot.com/feeds/atom.xml')
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+
+    def test_put_strips_slashes(self):
+        storage = staticstorage.MemoryStorage()
+
+        storage.put('/feeds/r0.xml', '<rss/>', 'application/rss+xml')
+
+        self.assertEqual(storage.objects, {'feeds/r0.xml': ('<rss/>', 'application/rss+xml')})
+        self.assertEqual(storage.url_for_path('/feeds/r0.xml'), 'memory:///feeds/r0.xml')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
+import datetime
 import unittest
 from google.appengine.ext import testbed
 from mock import Mock, patch
 
+import taskmaster
 from taskmaster import TaskMaster
 
 
@@ -41,3 +43,41 @@ class TaskMasterTestCase(unittest.TestCase):
 
         tasks = self.taskqueue_stub.get_filtered_tasks()
         self.assertEqual(len(tasks), len(fake_entries))
+
+
+class TaskNamesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_taskqueue_stub()
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.dt = datetime.datetime(2016, 2, 19, 10, 25, 21)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_torrent_task_name_is_deterministic(self):
+        entry = {'id': 123456, 'dt': self.dt}
+
+        self.assertEqual(taskmaster.torrent_task_name(entry), 'torrent-123456-1455877521')
+
+    def test_feed_task_name_is_deterministic(self):
+        self.assertEqual(taskmaster.feed_task_name(self.dt, 12), 'feeds-1455877521-12')
+
+    def test_feed_task_parts_with_same_remaining_count_are_added(self):
+        taskmaster.add_feed_build_task(['f2', 'c1', 'r0'], self.dt, self.dt)
+        taskmaster.add_feed_build_task(['f3', 'c1', 'r0'], self.dt, self.dt, part=1)
+        taskmaster.add_feed_build_task(['f3', 'c1', 'r0'], self.dt, self.dt, part=1)     # Retried part
+
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEqual(sorted(t.name for t in tasks), ['feeds-1455877521-0', 'feeds-1455877521-1'])
+
+    def test_add_torrent_tasks_skips_duplicates(self):
+        entries = [{'id': i, 'dt': self.dt} for i in range(5)]
+
+        taskmaster.add_torrent_tasks(entries)
+        taskmaster.add_torrent_tasks(entries)
+
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEqual(len(tasks), len(entries))
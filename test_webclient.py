@@ -1,3 +1,4 @@
+import os
 import unittest
 from google.appengine.ext import testbed
 from mock import Mock, MagicMock, patch
@@ -5,11 +6,18 @@ import requests
 from betamax import Betamax
 from betamax.fixtures.unittest import BetamaxTestCase
 
-from webclient import BaseWebClient, WebClient, Error, NotLoggedIn, TIMEOUTS
+import Queue
+import time
+from collections import OrderedDict
 
+from webclient import BaseWebClient, RutrackerWebClient, Error, NotLoggedIn, TIMEOUTS, FirstPostWatcher, CircuitBreaker, \
+    CircuitOpen, RequestError, RequestTimeout, LatencyTracker, READ_TIMEOUT_BOUNDS
+
+
+CASSETTE_DIR = '../cassettes'
 
 with Betamax.configure() as config:
-    config.cassette_library_dir = '../cassettes'
+    config.cassette_library_dir = CASSETTE_DIR
 
 
 class URLFetchTestCase(unittest.TestCase):
@@ -18,6 +26,7 @@ class URLFetchTestCase(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_urlfetch_stub()
+        self.testbed.init_memcache_stub()
 
         self.session = MagicMock()
 
@@ -77,6 +86,14 @@ class BaseWebClientTestCase(URLFetchTestCase):
 
         self.assertIs(rv, None)
 
+    def test_get_content_returns_raw_bytes(self):
+        mock_response = MagicMock(headers={'content-type': 'text/html'}, content='\xd4\xe8\xeb\xfc\xec')
+        wc = BaseWebClient(None)
+
+        rv = wc.get_content(mock_response)
+
+        self.assertEqual(rv, '\xd4\xe8\xeb\xfc\xec')
+
     def test_user_request_updates_session_cookies(self):
         cookies = {'test name': 'test value'}
         mock_acc = Mock(cookies=cookies)
@@ -98,29 +115,321 @@ class BaseWebClientTestCase(URLFetchTestCase):
         self.assertIs(mock_acc.cookies, cookies)
 
 
+class CircuitBreakerTestCase(URLFetchTestCase):
+
+    def setUp(self):
+        super(CircuitBreakerTestCase, self).setUp()
+        self.breaker = CircuitBreaker('test', threshold=2, open_time=60, probe_time=30)
+        self.session.request = Mock(side_effect=requests.exceptions.ConnectionError('Connection refused'))
+        self.wc = BaseWebClient(self.session, self.breaker)
+
+    def fail_requests(self, num):
+        for _ in range(num):
+            with self.assertRaises(RequestError):
+                self.wc.request('http://example.com/')
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        self.fail_requests(2)
+
+        with self.assertRaises(CircuitOpen) as cm:
+            self.wc.request('http://example.com/')
+        self.assertEqual(self.session.request.call_count, 2)
+        self.assertGreater(cm.exception.retry_after, 50)
+
+    def test_success_resets_failures(self):
+        self.fail_requests(1)
+        self.session.request = Mock(return_value=Mock(ok=True))
+        self.wc.request('http://example.com/')
+        self.session.request = Mock(side_effect=requests.exceptions.ConnectionError('Connection refused'))
+
+        self.fail_requests(1)
+        self.session.request = Mock(return_value=Mock(ok=True))
+        self.wc.request('http://example.com/')
+
+    def test_client_errors_are_not_failures(self):
+        response = Mock(ok=False, status_code=404)
+        response.raise_for_status = Mock(side_effect=requests.exceptions.HTTPError(response=response))
+        self.session.request = Mock(return_value=response)
+
+        self.fail_requests(3)
+
+    @patch('webclient.time.time')
+    def test_single_probe_closes_circuit(self, time_mock):
+        time_mock.return_value = 1000.0
+        self.fail_requests(2)
+        time_mock.return_value = 1061.0
+
+        self.assertTrue(self.breaker.before_request())
+        with self.assertRaises(CircuitOpen):
+            self.wc.request('http://example.com/')
+        self.breaker.record_success(True)
+
+        self.session.request = Mock(return_value=Mock(ok=True))
+        self.wc.request('http://example.com/')
+        self.assertFalse(self.breaker.before_request())
+
+    @patch('webclient.time.time')
+    def test_failed_probe_opens_circuit_again(self, time_mock):
+        time_mock.return_value = 1000.0
+        self.fail_requests(2)
+        time_mock.return_value = 1061.0
+
+        self.fail_requests(1)
+
+        with self.assertRaises(CircuitOpen):
+            self.wc.request('http://example.com/')
+
+
+class LatencyTrackerTestCase(unittest.TestCase):
+
+    def test_fixed_timeouts_until_enough_samples(self):
+        latencies = LatencyTracker(min_samples=3)
+        latencies.record('GET host/path', 1.0)
+
+        self.assertEqual(latencies.timeouts('GET host/path'), TIMEOUTS)
+        self.assertIsNone(latencies.percentile('GET host/path', 0.95))
+
+    def test_timeouts_follow_latency(self):
+        latencies = LatencyTracker(min_samples=3)
+        for seconds in [0.5, 1.0, 1.5, 2.0]:
+            latencies.record('GET host/path', seconds)
+
+        self.assertEqual(latencies.percentile('GET host/path', 0.5), 1.5)
+        self.assertEqual(latencies.timeouts('GET host/path'), (TIMEOUTS[0], 6.0))
+
+    def test_timeouts_are_bounded(self):
+        latencies = LatencyTracker(min_samples=1)
+        latencies.record('GET fast/path', 0.01)
+        latencies.record('GET slow/path', 60)
+
+        self.assertEqual(latencies.timeouts('GET fast/path')[1], READ_TIMEOUT_BOUNDS[0])
+        self.assertEqual(latencies.timeouts('GET slow/path')[1], READ_TIMEOUT_BOUNDS[1])
+
+    def test_timed_out_requests_are_recorded(self):
+        latencies = LatencyTracker(min_samples=1)
+
+        def request(*args, **kwargs):
+            time.sleep(0.05)
+            raise requests.exceptions.ReadTimeout('Read timed out')
+
+        wc = BaseWebClient(Mock(request=Mock(side_effect=request)), Mock(), latencies)
+
+        with self.assertRaises(RequestTimeout):
+            wc.request('http://example.com/')
+        self.assertGreaterEqual(latencies.percentile('GET example.com/', 0.5), 0.05)
+
+    def test_window_keeps_latest_samples(self):
+        latencies = LatencyTracker(window=2, min_samples=1)
+        for seconds in [10, 1, 2]:
+            latencies.record('GET host/path', seconds)
+
+        self.assertEqual(latencies.percentile('GET host/path', 1.0), 2)
+
+
+class RecordingAdapter(requests.adapters.BaseAdapter):
+    """Transport adapter answering with canned (delay, body) responses, records sent requests"""
+
+    def __init__(self, responses):
+        super(RecordingAdapter, self).__init__()
+        self.responses = list(responses)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        delay, body = self.responses.pop(0)
+        time.sleep(delay)
+        resp = requests.models.Response()
+        resp.status_code = 200
+        resp._content = body
+        resp.request = request
+        resp.url = request.url
+        return resp
+
+    def close(self):
+        pass
+
+
+class HedgedRequestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.latencies = LatencyTracker(min_samples=1)
+        self.latencies.record('GET example.com/', 0.1)
+        self.slow, self.fast = Mock(ok=True, name='slow'), Mock(ok=True, name='fast')
+        self.session = Mock(cookies=requests.cookies.RequestsCookieJar(), headers={}, adapters=OrderedDict())
+        self.wc = BaseWebClient(self.session, Mock(before_request=Mock(return_value=False)), self.latencies)
+        self.request = Mock()
+        self.attempt_sessions = []
+        for target, value in [('webclient.requests.Session', self.new_session),
+                              ('webclient._spare_sessions', Queue.LifoQueue())]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def new_session(self):
+        session = Mock(request=self.request, cookies=requests.cookies.RequestsCookieJar(), headers={})
+        self.attempt_sessions.append(session)
+        return session
+
+    def respond(self, *responses):
+        responses = list(responses)
+
+        def request(*args, **kwargs):
+            delay, response = responses.pop(0)
+            time.sleep(delay)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.request.side_effect = request
+        self.session.request = self.request
+
+    def test_slow_request_is_hedged(self):
+        self.respond((0.5, self.slow), (0, self.fast))
+
+        resp = self.wc.request('http://example.com/', hedge=True)
+
+        self.assertIs(resp, self.fast)
+        self.assertEqual(self.request.call_count, 2)
+
+    def test_fast_request_is_not_hedged(self):
+        self.respond((0, self.fast), (0, self.slow))
+
+        resp = self.wc.request('http://example.com/', hedge=True)
+
+        self.assertIs(resp, self.fast)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_hedged_request_may_win_after_error(self):
+        self.respond((0.3, requests.exceptions.ConnectionError('Connection reset')), (0.4, self.fast))
+
+        resp = self.wc.request('http://example.com/', hedge=True)
+
+        self.assertIs(resp, self.fast)
+
+    def test_error_before_hedge_delay_is_raised(self):
+        self.respond((0, requests.exceptions.ConnectionError('Connection refused')), (0, self.fast))
+
+        with self.assertRaises(RequestError):
+            self.wc.request('http://example.com/', hedge=True)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_posts_are_not_hedged(self):
+        self.respond((0.05, self.fast), (0, self.slow))
+
+        resp = self.wc.request('http://example.com/', method='POST', hedge=True)
+
+        self.assertIs(resp, self.fast)
+
+    def test_hedged_attempt_has_own_session(self):
+        self.session.cookies.set('bb_session', 'secret')
+        self.respond((0.5, self.slow), (0, self.fast))
+
+        self.wc.request('http://example.com/', hedge=True)
+
+        self.assertEqual(len(self.attempt_sessions), 1)
+        self.assertIsNot(self.attempt_sessions[0], self.session)
+        self.assertEqual(self.attempt_sessions[0].cookies.get('bb_session'), 'secret')
+
+    def test_fast_request_uses_client_session(self):
+        self.respond((0, self.fast))
+
+        self.wc.request('http://example.com/', hedge=True)
+
+        self.assertEqual(self.attempt_sessions, [])
+
+    def test_spare_sessions_are_reused(self):
+        self.respond((0.5, self.slow), (0, self.fast), (0.5, self.slow), (0, self.fast))
+
+        self.wc.request('http://example.com/', hedge=True)
+        self.wc.request('http://example.com/', hedge=True)
+
+        self.assertEqual(len(self.attempt_sessions), 1)
+
+    def test_mounted_adapters_serve_all_attempts(self):
+        adapter = RecordingAdapter([(0.5, 'slow'), (0, 'fast')])
+        session = requests.sessions.Session()
+        session.mount('http://example.com/', adapter)
+        wc = BaseWebClient(session, Mock(before_request=Mock(return_value=False)), self.latencies)
+
+        with patch('webclient.requests.Session', requests.sessions.Session):
+            resp = wc.request('http://example.com/', hedge=True)
+
+        self.assertEqual(resp.content, 'fast')
+        self.assertEqual(len(adapter.sent), 2)
+
+    def test_aborted_attempt_latency_is_not_recorded(self):
+        self.respond((0.5, self.slow), (0, self.fast))
+
+        self.wc.request('http://example.com/', hedge=True)
+        time.sleep(0.6)     # Slow attempt finishes after the fast one won
+
+        self.assertEqual(len(self.latencies.samples['GET example.com/']), 2)
+        self.assertLess(self.latencies.percentile('GET example.com/', 1.0), 0.5)
+
+
+class FirstPostWatcherTestCase(unittest.TestCase):
+
+    def feed(self, html, chunk_size):
+        watcher = FirstPostWatcher()
+        for i in range(0, len(html), chunk_size):
+            if watcher(html[i:i + chunk_size]):
+                return i + chunk_size
+        return None
+
+    def test_stops_after_second_post_starts(self):
+        html = '<tbody id="post_1"><a class="magnet-link-16"></a></tbody>' + '<tbody id="post_2">' + 'x' * 1000
+
+        for chunk_size in [1, 7, 16, 100]:
+            stopped_at = self.feed(html, chunk_size)
+            self.assertIsNotNone(stopped_at)
+            self.assertLessEqual(stopped_at, 100)
+
+    def test_does_not_stop_without_magnet_link(self):
+        html = '<tbody id="post_1"></tbody><tbody id="post_2"></tbody>'
+
+        self.assertIsNone(self.feed(html, 5))
+
+    def test_marker_in_tail_is_counted_once(self):
+        html = 'x' * 20 + '<tbody id="post_1">' + 'magnet-link-16'
+
+        self.assertIsNone(self.feed(html, 3))
+
+    def test_read_partial_stops_and_keeps_content(self):
+        response = MagicMock(headers={'content-length': '100'})
+        response.iter_content = Mock(return_value=iter(['a' * 10] * 10))
+        wc = BaseWebClient(None)
+
+        wc.read_partial(response, max_bytes=30)
+
+        self.assertEqual(response._content, 'a' * 30)
+        self.assertEqual(wc.bytes_skipped, 70)
+        self.assertTrue(response.close.called)
+
+
 class WebClientTestCase(URLFetchTestCase):
 
     def test_get_torrent_page_url_and_method(self):
-        webclient = WebClient(self.session)
-        webclient.get_torrent_page(1)
+        webclient = RutrackerWebClient(self.session)
+        webclient.get_torrent_page(Mock(cookies={'name': 'value'}), 1)
         self.session.request.assert_called_once_with('GET', 'http://rutracker.org/forum/viewtopic.php?t=1',
-                                                     timeout=TIMEOUTS)
+                                                     timeout=TIMEOUTS, stream=True)
 
     def test_tracker_log_in_url_and_method(self):
-        webclient = WebClient(self.session)
+        webclient = RutrackerWebClient(self.session)
         mock_acc = Mock(username='user', password='password', userid=12345)
 
         webclient.tracker_log_in(mock_acc)
-        formdata = WebClient.login_form_data(mock_acc)
+        formdata = RutrackerWebClient.login_form_data(mock_acc)
 
         self.session.request.assert_called_once_with('POST',
                                                      'http://login.rutracker.org/forum/login.php',
                                                      data=formdata, timeout=TIMEOUTS)
 
 
+@unittest.skipUnless(os.path.isdir(CASSETTE_DIR), 'Recorded tracker responses are not available')
 class WebClientIntegrationTestCase(BetamaxTestCase):
 
     def test_get_torrent_page(self):
-        webclient = WebClient(self.session)
-        html = webclient.get_torrent_page(669606)
-        self.assertIn(html, '669606')
+        webclient = RutrackerWebClient(self.session)
+        html = webclient.get_torrent_page(Mock(cookies={'name': 'value'}, userid=12345), 669606)
+        self.assertIn('669606', html)
@@ -1,5 +1,5 @@
 import datetime
-import email
+import email.utils
 
 
 def datetime_to_timestamp(dt):
@@ -11,3 +11,19 @@ def datetime_to_rfc822(dt):
     """Formats datetime object as RFC822 time string"""
     ts = datetime_to_timestamp(dt)
     return email.utils.formatdate(ts)
+
+
+def datetime_to_rfc3339(dt):
+    """Formats naive UTC datetime object as RFC3339 time string, as used in Atom feeds"""
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def datetime_to_http_date(dt):
+    """Formats datetime object as HTTP date, like in Last-Modified header"""
+    return email.utils.formatdate(datetime_to_timestamp(dt), usegmt=True)
+
+
+def http_date_to_timestamp(value):
+    """Parses HTTP date to POSIX timestamp, returns None if date is malformed"""
+    parsed = email.utils.parsedate_tz(value or '')
+    return email.utils.mktime_tz(parsed) if parsed else None
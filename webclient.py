@@ -1,33 +1,322 @@
 # coding: utf-8
 """Webclient is responsible for comunicating with tracker via HTTP"""
+import collections
+import copy
 import logging
+import Queue
+import threading
+import time
+import urlparse
+
 import requests
 
 
 TIMEOUTS = (3.05, 10)       # Connect, read
+CHUNK_SIZE = 16384          # For reading streamed responses
+BREAKER_THRESHOLD = 5       # Consecutive failed requests which open tracker circuit
+BREAKER_OPEN_TIME = 60      # Seconds circuit stays open before probe request is let through
+BREAKER_PROBE_TIME = 30     # Seconds probe request may take, another one is let through after that
+LATENCY_WINDOW = 200        # Latest request latencies kept per endpoint, timed out requests included
+LATENCY_MIN_SAMPLES = 20    # Endpoints with fewer samples get fixed TIMEOUTS and no hedged requests
+READ_TIMEOUT_FACTOR = 3     # Adaptive read timeout is this many times p99 latency of endpoint,
+READ_TIMEOUT_BOUNDS = (2, 20)   # within these bounds, seconds
+
+_local = threading.local()
+
+
+def get_session():
+    """Returns HTTP session of current thread. Reusing it keeps connections to tracker alive between tasks"""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def warm_up():
+    """Create HTTP session for current thread"""
+    get_session()
+
+
+_session_factory = get_session
+_spare_sessions = Queue.LifoQueue()     # Idle sessions of finished hedged request attempts, connections kept alive
+
+
+def borrow_session(template):
+    """Returns idle spare session, or new one, with headers, cookies and mounted adapters of template session
+
+    Hedged request attempts run in threads at the same time, so each of them gets a session of its own.
+    Adapters are shared, so requests go wherever template sends them, e.g. to recorded responses in tests"""
+    try:
+        session = _spare_sessions.get_nowait()
+    except Queue.Empty:
+        session = requests.Session()
+    session.headers = copy.copy(template.headers)
+    session.cookies.clear()
+    session.cookies.update(template.cookies)
+    session.adapters = copy.copy(template.adapters)
+    return session
+
+
+def release_session(session):
+    """Return borrowed session to spares once its request is finished"""
+    _spare_sessions.put(session)
+
+
+def set_session_factory(factory):
+    """Make web clients created without explicit session get it from factory. Returns previous factory"""
+    global _session_factory
+    previous, _session_factory = _session_factory, factory
+    return previous
+
+
+class CircuitBreaker(object):
+    """Stops requests to failing server, state is shared between instances in memcache
+
+    Circuit opens after threshold consecutive failures, then requests fail with CircuitOpen. Once open_time
+    has passed, one probe request is let through: circuit closes if it succeeds and opens again if it fails"""
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, open_time=BREAKER_OPEN_TIME,
+                 probe_time=BREAKER_PROBE_TIME, cache=None):
+        self.failures_key = 'breaker.{}.failures'.format(name)
+        self.open_key = 'breaker.{}.open_until'.format(name)
+        self.probe_key = 'breaker.{}.probe'.format(name)
+        self.threshold = threshold
+        self.open_time = open_time
+        self.probe_time = probe_time
+        self._cache = cache
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            from google.appengine.api import memcache     # Web client is also used outside of App Engine
+            self._cache = memcache
+        return self._cache
+
+    def before_request(self):
+        """Raise CircuitOpen if request must not be sent. Returns True if circuit state has to be reset on success"""
+        state = self.cache.get_multi([self.failures_key, self.open_key])
+        open_until = state.get(self.open_key)
+        if open_until is None:
+            return bool(state.get(self.failures_key))
+
+        now = time.time()
+        if now < open_until:
+            raise CircuitOpen('Circuit is open', open_until - now)
+        if not self.cache.add(self.probe_key, now, time=self.probe_time):
+            raise CircuitOpen('Circuit is half-open, probe request is running', self.probe_time)
+        logging.info('Sending probe request')
+        return True
+
+    def record_success(self, reset):
+        if reset:
+            self.cache.delete_multi([self.failures_key, self.open_key, self.probe_key])
+
+    def record_failure(self):
+        failures = self.cache.incr(self.failures_key, initial_value=0)
+        if failures >= self.threshold or self.cache.get(self.probe_key):
+            logging.warning('Opening circuit for %ds after %s consecutive failures', self.open_time, failures)
+            self.cache.set(self.open_key, time.time() + self.open_time)
+            self.cache.delete(self.probe_key)
+
+
+class LatencyTracker(object):
+    """Rolling windows of request latencies per endpoint, kept in instance memory
+
+    Every instance learns latencies from its own requests, so tracking costs no RPCs"""
+
+    def __init__(self, window=LATENCY_WINDOW, min_samples=LATENCY_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            if endpoint not in self.samples:
+                self.samples[endpoint] = collections.deque(maxlen=self.window)
+            self.samples[endpoint].append(seconds)
+
+    def percentile(self, endpoint, fraction):
+        """Returns latency percentile of endpoint in seconds, None if there are not enough samples yet"""
+        with self.lock:
+            samples = sorted(self.samples.get(endpoint, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def timeouts(self, endpoint):
+        """Returns (connect, read) timeouts for request to endpoint"""
+        p99 = self.percentile(endpoint, 0.99)
+        if p99 is None:
+            return TIMEOUTS
+        low, high = READ_TIMEOUT_BOUNDS
+        return TIMEOUTS[0], min(high, max(low, p99 * READ_TIMEOUT_FACTOR))
+
+
+_latencies = LatencyTracker()
+
+
+def endpoint(method, url):
+    """Returns endpoint name for request latency tracking: method, host and path without query"""
+    parts = urlparse.urlsplit(url)
+    return '{} {}{}'.format(method, parts.netloc, parts.path)
+
+
+_breaker = None
+
+
+def get_breaker():
+    """Returns tracker circuit breaker shared by web clients of the process"""
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker('tracker')
+    return _breaker
+
+
+_breaker_factory = get_breaker
+
+
+def set_breaker_factory(factory):
+    """Make web clients created without explicit breaker get it from factory, which may return None
+    for no breaker. Returns previous factory"""
+    global _breaker_factory
+    previous, _breaker_factory = _breaker_factory, factory
+    return previous
 
 
 class BaseWebClient(object):
     """Base class for tracker adapters"""
     ENCODING = 'utf-8'      # Default encoding for text responses
 
-    def __init__(self, session=None):
-        self.session = session or requests.Session()
+    def __init__(self, session=None, breaker=None, latencies=None):
+        self.session = session or _session_factory()
+        self.breaker = breaker or _breaker_factory()
+        self.latencies = latencies or _latencies
+        self.bytes_skipped = 0      # Response bytes left unread by streamed requests
         # Set logging level for libraries
         logging.getLogger("requests").setLevel(logging.WARNING)
         logging.getLogger("urllib3").setLevel(logging.WARNING)
 
-    def request(self, url, method='GET', **kwargs):
-        """Send an actual http request, raise Error on error"""
+    def request(self, url, method='GET', stop=None, max_bytes=None, hedge=False, **kwargs):
+        """Send an actual http request, raise Error on error
+
+        If stop or max_bytes are given, response body is streamed. Reading stops when stop(chunk) returns True
+        or max_bytes were read, and response.content holds the part of body read so far.
+        Timeouts follow latency of endpoint. If hedge is True, GET request is sent once more when there is
+        no response after p95 latency of endpoint, and the first response is used."""
+        name = endpoint(method, url)
+        kwargs['timeout'] = self.latencies.timeouts(name)
+        hedge_delay = self.latencies.percentile(name, 0.95) if hedge and method == 'GET' else None
+        reset = self.breaker.before_request() if self.breaker else False
         try:
-            resp = self.session.request(method, url, timeout=TIMEOUTS, **kwargs)
-            if not resp.ok:
-                resp.raise_for_status()
+            if hedge_delay is None:
+                resp = self.send(name, method, url, stop, max_bytes, **kwargs)
+            else:
+                resp = self.send_hedged(hedge_delay, name, method, url, stop, max_bytes, **kwargs)
         except requests.exceptions.RequestException as e:
+            if self.breaker and is_server_failure(e):
+                self.breaker.record_failure()
+            elif self.breaker:
+                self.breaker.record_success(reset)
+            if isinstance(e, requests.exceptions.Timeout):
+                raise RequestTimeout(str(e))
             raise RequestError(str(e))
 
+        if self.breaker:
+            self.breaker.record_success(reset)
+        return resp
+
+    def send(self, name, method, url, stop=None, max_bytes=None, aborted=None, **kwargs):
+        """Send request, read streamed response and record its latency. Raises requests exceptions
+
+        Timed out requests are recorded with the time they took, so timeouts grow when endpoint slows down.
+        Latency is not recorded if aborted() returns True once request is over"""
+        started = time.time()
+        if stop is not None or max_bytes is not None:
+            kwargs['stream'] = True
+        try:
+            resp = self.session.request(method, url, **kwargs)
+            if not resp.ok:
+                resp.raise_for_status()
+            if kwargs.get('stream'):
+                self.read_partial(resp, stop, max_bytes)
+        except requests.exceptions.Timeout:
+            if not (aborted and aborted()):
+                self.latencies.record(name, time.time() - started)
+            raise
+        if not (aborted and aborted()):
+            self.latencies.record(name, time.time() - started)
+        return resp
+
+    def send_hedged(self, delay, name, method, url, stop=None, max_bytes=None, **kwargs):
+        """Send request, and send it again if there is no response in delay seconds. Returns first response
+
+        Attempts run in threads on copies of this client. The first one uses session of this client, the hedged one
+        gets a borrowed session. Reading of the slower streamed response is stopped once the other one arrives,
+        and its latency is not recorded.
+        Raises error of the last attempt if all of them fail"""
+        results = Queue.Queue()
+        done = threading.Event()
+
+        def attempt(session):
+            client = copy.copy(self)
+            client.session = session
+            client.bytes_skipped = 0
+            attempt_stop = None
+            if stop is not None or max_bytes is not None:
+                own_stop = copy.copy(stop)      # Stop conditions may keep state, like FirstPostWatcher
+                attempt_stop = lambda chunk: done.is_set() or bool(own_stop and own_stop(chunk))
+            try:
+                resp = client.send(name, method, url, attempt_stop, max_bytes, done.is_set, **kwargs)
+                results.put((client, resp, None))
+            except requests.exceptions.RequestException as e:
+                results.put((client, None, e))
+            finally:
+                if session is not self.session:
+                    release_session(session)
+
+        # Timed waits poll in Python 2, so timer wakes the waiting thread instead
+        timer = threading.Timer(delay, results.put, [None])
+        threading.Thread(target=attempt, args=[self.session]).start()
+        timer.start()
+        pending = 1
+        while True:
+            result = results.get()
+            if result is None:
+                logging.debug('No response from %s in %.2fs, sending hedged request', name, delay)
+                threading.Thread(target=attempt, args=[borrow_session(self.session)]).start()
+                pending += 1
+                continue
+            pending -= 1
+            client, resp, error = result
+            if error is None or not pending:
+                break
+        timer.cancel()
+        done.set()
+
+        if error is not None:
+            raise error
+        self.bytes_skipped += client.bytes_skipped
         return resp
 
+    def read_partial(self, response, stop=None, max_bytes=None):
+        """Read streamed response body until stop(chunk) returns True or max_bytes were read, then close it"""
+        chunks = []
+        nread = 0
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                chunks.append(chunk)
+                nread += len(chunk)
+                if (max_bytes and nread >= max_bytes) or (stop and stop(chunk)):
+                    break
+        finally:
+            response.close()
+
+        response._content = ''.join(chunks)
+        response._content_consumed = True
+        content_length = response.headers.get('content-length')
+        if content_length and not response.headers.get('content-encoding'):
+            self.bytes_skipped += max(0, int(content_length) - nread)
+
     def user_request(self, account, url, method='GET',  **kwargs):
         """Send request on behalf of tracker user, handle session cookies"""
         if account.cookies:
@@ -47,7 +336,7 @@ class BaseWebClient(object):
     def authorized_request(self, account, url, method,  **kwargs):
         """Issue HTTP request and raise NotLoggedIn if user was not authorised on server"""
         resp = self.request(url, method, **kwargs)
-        html = self.get_text(resp)
+        html = self.get_content(resp)
 
         if html and not self.is_logged_in(html, account):
             raise NotLoggedIn('User {} is not logged in'.format(account))
@@ -60,9 +349,14 @@ class BaseWebClient(object):
             response.encoding = self.ENCODING
             return response.text
 
+    def get_content(self, response):
+        """Returns raw response body (bytes, not decoded) for text responses, None for non-text"""
+        if 'text' in response.headers['content-type']:
+            return response.content
+
     def is_logged_in(self, html, account):
         """Returns true if html response has user account info"""
-        return account.userid in html
+        return str(account.userid) in html
 
 
 class RutrackerWebClient(BaseWebClient):
@@ -74,15 +368,18 @@ class RutrackerWebClient(BaseWebClient):
     ENCODING = 'windows-1251'
     USER_MARKER = ('<a class="logged-in-as-uname" '
                    'href="http://rutracker.org/forum/profile.php?mode=viewprofile&amp;u={}">')
+    TORRENT_PAGE_MAX_BYTES = 1024 * 1024
+    HEDGE_TORRENT_PAGES = True      # Torrent page GETs are idempotent, slow ones are sent twice
 
     def get_torrent_page(self, account, tid):
-        """"Returns torrent page content"""
+        """"Returns torrent page content up to the end of first post, windows-1251 encoded"""
         url = self.TORRENT_PAGE_URL.format(tid)
-        resp = self.user_request(account, url)
-        return self.get_text(resp)
+        resp = self.user_request(account, url, stop=FirstPostWatcher(), max_bytes=self.TORRENT_PAGE_MAX_BYTES,
+                                 hedge=self.HEDGE_TORRENT_PAGES)
+        return self.get_content(resp)
 
     def get_index_page(self, account, forum_id=None):
-        """Returns page with latest torrents list"""
+        """Returns page with latest torrents list, windows-1251 encoded"""
         formdata = dict(self.INDEX_FORM_DATA)
         if forum_id is None:
             url = self.INDEX_URL
@@ -90,21 +387,21 @@ class RutrackerWebClient(BaseWebClient):
             url = self.INDEX_URL + '?f=' + str(forum_id)
             formdata['f[]'] = str(forum_id)
         resp = self.user_request(account, url, method='POST', data=formdata)
-        return self.get_text(resp)
+        return self.get_content(resp)
 
     def tracker_log_in(self, account):
         """Log in user via tracker log in form, returns True if login succeeded"""
         formdata = RutrackerWebClient.login_form_data(account)
 
         resp = self.request(self.LOGIN_URL, method='POST', data=formdata)
-        html = self.get_text(resp)
+        html = self.get_content(resp)
 
         if html and not RutrackerWebClient.is_logged_in(html, account):
             raise LoginFailed("Server login failed for {} ".format(account))
 
     @classmethod
     def is_logged_in(cls, html, account):
-        """Check if the page was requested with user logged in"""
+        """Check if the page was requested with user logged in. Marker is ascii, so html may be raw bytes"""
         marker = cls.USER_MARKER.format(account.userid)
         return marker in html
 
@@ -117,6 +414,38 @@ class RutrackerWebClient(BaseWebClient):
         }
 
 
+def is_server_failure(exc):
+    """Returns True if requests exception means server is down or overloaded, not that request was bad"""
+    response = getattr(exc, 'response', None)
+    return response is None or response.status_code >= 500
+
+
+class FirstPostWatcher(object):
+    """Watches streamed torrent page chunks, returns True once first post and magnet link have arrived
+
+    First post is complete when the second post starts or the posts table ends"""
+    MAGNET_MARKER = 'magnet-link-16'
+    POST_MARKER = '<tbody id="post_'
+    POSTS_END_MARKER = '</table><!--/topic_main-->'
+
+    def __init__(self):
+        self.tail = ''
+        self.magnet_seen = False
+        self.posts_seen = 0
+        self.posts_ended = False
+        self.overlap = max(len(self.MAGNET_MARKER), len(self.POST_MARKER), len(self.POSTS_END_MARKER)) - 1
+
+    def __call__(self, chunk):
+        window = self.tail + chunk      # Markers may be split between chunks
+        # Post markers starting this far into window were not fully inside previous tail, so not yet counted
+        new_from = max(0, len(self.tail) - len(self.POST_MARKER) + 1)
+        self.tail = window[-self.overlap:]
+        self.magnet_seen = self.magnet_seen or self.MAGNET_MARKER in window
+        self.posts_seen += window.count(self.POST_MARKER, new_from)
+        self.posts_ended = self.posts_ended or self.POSTS_END_MARKER in window
+        return self.magnet_seen and (self.posts_seen > 1 or self.posts_ended)
+
+
 class Error(RuntimeError):
     """Base class for all exceptions in this module"""
     pass
@@ -127,6 +456,19 @@ class RequestError(Error):
     pass
 
 
+class RequestTimeout(RequestError):
+    """HTTP request timed out"""
+    pass
+
+
+class CircuitOpen(RequestError):
+    """Request was not sent, tracker is failing. Retry after retry_after seconds"""
+
+    def __init__(self, message, retry_after):
+        super(CircuitOpen, self).__init__(message)
+        self.retry_after = retry_after
+
+
 class LoginFailed(Error):
     """Server login failed"""
     pass